@@ -57,29 +57,115 @@
 #   valueMap: A dict of possible outputs and the human-readable value they 
 #             should be mapped to.  In the above example, fmode=0 is mapped to
 #             'Auto', while fmode=2 is mapped to 'On'.  
+#   ttl:      Optional maximum age in seconds of cached data used for this 
+#             entry.  By default the TTL of the getter URL applies.
+#   snapshot: False to leave the entry out of readableKeys (and so out of 
+#             snapshot() and the command line's default output), for values 
+#             that are slow to read and only wanted on request.
+#
+# An API may also define cacheTTLs, a dict mapping thermostat URLs to the 
+# number of seconds their responses can be cached (e.g. the model never 
+# changes).  URLs not listed use the TStat's cacheExpiry.
 #
 # Extending an existing API:
 #   Assume that in a new hardware/software revision, power usage data in KWH is
 #   available at /tstat/kwh.  A new API could be defined as follows:
 #
 # class APIv2(APIv1):
-#     def __init__(self):
-#         self.entries['fmode'].getters = [('/tstat/kwh', 'kwh')]
+#     models = ['CT80 V2.00']
+#     entries = dict(APIv1.entries)
+#     entries['kwh'] = APIEntry([('/tstat/kwh', 'kwh')], [])
 #
 #   You would most likely also want to add access functions to TStat.py as 
 #   well.
+#
+# Every API subclass is checked and indexed once, when the class is defined
+# (see APIMeta): malformed entries raise ValueError at import time, each 
+# entry gets its reverse value map and pre-split JSON key paths, the class 
+# gets locationKeys (URL -> keys it supplies), and its models are added to 
+# the index used by getAPI.  Define entries in the class body rather than 
+# modifying them afterwards, or the index will be out of date.
 
 class APIEntry:
-	def __init__(self, getters, setters, valueMap=None, usesJson=True):
+	def __init__(self, getters, setters, valueMap=None, usesJson=True, ttl=None, snapshot=True):
 		self.getters = getters
 		self.setters = setters
 		self.valueMap = valueMap
 		self.usesJson = usesJson
+		self.ttl = ttl
+		self.snapshot = snapshot
+
+	def _compile(self, name):
+		"""Used internally to validate this entry and precompute lookups for it."""
+		for kind in ('getters', 'setters'):
+			accessors = getattr(self, kind)
+			if not isinstance(accessors, list):
+				raise ValueError("%s: %s must be a list" % (name, kind))
+			for accessor in accessors:
+				if not isinstance(accessor, tuple) or len(accessor) != 2 \
+						or not isinstance(accessor[0], str) or not isinstance(accessor[1], str) \
+						or not accessor[0].startswith('/') or not accessor[1]:
+					raise ValueError("%s: bad %s entry %r (expected ('/url', 'key'))" % (name, kind[:-1], accessor))
+
+		# Reverse value map, used to turn e.g. 'On' back into 2
+		self.inverse = None
+		if self.valueMap is not None:
+			if not isinstance(self.valueMap, dict):
+				raise ValueError("%s: valueMap must be a dict" % name)
+			self.inverse = {}
+			for k, v in self.valueMap.items():
+				if self.inverse.has_key(v):
+					raise ValueError("%s: valueMap maps both %r and %r to %r" % (name, self.inverse[v], k, v))
+				self.inverse[v] = k
+
+		# JSON key paths, e.g. 'today/heat_runtime' -> ('today', 'heat_runtime')
+		self.paths = {}
+		self.byLocation = {}
+		self.ranks = {}
+		for rank, getter in enumerate(self.getters):
+			self.paths[getter] = tuple(getter[1].split("/"))
+			if not self.byLocation.has_key(getter[0]):
+				self.byLocation[getter[0]] = getter
+				self.ranks[getter[0]] = rank
+
+# Model string -> API class, filled in by APIMeta
+modelIndex = {}
+
+class APIMeta(type):
+	"""Validates and indexes each API class when it is defined."""
+
+	def __init__(cls, name, bases, namespace):
+		type.__init__(cls, name, bases, namespace)
+		entries = cls.__dict__.get('entries')
+		if entries is None:
+			entries = getattr(cls, 'entries', None) or {}
+		if not isinstance(entries, dict):
+			raise ValueError("%s.entries must be a dict" % name)
+
+		locationKeys = {}
+		for key, entry in entries.items():
+			if not isinstance(entry, APIEntry):
+				raise ValueError("%s.entries['%s'] is not an APIEntry" % (name, key))
+			entry._compile("%s.entries['%s']" % (name, key))
+			for location in entry.byLocation:
+				locationKeys.setdefault(location, []).append(key)
+		cls.locationKeys = locationKeys
+		cls.readableKeys = sorted([key for key, entry in entries.items() if entry.getters and entry.snapshot])
+
+		# Only models listed in this class body; subclasses that inherit a 
+		# models list must not take over their parent's models
+		for model in cls.__dict__.get('models', []):
+			modelIndex.setdefault(model, cls)
 
 class API:
+	__metaclass__ = APIMeta
+
 	models = []
 	successStrings = []
 	entries = None
+	cacheTTLs = {
+		'/tstat/model': 24*60*60
+	}
 
 	def __getitem__(self, item):
 		return self.entries[item]
@@ -101,6 +187,10 @@ class API_CT50v109(API):
 						"Cloud updates have been suspended till reboot",
 						"Cloud updates activated"
 	]
+	cacheTTLs = {
+		'/tstat/model': 24*60*60,
+		'/tstat/datalog': 60
+	}
 	entries = {
 		'fmode': APIEntry(
 			[('/tstat/fmode', 'fmode'), ('/tstat', 'fmode')],
@@ -191,7 +281,24 @@ class API_CT50v109(API):
 			[],
 			[('/cloud/mode', 'command')],
 			usesJson=False
-		)
+		),
+		# 7-day program: [minute, temp] for each of four periods, where 
+		# minute counts from midnight.  Days are numbered from Monday.  
+		# Read through TStat.getProgram rather than every snapshot.
+		'program_heat_mon': APIEntry([('/tstat/program/heat', '0')], [('/tstat/program/heat', '0')], snapshot=False),
+		'program_heat_tue': APIEntry([('/tstat/program/heat', '1')], [('/tstat/program/heat', '1')], snapshot=False),
+		'program_heat_wed': APIEntry([('/tstat/program/heat', '2')], [('/tstat/program/heat', '2')], snapshot=False),
+		'program_heat_thu': APIEntry([('/tstat/program/heat', '3')], [('/tstat/program/heat', '3')], snapshot=False),
+		'program_heat_fri': APIEntry([('/tstat/program/heat', '4')], [('/tstat/program/heat', '4')], snapshot=False),
+		'program_heat_sat': APIEntry([('/tstat/program/heat', '5')], [('/tstat/program/heat', '5')], snapshot=False),
+		'program_heat_sun': APIEntry([('/tstat/program/heat', '6')], [('/tstat/program/heat', '6')], snapshot=False),
+		'program_cool_mon': APIEntry([('/tstat/program/cool', '0')], [('/tstat/program/cool', '0')], snapshot=False),
+		'program_cool_tue': APIEntry([('/tstat/program/cool', '1')], [('/tstat/program/cool', '1')], snapshot=False),
+		'program_cool_wed': APIEntry([('/tstat/program/cool', '2')], [('/tstat/program/cool', '2')], snapshot=False),
+		'program_cool_thu': APIEntry([('/tstat/program/cool', '3')], [('/tstat/program/cool', '3')], snapshot=False),
+		'program_cool_fri': APIEntry([('/tstat/program/cool', '4')], [('/tstat/program/cool', '4')], snapshot=False),
+		'program_cool_sat': APIEntry([('/tstat/program/cool', '5')], [('/tstat/program/cool', '5')], snapshot=False),
+		'program_cool_sun': APIEntry([('/tstat/program/cool', '6')], [('/tstat/program/cool', '6')], snapshot=False)
 		#'eventlog': #TODO
 	}
 
@@ -201,6 +308,7 @@ class API_CT30v192(API_CT50v109):
 APIs = [API_CT50v109, API_CT30v192]
 
 def getAPI(model):
-	for api in APIs:
-		if model in api.models:
-			return api()
+	try:
+		return modelIndex[model]()
+	except (KeyError, TypeError):
+		return None
@@ -0,0 +1,571 @@
+#!/usr/bin/env python
+
+#Copyright (c) 2011, Paul Jennings <pjennings-tstat@pjennings.net>
+#All rights reserved.
+
+#Redistribution and use in source and binary forms, with or without
+#modification, are permitted provided that the following conditions are met:
+#
+#    * Redistributions of source code must retain the above copyright notice,
+#      this list of conditions and the following disclaimer.
+#    * Redistributions in binary form must reproduce the above copyright
+#      notice, this list of conditions and the following disclaimer in the
+#      documentation and/or other materials provided with the distribution.
+#    * The names of its contributors may not be used to endorse or promote
+#      products derived from this software without specific prior written
+#      permission.
+
+#THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+#AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+#IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+#ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+#LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+#CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+#SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+#INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+#CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+#ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF
+#THE POSSIBILITY OF SUCH DAMAGE.
+
+# AsyncTStat.py
+# Non-blocking interface for Radio Thermostat wifi-enabled thermostats.
+
+# Usage:
+# loop = EventLoop()
+# t = AsyncTStat('1.2.3.4', loop=loop)
+# d = t.getCurrentTemp()       # Returns a Deferred immediately
+# d.addCallback(handleTemp)    # handleTemp(70.5) is called from the loop
+# loop.run()                   # Runs until all outstanding requests finish
+#
+# t.getHeatPoint().wait()      # Or run the loop until one result is ready
+#
+# AsyncTStat has the same getX/setX methods as TStat, but each returns a
+# Deferred instead of blocking.  All thermostats sharing one EventLoop are
+# driven from a single thread using asyncore, and retry backoff is scheduled
+# on the loop's timer queue instead of sleeping.  The API tables, cache,
+# getter fallback and value mapping are inherited from TStat unchanged.
+
+import asyncore
+import heapq
+import socket
+import time
+
+from TStat import TStat, PROGRAM_DAYS
+from API import *
+from Cache import monotonic
+
+class Deferred:
+	"""Result of an asynchronous call, delivered to callbacks when ready."""
+
+	def __init__(self, loop=None):
+		self.loop = loop
+		self.called = False
+		self.result = None
+		self.error = None
+		self._callbacks = []
+
+	def addCallback(self, callback, errback=None):
+		"""Calls callback(result) on success or errback(error) on failure."""
+		self._callbacks.append((callback, errback))
+		if self.called:
+			self._fire()
+		return self
+
+	def callback(self, result):
+		self.called = True
+		self.result = result
+		self._fire()
+
+	def errback(self, error):
+		self.called = True
+		self.error = error
+		self._fire()
+
+	def _fire(self):
+		while self._callbacks:
+			callback, errback = self._callbacks.pop(0)
+			if self.error is None:
+				callback(self.result)
+			elif errback is not None:
+				errback(self.error)
+
+	def wait(self):
+		"""Runs the event loop until this result is ready, then returns it."""
+		self.loop.run(lambda: self.called)
+		if self.error is not None:
+			raise self.error
+		return self.result
+
+def gatherResults(deferreds, loop=None):
+	"""Returns a Deferred that fires with a list of results once all of deferreds have."""
+	gathered = Deferred(loop)
+	results = [None] * len(deferreds)
+	remaining = [len(deferreds)]
+
+	def collect(index):
+		def done(result):
+			results[index] = result
+			remaining[0] = remaining[0] - 1
+			if remaining[0] == 0:
+				gathered.callback(results)
+		def failed(error):
+			if not gathered.called:
+				gathered.errback(error)
+		return (done, failed)
+
+	if not deferreds:
+		gathered.callback(results)
+	for i, d in enumerate(deferreds):
+		d.addCallback(*collect(i))
+	return gathered
+
+class EventLoop:
+	"""Single-threaded loop driving sockets and timers for any number of tstats."""
+
+	def __init__(self):
+		self.map = {}
+		self._timers = []
+		self._live = 0
+		self._seq = 0
+
+	def callLater(self, delay, func, *args):
+		"""Schedules func(*args) to run after delay seconds.
+
+		Returns a handle that can be passed to cancel()."""
+		self._seq = self._seq + 1
+		timer = [time.time() + delay, self._seq, func, args]
+		heapq.heappush(self._timers, timer)
+		self._live = self._live + 1
+		return timer
+
+	def cancel(self, timer):
+		"""Cancels a timer returned by callLater if it has not run yet."""
+		if timer[2] is not None:
+			timer[2] = None
+			self._live = self._live - 1
+
+	def _runTimers(self):
+		now = time.time()
+		while self._timers and self._timers[0][0] <= now:
+			timer = heapq.heappop(self._timers)
+			func, args = timer[2], timer[3]
+			if func is not None:
+				timer[2] = None
+				self._live = self._live - 1
+				func(*args)
+		# Drop cancelled timers so they don't hold up the next wakeup
+		while self._timers and self._timers[0][2] is None:
+			heapq.heappop(self._timers)
+
+	def run(self, until=None):
+		"""Runs until there is no more work, or until until() returns True."""
+		while self.map or self._live:
+			if until is not None and until():
+				return
+			timeout = 1.0
+			if self._timers:
+				timeout = max(0, min(timeout, self._timers[0][0] - time.time()))
+			if self.map:
+				asyncore.loop(timeout, True, self.map, 1)
+			else:
+				time.sleep(timeout)
+			self._runTimers()
+
+class _HTTPRequest(asyncore.dispatcher):
+	"""One non-blocking HTTP/1.0 request; the response ends when the tstat closes."""
+
+	def __init__(self, loop, address, method, location, body, headers, deferred, timeout):
+		asyncore.dispatcher.__init__(self, map=loop.map)
+		self.deferred = deferred
+		self.inbuf = []
+		lines = ["%s %s HTTP/1.0" % (method, location), "Host: %s" % address]
+		headers = dict(headers or {})
+		if body is not None:
+			headers["Content-Length"] = str(len(body))
+		for k, v in headers.items():
+			lines.append("%s: %s" % (k, v))
+		self.outbuf = "\r\n".join(lines) + "\r\n\r\n" + (body or "")
+
+		host, port = address, 80
+		if ":" in address:
+			host, port = address.rsplit(":", 1)
+			port = int(port)
+		self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+		self.loop = loop
+		self.timer = loop.callLater(timeout, self._timeout)
+		try:
+			self.connect((host, port))
+		except socket.error, e:
+			self._finish(error=e)
+
+	def _finish(self, response=None, error=None):
+		if self.deferred.called:
+			return
+		self.loop.cancel(self.timer)
+		self.close()
+		if error is not None:
+			self.deferred.errback(error)
+		else:
+			self.deferred.callback(response)
+
+	def _timeout(self):
+		self._finish(error=socket.timeout("timed out"))
+
+	def handle_connect(self):
+		pass
+
+	def writable(self):
+		return not self.connected or len(self.outbuf) > 0
+
+	def handle_write(self):
+		sent = self.send(self.outbuf)
+		self.outbuf = self.outbuf[sent:]
+
+	def handle_read(self):
+		data = self.recv(8192)
+		if data:
+			self.inbuf.append(data)
+
+	def handle_close(self):
+		data = "".join(self.inbuf)
+		head, sep, body = data.partition("\r\n\r\n")
+		try:
+			status = int(head.split(None, 2)[1])
+		except (IndexError, ValueError):
+			self._finish(error=socket.error("Malformed response: %r" % data[:80]))
+			return
+		self._finish((status, body))
+
+	def handle_error(self):
+		self._finish(error=socket.error("Request failed: %s" % (asyncore.compact_traceback()[2],)))
+
+	def log(self, message):
+		pass
+
+class AsyncTStat(TStat):
+	def __init__(self, address, cacheExpiry=5, api=None, logger=None, logLevel=None, loop=None, **kwargs):
+		if loop is None:
+			loop = EventLoop()
+		self.loop = loop
+		self._detecting = None
+		TStat.__init__(self, address, cacheExpiry, api, logger, logLevel, **kwargs)
+
+	def _deferred(self):
+		return Deferred(self.loop)
+
+	def _ready(self):
+		"""Used internally to detect the API (once) before the first real request."""
+		if self._detecting is None and self._api is None:
+			api = self._knownAPI()
+			if api is not None:
+				self._useAPI(api)
+		if self._detecting is None and self._api is not None:
+			d = self._deferred()
+			d.callback(self._api)
+			return d
+		if self._detecting is None and self._detectPending():
+			# Like TStat, answer with None until it is time to try again
+			d = self._deferred()
+			d.callback(None)
+			return d
+		if self._detecting is None:
+			# The base API knows just enough to ask for the model
+			self._api = API()
+			self._detecting = self._deferred()
+			def detected(model):
+				detecting = self._detecting
+				self._detecting = None
+				api = self._detected(model)
+				self._useAPI(api)
+				detecting.callback(api)
+			def failed(error):
+				detecting = self._detecting
+				self._detecting = None
+				self._api = None
+				self._detected(None)
+				detecting.callback(None)
+			self._getAsync('model', True).addCallback(detected, failed)
+		d = self._deferred()
+		self._detecting.addCallback(d.callback, d.errback)
+		return d
+
+	def _fetchAsync(self, method, location, body=None, headers=None):
+		"""Used internally to perform a request under the retry policy, backing off on the loop's timers.
+
+		Fires with the last (status, data) tuple, or None if the tstat never 
+		answered (or is known to be offline)."""
+		d = self._deferred()
+		if not self.breaker.allow():
+			self.logger.warning("%s is not responding; skipping %s %s" % (self.address, method, location))
+			if self.metrics is not None:
+				self.metrics.inc('tstat_breaker_rejections_total', (('address', self.address),))
+			d.callback(None)
+			return d
+		call = self.retry.begin()
+
+		def attempt():
+			# Waiting for the spacer comes out of the call's deadline
+			self.loop.callLater(min(self.spacer.reserve(), max(call.remaining(), 0)), send)
+
+		def send():
+			started = monotonic()
+			def done(response):
+				if self.metrics is not None:
+					self._measure(method, location, started, response)
+				self.spacer.record(response[0] < 500)
+				check(response)
+			def failed(error):
+				self.logger.debug("%s %s failed: %s" % (method, location, error))
+				if self.metrics is not None:
+					self._measure(method, location, started, None)
+				self.spacer.record(False)
+				check(None)
+			r = self._deferred()
+			r.addCallback(done, failed)
+			connect, read = call.timeouts()
+			_HTTPRequest(self.loop, self.address, method, location, body, headers, r, connect + read)
+
+		def check(response):
+			status = None
+			if response is not None:
+				status = response[0]
+			if self.retry.retryable(status):
+				delay = call.next()
+				if delay is not None:
+					if self.metrics is not None:
+						self.metrics.inc('tstat_retries_total', (('address', self.address), ('method', method), ('location', location)))
+					self.loop.callLater(delay, attempt)
+					return
+				self.breaker.failure()
+			else:
+				self.breaker.success()
+			d.callback(response)
+
+		attempt()
+		return d
+
+	def _revalidate(self, location):
+		"""Used internally to refresh a stale location from the event loop."""
+		if location in self._refreshing:
+			return
+		self._refreshing.add(location)
+		def fetched(response):
+			self._refreshing.discard(location)
+			response = self._parse(location, response)
+			if response is not None:
+				self.cache.put(location, response)
+		def failed(error):
+			self._refreshing.discard(location)
+		self._fetchAsync("GET", location).addCallback(fetched, failed)
+
+	def _getAsync(self, key, raw=False):
+		"""Used internally to retrieve key, trying each getter in turn."""
+		d = self._deferred()
+		entry = self._entry(key)
+		if entry is None:
+			d.callback(None)
+			return d
+
+		getter, response = self._cached(entry)
+		if getter is not None:
+			self.logger.debug("Using cached entry")
+			d.callback(self._extract(entry, getter, response, raw))
+			return d
+
+		getters = list(entry.getters)
+		def tryNext(ignored=None):
+			if not getters:
+				self.logger.error("Unable to retrieve '%s' from any of %s" % (key, entry.getters))
+				d.callback(None)
+				return
+			getter = getters.pop(0)
+			def fetched(response):
+				response = self._parse(getter[0], response)
+				if response is None:
+					tryNext()
+					return
+				self.cache.put(getter[0], response)
+				d.callback(self._extract(entry, getter, response, raw))
+			self._fetchAsync("GET", getter[0]).addCallback(fetched, d.errback)
+		tryNext()
+		return d
+
+	def _get(self, key, raw=False):
+		"""Used internally to retrieve data from the tstat; returns a Deferred."""
+		d = self._deferred()
+		def ready(api):
+			self._getAsync(key, raw).addCallback(d.callback, d.errback)
+		self._ready().addCallback(ready, d.errback)
+		return d
+
+	def _post(self, key, value):
+		"""Used internally to modify tstat settings; returns a Deferred."""
+		d = self._deferred()
+		def ready(api):
+			entry = self._entry(key, setting=True)
+			if entry is None:
+				d.callback(False)
+				return
+			raw = self._toRaw(key, entry, value)
+			if self._isNoop(key, entry, raw):
+				d.callback(True)
+				return
+			setters = list(entry.setters)
+			def tryNext(ignored=None):
+				if not setters:
+					d.callback(None)
+					return
+				setter = setters.pop(0)
+				params = self._encode(entry, setter, raw)
+				def posted(response):
+					result = self._checkSet(setter[0], params, response)
+					self._written(entry, raw, result)
+					if result is not None:
+						d.callback(True)
+					else:
+						tryNext()
+				self._fetchAsync("POST", setter[0], params, self.postHeaders).addCallback(posted, d.errback)
+			tryNext()
+		self._ready().addCallback(ready, d.errback)
+		return d
+
+	def setMany(self, values):
+		"""Returns a Deferred firing with a dict of key -> success, sending one POST per setter location."""
+		d = self._deferred()
+		def ready(api):
+			results = {}
+			pending = self._pendingSets(values, results)
+			def round(ignored=None):
+				requests = self._setGroups(pending)
+				if not requests:
+					for key in pending.keys():
+						results[key] = False
+					d.callback(results)
+					return
+				posts = []
+				for location, body, keys in requests:
+					def posted(response, location=location, body=body, keys=keys):
+						result = self._checkSet(location, body, response)
+						for key in keys:
+							self._written(pending[key][0], pending[key][1], result)
+						if result is None:
+							return
+						for key in keys:
+							results[key] = result
+							del pending[key]
+					posts.append(self._fetchAsync("POST", location, body, self.postHeaders).addCallback(posted))
+				gatherResults(posts).addCallback(round, d.errback)
+			round()
+		self._ready().addCallback(ready, d.errback)
+		return d
+
+	def _getManyAsync(self, keys, raw=False):
+		"""Used internally to fetch every planned location concurrently, replanning on failure."""
+		d = self._deferred()
+		entries = {}
+		for key in keys:
+			entry = self._entry(key)
+			if entry is not None:
+				entries[key] = entry
+		results = {}
+		failed = set()
+		pending = set(entries)
+
+		def finish():
+			for key in keys:
+				if not results.has_key(key):
+					if entries.has_key(key):
+						self.logger.error("Unable to retrieve '%s' from any of %s" % (key, entries[key].getters))
+					results[key] = None
+			d.callback(results)
+
+		def use(location, planKeys, response):
+			for key in planKeys:
+				entry = entries[key]
+				results[key] = self._extract(entry, self._getter(entry, location), response, raw)
+				pending.discard(key)
+
+		def round():
+			plan = self._plan(entries, pending, failed)
+			if not plan:
+				finish()
+				return
+			fetches = []
+			for location, planKeys in plan:
+				response = self._cachedLocation(location)
+				if response is not None:
+					use(location, planKeys, response)
+					continue
+				def fetched(response, location=location, planKeys=planKeys):
+					response = self._parse(location, response)
+					if response is None:
+						failed.add(location)
+						return
+					self.cache.put(location, response)
+					use(location, planKeys, response)
+				fetches.append(self._fetchAsync("GET", location).addCallback(fetched))
+			if pending:
+				gatherResults(fetches).addCallback(lambda ignored: round(), d.errback)
+			else:
+				finish()
+
+		round()
+		return d
+
+	def getMany(self, keys, raw=False):
+		"""Returns a Deferred firing with a dict of values for keys, retrieving each URL at most once."""
+		d = self._deferred()
+		def ready(api):
+			self._getManyAsync(keys, raw).addCallback(d.callback, d.errback)
+		self._ready().addCallback(ready, d.errback)
+		return d
+
+	def snapshot(self, raw=False):
+		"""Returns a Deferred firing with a dict of every readable value."""
+		d = self._deferred()
+		def ready(api):
+			self._getManyAsync(self.api.readableKeys, raw).addCallback(d.callback, d.errback)
+		self._ready().addCallback(ready, d.errback)
+		return d
+
+	def getSetPoints(self, raw=False):
+		"""Returns both heating and cooling set points."""
+		d = self._deferred()
+		def done(values):
+			d.callback((values['t_heat'], values['t_cool']))
+		self.getMany(['t_heat', 't_cool']).addCallback(done, d.errback)
+		return d
+
+	def getTime(self, raw=False):
+		"""Returns current time."""
+		return self.getMany(['day', 'hour', 'minute'])
+
+	def getProgram(self, mode):
+		"""Returns the 7-day program for mode ('heat' or 'cool') as a dict of day number (0 is Monday) -> [minute, temp, ...]."""
+		d = self._deferred()
+		keys = ['program_%s_%s' % (mode, day) for day in PROGRAM_DAYS]
+		def done(values):
+			d.callback(dict([(i, values[key]) for i, key in enumerate(keys)]))
+		self.getMany(keys, raw=True).addCallback(done, d.errback)
+		return d
+
+	def setProgram(self, mode, program):
+		"""Sets the days in program of the 7-day program for mode; returns a Deferred firing with day number -> True/False."""
+		d = self._deferred()
+		values = dict([('program_%s_%s' % (mode, PROGRAM_DAYS[day]), periods) for day, periods in program.items()])
+		def done(results):
+			d.callback(dict([(day, results['program_%s_%s' % (mode, PROGRAM_DAYS[day])]) for day in program]))
+		self.setMany(values).addCallback(done, d.errback)
+		return d
+
+	def isOK(self):
+		"""Returns true if thermostat reports that it is OK."""
+		d = self._deferred()
+		self._get('errstatus').addCallback(lambda r: d.callback(r == 'OK'), d.errback)
+		return d
+
+	def getEventLog(self):
+		"""Returns events?"""
+		d = self._deferred()
+		d.callback(None)
+		return d
@@ -0,0 +1,185 @@
+#!/usr/bin/env python
+
+#Copyright (c) 2011, Paul Jennings <pjennings-tstat@pjennings.net>
+#All rights reserved.
+
+#Redistribution and use in source and binary forms, with or without
+#modification, are permitted provided that the following conditions are met:
+#
+#    * Redistributions of source code must retain the above copyright notice,
+#      this list of conditions and the following disclaimer.
+#    * Redistributions in binary form must reproduce the above copyright
+#      notice, this list of conditions and the following disclaimer in the
+#      documentation and/or other materials provided with the distribution.
+#    * The names of its contributors may not be used to endorse or promote
+#      products derived from this software without specific prior written
+#      permission.
+
+#THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+#AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+#IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+#ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+#LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+#CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+#SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+#INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+#CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+#ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF
+#THE POSSIBILITY OF SUCH DAMAGE.
+
+# Benchmark.py
+# Throughput and latency benchmarks against simulated thermostats.
+
+# Usage:
+# python Benchmark.py [latency [maxDevices]]
+#
+# Starts simulated thermostats (see Simulator.py) answering after latency
+# seconds (default 0.02) and prints:
+#   reads:    Uncached getCurrentTemp() calls, one after another: reads/sec
+#             and p50/p99 latency.
+#   cache:    A mix of getters with a 1 second cache: reads/sec, cache hit
+#             ratio and HTTP requests per read.
+#   snapshot: snapshot() against reading every key with its own getter.
+#   fleet:    TStatFleet and AsyncTStat reading every device of fleets of
+#             1, 2, 4, ... maxDevices (default 32) thermostats.
+#
+# Each bench* function returns a dict, so they can also be called from other
+# scripts to compare runs.
+
+import logging
+import sys
+
+from API import API_CT50v109
+from Cache import monotonic
+from Simulator import Simulator, simulateMany
+from TStat import TStat
+
+def percentile(values, p):
+	"""Returns the p'th percentile (0-100) of values."""
+	if not values:
+		return None
+	values = sorted(values)
+	return values[min(len(values) - 1, int(round(p / 100.0 * (len(values) - 1))))]
+
+def _tstat(address, **kwargs):
+	"""Used internally to build a TStat that skips model detection and the registry."""
+	kwargs.setdefault('api', API_CT50v109())
+	kwargs.setdefault('registry', False)
+	return TStat(address, **kwargs)
+
+def benchReads(address, count=200):
+	"""Times count uncached reads from one thermostat."""
+	t = _tstat(address, cacheExpiry=0)
+	latencies = []
+	started = monotonic()
+	for i in range(count):
+		begin = monotonic()
+		t.getCurrentTemp()
+		latencies.append(monotonic() - begin)
+	elapsed = monotonic() - started
+	t.close()
+	return {
+		'reads': count,
+		'seconds': elapsed,
+		'readsPerSec': count / elapsed,
+		'p50': percentile(latencies, 50),
+		'p99': percentile(latencies, 99)
+	}
+
+def benchCache(simulator, duration=3, cacheExpiry=1):
+	"""Reads a mix of values for duration seconds with a cacheExpiry second cache."""
+	t = _tstat(simulator.address, cacheExpiry=cacheExpiry)
+	getters = [t.getCurrentTemp, t.getTState, t.getFanMode, t.getHeatPoint, t.getHoldState]
+	before = simulator.stats()['requests']
+	reads = 0
+	started = monotonic()
+	while monotonic() - started < duration:
+		getters[reads % len(getters)]()
+		reads = reads + 1
+	elapsed = monotonic() - started
+	stats = t.cache.stats()
+	t.close()
+	requests = simulator.stats()['requests'] - before
+	lookups = stats['hits'] + stats['stale'] + stats['misses']
+	return {
+		'reads': reads,
+		'readsPerSec': reads / elapsed,
+		'hitRatio': float(stats['hits']) / max(lookups, 1),
+		'requestsPerRead': float(requests) / max(reads, 1)
+	}
+
+def benchSnapshot(simulator, count=20):
+	"""Compares snapshot() with reading each key through its own getter."""
+	t = _tstat(simulator.address, cacheExpiry=0)
+	keys = t.api.readableKeys
+	result = {}
+	for name in ('snapshot', 'getters'):
+		before = simulator.stats()['requests']
+		started = monotonic()
+		for i in range(count):
+			if name == 'snapshot':
+				t.snapshot(raw=True)
+			else:
+				for key in keys:
+					t._get(key, raw=True)
+		elapsed = monotonic() - started
+		result[name] = {
+			'secondsPerCall': elapsed / count,
+			'requestsPerCall': float(simulator.stats()['requests'] - before) / count
+		}
+	t.close()
+	return result
+
+def benchFleet(addresses, rounds=3, workers=16):
+	"""Reads every address rounds times with TStatFleet and with AsyncTStat."""
+	from AsyncTStat import AsyncTStat, EventLoop, gatherResults
+	from TStatFleet import TStatFleet
+
+	result = {}
+	fleet = TStatFleet(addresses, workers=workers, api=API_CT50v109(), registry=False, cacheExpiry=0)
+	fleet.gather('getCurrentTemp')
+	started = monotonic()
+	for i in range(rounds):
+		fleet.gather('getCurrentTemp')
+	result['fleet'] = len(addresses) * rounds / (monotonic() - started)
+	fleet.close()
+
+	loop = EventLoop()
+	tstats = [AsyncTStat(a, api=API_CT50v109(), registry=False, cacheExpiry=0, loop=loop) for a in addresses]
+	started = monotonic()
+	for i in range(rounds):
+		gatherResults([t.getCurrentTemp() for t in tstats], loop).wait()
+	result['async'] = len(addresses) * rounds / (monotonic() - started)
+	return result
+
+def main():
+	latency = 0.02
+	maxDevices = 32
+	if len(sys.argv) > 1:
+		latency = float(sys.argv[1])
+	if len(sys.argv) > 2:
+		maxDevices = int(sys.argv[2])
+	logging.basicConfig(level=logging.ERROR)
+
+	s = Simulator(latency=latency)
+	r = benchReads(s.address)
+	print "reads:    %.1f reads/sec  p50 %.1fms  p99 %.1fms" % (r['readsPerSec'], r['p50'] * 1000, r['p99'] * 1000)
+	r = benchCache(s)
+	print "cache:    %.1f reads/sec  hit ratio %.3f  %.3f requests/read" % (r['readsPerSec'], r['hitRatio'], r['requestsPerRead'])
+	r = benchSnapshot(s)
+	for name in ('snapshot', 'getters'):
+		print "%-9s %.1fms/call  %.1f requests/call" % (name + ":", r[name]['secondsPerCall'] * 1000, r[name]['requestsPerCall'])
+	s.close()
+
+	print "fleet:    devices  TStatFleet reads/sec  AsyncTStat reads/sec"
+	size = 1
+	while size <= maxDevices:
+		simulators = simulateMany(size, latency=latency)
+		r = benchFleet([sim.address for sim in simulators])
+		print "          %7d  %20.1f  %20.1f" % (size, r['fleet'], r['async'])
+		for sim in simulators:
+			sim.close()
+		size = size * 2
+
+if __name__ == '__main__':
+	main()
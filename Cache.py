@@ -0,0 +1,506 @@
+#!/usr/bin/env python
+
+#Copyright (c) 2011, Paul Jennings <pjennings-tstat@pjennings.net>
+#All rights reserved.
+
+#Redistribution and use in source and binary forms, with or without
+#modification, are permitted provided that the following conditions are met:
+#
+#    * Redistributions of source code must retain the above copyright notice,
+#      this list of conditions and the following disclaimer.
+#    * Redistributions in binary form must reproduce the above copyright
+#      notice, this list of conditions and the following disclaimer in the
+#      documentation and/or other materials provided with the distribution.
+#    * The names of its contributors may not be used to endorse or promote
+#      products derived from this software without specific prior written
+#      permission.
+
+#THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+#AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+#IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+#ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+#LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+#CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+#SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+#INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+#CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+#ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF
+#THE POSSIBILITY OF SUCH DAMAGE.
+
+# Cache.py
+# Response cache used by TStat.
+
+# A ResponseCache maps a thermostat URL (e.g. '/tstat') to a CacheEntry
+# holding the decoded JSON and the monotonic time it was retrieved.
+#
+# TTLs:  Every location expires after ttl seconds unless it has its own TTL
+#        in ttls (see API.cacheTTLs, which seeds these per hardware API) or
+#        the caller passes a TTL for a particular APIEntry.
+# Size:  At most maxEntries locations are kept; the least recently used
+#        entry is dropped first.
+# Stale: With staleTTL > 0, an expired entry may still be served for up to
+#        staleTTL seconds past its TTL while the caller refreshes it in the
+#        background (stale-while-revalidate).
+#
+# stats() returns hit/miss/stale/eviction counters.
+#
+# SharedCache keeps the same data in a local SQLite database instead, so 
+# several processes (e.g. cron runs of TStatGcal.py, or worker processes) 
+# talking to the same thermostat share responses.  Before retrieving a URL, 
+# a process claims a short lease on it; other processes that miss the cache 
+# at the same time wait for the lease holder's result instead of sending 
+# their own request.
+
+import os
+import threading
+import time
+
+# For Python < 2.6, this json module:
+# http://pypi.python.org/pypi/python-json
+# will work.
+try:
+	from json import read as loads
+	from json import write as dumps
+except ImportError:
+	from json import loads
+	from json import dumps
+
+try:
+	from collections import OrderedDict
+except ImportError:
+	OrderedDict = None
+
+def _clock():
+	"""Returns a monotonic clock function, falling back to time.time."""
+	try:
+		return time.monotonic
+	except AttributeError:
+		pass
+	try:
+		import ctypes
+		import ctypes.util
+		import sys
+
+		class timespec(ctypes.Structure):
+			_fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+		librt = ctypes.CDLL(ctypes.util.find_library('rt') or ctypes.util.find_library('c'), use_errno=True)
+		clock_gettime = librt.clock_gettime
+		clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(timespec)]
+		# CLOCK_MONOTONIC is 1 on Linux, 4 on FreeBSD and 6 on Mac OS X
+		clockId = 1
+		if sys.platform.startswith('freebsd'):
+			clockId = 4
+		elif sys.platform == 'darwin':
+			clockId = 6
+		t = timespec()
+
+		def monotonic():
+			if clock_gettime(clockId, ctypes.pointer(t)) != 0:
+				return time.time()
+			return t.tv_sec + t.tv_nsec * 1e-9
+		monotonic()
+		return monotonic
+	except Exception:
+		return time.time
+
+monotonic = _clock()
+
+def _patched(data, path, value):
+	"""Returns a copy of data with value stored at path (keys separated by '/')."""
+	keys = path.split("/")
+	data = dict(data)
+	node = data
+	for key in keys[:-1]:
+		node[key] = dict(node.get(key) or {})
+		node = node[key]
+	node[keys[-1]] = value
+	return data
+
+class CacheEntry:
+	def __init__(self, location, data, created=None):
+		self.location = location
+		self.data = data
+		if created is None:
+			created = monotonic()
+		self.time = created
+
+	def age(self, now=None):
+		"""Returns the age of this entry in seconds."""
+		if now is None:
+			now = monotonic()
+		return now-self.time
+
+class ResponseCache:
+	def __init__(self, ttl=5, maxEntries=64, staleTTL=0, ttls=None):
+		self.ttl = ttl
+		self.maxEntries = maxEntries
+		self.staleTTL = staleTTL
+		if ttls is None:
+			ttls = {}
+		self.ttls = ttls
+		if OrderedDict is not None:
+			self._entries = OrderedDict()
+		else:
+			self._entries = {}
+		self._lock = threading.RLock()
+		self.hits = 0
+		self.misses = 0
+		self.stale = 0
+		self.expired = 0
+		self.evictions = 0
+
+	def setTTL(self, location, ttl):
+		"""Sets the TTL in seconds for one location."""
+		self.ttls[location] = ttl
+
+	def ttlFor(self, location, ttl=None):
+		"""Returns the TTL that applies to location (ttl overrides if given)."""
+		if ttl is not None:
+			return ttl
+		return self.ttls.get(location, self.ttl)
+
+	def _touch(self, location, entry):
+		"""Used internally to mark location as most recently used."""
+		if OrderedDict is not None:
+			del self._entries[location]
+			self._entries[location] = entry
+
+	def lookup(self, locations, ttl=None, count=True):
+		"""Finds the youngest usable entry among locations.
+
+		Returns (location, entry, fresh).  fresh is False when the entry is
+		past its TTL but within staleTTL, in which case the caller should
+		refresh it.  Returns (None, None, False) on a miss.  Each call counts
+		as a single hit, stale hit or miss; misses where some entry had 
+		outlived its TTL (and staleTTL) are also counted as expired.  With 
+		count False, nothing is counted and recency is left alone."""
+		now = monotonic()
+		self._lock.acquire()
+		try:
+			best = None
+			stale = None
+			expired = False
+			for location in locations:
+				entry = self._entries.get(location)
+				if entry is None:
+					continue
+				age = entry.age(now)
+				limit = self.ttlFor(location, ttl)
+				if age < limit:
+					if best is None or age < best[1].age(now):
+						best = (location, entry)
+				elif age < limit + self.staleTTL:
+					if stale is None or age < stale[1].age(now):
+						stale = (location, entry)
+				else:
+					expired = True
+			if count:
+				if best is not None:
+					self.hits = self.hits + 1
+					self._touch(*best)
+				elif stale is not None:
+					self.stale = self.stale + 1
+					self._touch(*stale)
+				else:
+					self.misses = self.misses + 1
+					if expired:
+						self.expired = self.expired + 1
+			if best is not None:
+				return (best[0], best[1], True)
+			if stale is not None:
+				return (stale[0], stale[1], False)
+			return (None, None, False)
+		finally:
+			self._lock.release()
+
+	def get(self, location, ttl=None):
+		"""Returns the fresh CacheEntry for location, or None."""
+		location, entry, fresh = self.lookup([location], ttl)
+		if fresh:
+			return entry
+		return None
+
+	def peek(self, location, ttl=None):
+		"""Like get(), but without counting a hit or miss (for planning)."""
+		location, entry, fresh = self.lookup([location], ttl, False)
+		if fresh:
+			return entry
+		return None
+
+	def put(self, location, data):
+		"""Stores data for location and returns the new CacheEntry."""
+		entry = CacheEntry(location, data)
+		self._lock.acquire()
+		try:
+			if self._entries.has_key(location):
+				del self._entries[location]
+			self._entries[location] = entry
+			while len(self._entries) > self.maxEntries:
+				if OrderedDict is not None:
+					self._entries.popitem(last=False)
+				else:
+					oldest = min(self._entries.values(), key=lambda e: e.time)
+					del self._entries[oldest.location]
+				self.evictions = self.evictions + 1
+		finally:
+			self._lock.release()
+		return entry
+
+	def patch(self, location, path, value):
+		"""Sets the value at path (e.g. 'time/day') in the cached data for location.
+
+		The entry keeps its original timestamp, so patching never makes 
+		data look fresher than it is.  Does nothing if location is not 
+		cached."""
+		self._lock.acquire()
+		try:
+			entry = self._entries.get(location)
+			if entry is None:
+				return
+			self._entries[location] = CacheEntry(location, _patched(entry.data, path, value), entry.time)
+		finally:
+			self._lock.release()
+
+	def invalidate(self, location=None):
+		"""Drops location from the cache, or everything if location is None."""
+		self._lock.acquire()
+		try:
+			if location is None:
+				self._entries.clear()
+			elif self._entries.has_key(location):
+				del self._entries[location]
+		finally:
+			self._lock.release()
+
+	def stats(self):
+		"""Returns a dict of cache counters."""
+		self._lock.acquire()
+		try:
+			return {
+				'hits': self.hits,
+				'misses': self.misses,
+				'stale': self.stale,
+				'expired': self.expired,
+				'evictions': self.evictions,
+				'entries': len(self._entries)
+			}
+		finally:
+			self._lock.release()
+
+	def claim(self, location):
+		"""Returns True if the caller should retrieve location itself.
+
+		Only SharedCache ever returns False (another process is already 
+		retrieving location)."""
+		return True
+
+	def release(self, location):
+		"""Gives up a claim made with claim()."""
+		pass
+
+	def wait(self, location, ttl=None):
+		"""Waits for another claimant to store location and returns the entry (or None)."""
+		return None
+
+	def has_key(self, location):
+		return self._entries.has_key(location)
+
+	def __contains__(self, location):
+		return self.has_key(location)
+
+	def __getitem__(self, location):
+		return self._entries[location]
+
+	def __len__(self):
+		return len(self._entries)
+
+class SharedCache(ResponseCache):
+	"""ResponseCache stored in SQLite and shared between processes.
+
+	Entries are stored per thermostat address with wall-clock timestamps.  
+	Size is bounded per address, evicting the oldest retrieval first."""
+
+	defaultPath = os.path.expanduser("~/.tstat/cache.sqlite")
+
+	def __init__(self, address, path=None, ttl=5, maxEntries=64, staleTTL=0, ttls=None, leaseTime=30):
+		ResponseCache.__init__(self, ttl, maxEntries, staleTTL, ttls)
+		import sqlite3
+		if path is None:
+			path = self.defaultPath
+		directory = os.path.dirname(path)
+		if directory and not os.path.isdir(directory):
+			os.makedirs(directory)
+		self.address = address
+		self.path = path
+		self.leaseTime = leaseTime
+		self._db = sqlite3.connect(path, timeout=30, isolation_level=None, check_same_thread=False)
+		try:
+			self._db.execute("PRAGMA journal_mode=WAL")
+		except sqlite3.DatabaseError:
+			pass
+		self._db.execute("CREATE TABLE IF NOT EXISTS responses (address TEXT, location TEXT, data TEXT, created REAL, PRIMARY KEY (address, location))")
+		self._db.execute("CREATE TABLE IF NOT EXISTS leases (address TEXT, location TEXT, owner TEXT, expires REAL, PRIMARY KEY (address, location))")
+		self._owner = "%s:%d:%d" % (os.uname()[1], os.getpid(), id(self))
+
+	def _entry(self, location, data, created):
+		"""Used internally to turn a stored row into a CacheEntry on the local monotonic clock."""
+		return CacheEntry(location, loads(data), monotonic() - (time.time() - created))
+
+	def lookup(self, locations, ttl=None, count=True):
+		now = time.time()
+		self._lock.acquire()
+		try:
+			marks = ",".join(["?"] * len(locations))
+			rows = self._db.execute("SELECT location, data, created FROM responses WHERE address = ? AND location IN (%s)" % marks, [self.address] + list(locations)).fetchall()
+			best = None
+			stale = None
+			expired = False
+			for location, data, created in rows:
+				age = now - created
+				limit = self.ttlFor(location, ttl)
+				if age < limit:
+					if best is None or created > best[2]:
+						best = (location, data, created)
+				elif age < limit + self.staleTTL:
+					if stale is None or created > stale[2]:
+						stale = (location, data, created)
+				else:
+					expired = True
+			if count:
+				if best is not None:
+					self.hits = self.hits + 1
+				elif stale is not None:
+					self.stale = self.stale + 1
+				else:
+					self.misses = self.misses + 1
+					if expired:
+						self.expired = self.expired + 1
+			if best is not None:
+				return (best[0], self._entry(*best), True)
+			if stale is not None:
+				return (stale[0], self._entry(*stale), False)
+			return (None, None, False)
+		finally:
+			self._lock.release()
+
+	def put(self, location, data):
+		entry = CacheEntry(location, data)
+		self._lock.acquire()
+		try:
+			self._db.execute("BEGIN IMMEDIATE")
+			try:
+				self._db.execute("INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?)", (self.address, location, dumps(data), time.time()))
+				cursor = self._db.execute("DELETE FROM responses WHERE address = ? AND location NOT IN (SELECT location FROM responses WHERE address = ? ORDER BY created DESC LIMIT ?)", (self.address, self.address, self.maxEntries))
+				if cursor.rowcount > 0:
+					self.evictions = self.evictions + cursor.rowcount
+				self._db.execute("COMMIT")
+			except:
+				self._db.execute("ROLLBACK")
+				raise
+		finally:
+			self._lock.release()
+		return entry
+
+	def patch(self, location, path, value):
+		self._lock.acquire()
+		try:
+			self._db.execute("BEGIN IMMEDIATE")
+			try:
+				row = self._db.execute("SELECT data FROM responses WHERE address = ? AND location = ?", (self.address, location)).fetchone()
+				if row is not None:
+					data = dumps(_patched(loads(row[0]), path, value))
+					self._db.execute("UPDATE responses SET data = ? WHERE address = ? AND location = ?", (data, self.address, location))
+				self._db.execute("COMMIT")
+			except:
+				self._db.execute("ROLLBACK")
+				raise
+		finally:
+			self._lock.release()
+
+	def invalidate(self, location=None):
+		self._lock.acquire()
+		try:
+			if location is None:
+				self._db.execute("DELETE FROM responses WHERE address = ?", (self.address,))
+			else:
+				self._db.execute("DELETE FROM responses WHERE address = ? AND location = ?", (self.address, location))
+		finally:
+			self._lock.release()
+
+	def claim(self, location):
+		now = time.time()
+		self._lock.acquire()
+		try:
+			self._db.execute("BEGIN IMMEDIATE")
+			try:
+				row = self._db.execute("SELECT owner, expires FROM leases WHERE address = ? AND location = ?", (self.address, location)).fetchone()
+				if row is not None and row[0] != self._owner and row[1] > now:
+					self._db.execute("COMMIT")
+					return False
+				self._db.execute("INSERT OR REPLACE INTO leases VALUES (?, ?, ?, ?)", (self.address, location, self._owner, now + self.leaseTime))
+				self._db.execute("COMMIT")
+				return True
+			except:
+				self._db.execute("ROLLBACK")
+				raise
+		finally:
+			self._lock.release()
+
+	def release(self, location):
+		self._lock.acquire()
+		try:
+			self._db.execute("DELETE FROM leases WHERE address = ? AND location = ? AND owner = ?", (self.address, location, self._owner))
+		finally:
+			self._lock.release()
+
+	def wait(self, location, ttl=None):
+		deadline = time.time() + self.leaseTime
+		delay = 0.05
+		while time.time() < deadline:
+			self._lock.acquire()
+			try:
+				row = self._db.execute("SELECT expires FROM leases WHERE address = ? AND location = ?", (self.address, location)).fetchone()
+			finally:
+				self._lock.release()
+			if row is None or row[0] <= time.time():
+				# The claimant finished (or gave up); use whatever it stored
+				return self.get(location, ttl)
+			time.sleep(delay)
+			delay = min(delay * 2, 1.0)
+		return None
+
+	def has_key(self, location):
+		self._lock.acquire()
+		try:
+			return self._db.execute("SELECT 1 FROM responses WHERE address = ? AND location = ?", (self.address, location)).fetchone() is not None
+		finally:
+			self._lock.release()
+
+	def __getitem__(self, location):
+		self._lock.acquire()
+		try:
+			row = self._db.execute("SELECT location, data, created FROM responses WHERE address = ? AND location = ?", (self.address, location)).fetchone()
+		finally:
+			self._lock.release()
+		if row is None:
+			raise KeyError(location)
+		return self._entry(*row)
+
+	def __len__(self):
+		self._lock.acquire()
+		try:
+			return self._db.execute("SELECT COUNT(*) FROM responses WHERE address = ?", (self.address,)).fetchone()[0]
+		finally:
+			self._lock.release()
+
+	def stats(self):
+		stats = {
+			'hits': self.hits,
+			'misses': self.misses,
+			'stale': self.stale,
+			'expired': self.expired,
+			'evictions': self.evictions
+		}
+		stats['entries'] = len(self)
+		return stats
@@ -0,0 +1,401 @@
+#!/usr/bin/env python
+
+#Copyright (c) 2011, Paul Jennings <pjennings-tstat@pjennings.net>
+#All rights reserved.
+
+#Redistribution and use in source and binary forms, with or without
+#modification, are permitted provided that the following conditions are met:
+#
+#    * Redistributions of source code must retain the above copyright notice,
+#      this list of conditions and the following disclaimer.
+#    * Redistributions in binary form must reproduce the above copyright
+#      notice, this list of conditions and the following disclaimer in the
+#      documentation and/or other materials provided with the distribution.
+#    * The names of its contributors may not be used to endorse or promote
+#      products derived from this software without specific prior written
+#      permission.
+
+#THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+#AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+#IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+#ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+#LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+#CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+#SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+#INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+#CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+#ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF
+#THE POSSIBILITY OF SUCH DAMAGE.
+
+# ICalendar.py
+# Local iCalendar (.ics) files as a calendar source for TStatGcal.
+
+# Usage:
+# source = ICSCalendar('/srv/schedules/building2.ics')
+# schedule = Schedule(schedulePath(source.name))
+# source.sync(schedule)        # Loads events near today into schedule
+#
+# for event in readEvents(open('building2.ics', 'rb')):
+#     print event['SUMMARY'][0], expand(event, start, end)
+#
+# The file is read one line at a time; only the VEVENT properties needed
+# to place an event in time (UID, SUMMARY, DTSTART, RRULE, RDATE, EXDATE,
+# RECURRENCE-ID and STATUS) are kept, and everything else is skipped
+# without being decoded.  Recurring events are expanded only inside the
+# requested window: rules without a COUNT jump straight to the window
+# instead of walking from their first occurrence.  The results go into a
+# Schedule, which indexes them by start time.  sync() only rereads the
+# file when it (or the date) has changed.
+#
+# Supported recurrence rules: FREQ=DAILY/WEEKLY/MONTHLY/YEARLY with
+# INTERVAL, COUNT, UNTIL, BYDAY (plain weekdays, for DAILY and WEEKLY) and
+# BYMONTHDAY (MONTHLY).  Events with other rules are used for their first
+# occurrence only.  Times with a TZID are taken as local time.
+
+import calendar
+import datetime
+import os
+import time
+
+DAY = 24 * 60 * 60
+
+WEEKDAYS = {'MO': 0, 'TU': 1, 'WE': 2, 'TH': 3, 'FR': 4, 'SA': 5, 'SU': 6}
+
+# VEVENT properties that readEvents keeps
+PROPERTIES = frozenset(['UID', 'SUMMARY', 'DTSTART', 'RRULE', 'RDATE', 'EXDATE', 'RECURRENCE-ID', 'STATUS'])
+
+def _unfold(f):
+	"""Used internally to yield the logical (unfolded) lines of an iCalendar file."""
+	pending = None
+	folded = None
+	for line in f:
+		if line[:1] in (' ', '\t'):
+			if pending is not None:
+				if folded is None:
+					folded = [pending]
+				folded.append(line[1:].rstrip('\r\n'))
+			continue
+		if folded is not None:
+			pending = ''.join(folded)
+			folded = None
+		if pending is not None:
+			yield pending
+		pending = line.rstrip('\r\n')
+	if folded is not None:
+		pending = ''.join(folded)
+	if pending is not None:
+		yield pending
+
+def _unescape(text):
+	"""Used internally to decode an iCalendar TEXT value."""
+	if '\\' not in text:
+		return text
+	return text.replace('\\n', '\n').replace('\\N', '\n').replace('\\,', ',').replace('\\;', ';').replace('\\\\', '\\')
+
+def readEvents(f):
+	"""Yields each VEVENT in the open file f as a dict of the PROPERTIES it has.
+
+	Values are (value, params) tuples, where params is a dict of the
+	property's parameters; RDATE and EXDATE are lists of them."""
+	event = None
+	nested = 0
+	for line in _unfold(f):
+		if event is None:
+			if line == 'BEGIN:VEVENT':
+				event = {}
+			continue
+		if line.startswith('BEGIN:'):
+			nested = nested + 1
+			continue
+		if line.startswith('END:'):
+			if nested:
+				nested = nested - 1
+			elif line == 'END:VEVENT':
+				yield event
+				event = None
+			continue
+		if nested:
+			continue
+		# Look at the name before taking the rest of the line apart
+		colon = line.find(':')
+		if colon < 0:
+			continue
+		semicolon = line.find(';', 0, colon)
+		if semicolon < 0:
+			name = line[:colon].upper()
+		else:
+			name = line[:semicolon].upper()
+		if name not in PROPERTIES:
+			continue
+		value = line[colon + 1:]
+		params = {}
+		if semicolon >= 0:
+			for part in line[semicolon + 1:colon].split(';'):
+				param, sep, paramValue = part.partition('=')
+				params[param.upper()] = paramValue.strip('"')
+		if name in ('RDATE', 'EXDATE'):
+			event.setdefault(name, []).append((value, params))
+		else:
+			event[name] = (value, params)
+
+def parseDate(value, params=None):
+	"""Returns an iCalendar DATE or DATE-TIME as (datetime, utc).
+
+	The datetime is naive; utc says whether it is in UTC (rather than
+	local time)."""
+	value = value.strip()
+	if len(value) == 8 or (params and params.get('VALUE') == 'DATE'):
+		return (datetime.datetime(int(value[0:4]), int(value[4:6]), int(value[6:8])), False)
+	if len(value) < 15 or value[8] != 'T':
+		raise ValueError("Unrecognized date '%s'" % value)
+	dt = datetime.datetime(int(value[0:4]), int(value[4:6]), int(value[6:8]), int(value[9:11]), int(value[11:13]), int(value[13:15]))
+	return (dt, value.endswith('Z'))
+
+def toEpoch(dt, utc):
+	"""Returns a datetime from parseDate as seconds since the epoch."""
+	if utc:
+		return calendar.timegm(dt.timetuple())
+	return time.mktime(dt.timetuple())
+
+def _fromEpoch(t, utc):
+	"""Used internally to turn seconds since the epoch back into a naive datetime."""
+	if utc:
+		return datetime.datetime.utcfromtimestamp(t)
+	return datetime.datetime.fromtimestamp(t)
+
+def _parseRule(text):
+	"""Used internally to split an RRULE value into a dict."""
+	rule = {}
+	for part in text.split(';'):
+		name, sep, value = part.partition('=')
+		if sep:
+			rule[name.upper()] = value.upper()
+	return rule
+
+def _addMonths(dt, months):
+	"""Used internally to move dt to the first of the month months later."""
+	month = dt.month - 1 + months
+	return dt.replace(year=dt.year + month // 12, month=month % 12 + 1, day=1)
+
+def _candidates(rule, dtstart, last):
+	"""Used internally to plan the expansion of rule.
+
+	Returns (anchor, step, generate), where generate(first) yields 
+	possible occurrences in time order from the first'th period (of step 
+	days or months from anchor) up to the period containing last.  
+	Candidates may fall before dtstart; the caller drops those.  Returns 
+	None for rules that are not supported."""
+	freq = rule.get('FREQ')
+	interval = max(1, int(rule.get('INTERVAL', '1')))
+	at = datetime.timedelta(hours=dtstart.hour, minutes=dtstart.minute, seconds=dtstart.second)
+	day0 = datetime.datetime(dtstart.year, dtstart.month, dtstart.day)
+	byday = None
+	if rule.has_key('BYDAY'):
+		byday = []
+		for day in rule['BYDAY'].split(','):
+			if not WEEKDAYS.has_key(day):
+				return None
+			byday.append(WEEKDAYS[day])
+		byday.sort()
+
+	if freq in ('DAILY', 'WEEKLY'):
+		if freq == 'DAILY':
+			anchor = day0
+			step = interval
+			offsets = [0]
+		else:
+			# Weeks start on Monday (WKST is ignored)
+			anchor = day0 - datetime.timedelta(days=day0.weekday())
+			step = 7 * interval
+			offsets = byday or [day0.weekday()]
+		def generate(first):
+			n = first
+			while True:
+				period = anchor + datetime.timedelta(days=n * step)
+				if period > last:
+					return
+				for offset in offsets:
+					day = period + datetime.timedelta(days=offset)
+					if freq == 'DAILY' and byday is not None and day.weekday() not in byday:
+						continue
+					yield day + at
+				n = n + 1
+		return (anchor, step, generate)
+
+	if freq in ('MONTHLY', 'YEARLY'):
+		if byday is not None:
+			return None
+		if freq == 'MONTHLY':
+			step = interval
+			days = [int(d) for d in rule.get('BYMONTHDAY', str(day0.day)).split(',')]
+		else:
+			step = 12 * interval
+			days = [day0.day]
+		anchor = day0.replace(day=1)
+		def generate(first):
+			n = first
+			while True:
+				period = _addMonths(anchor, n * step)
+				if period > last:
+					return
+				length = calendar.monthrange(period.year, period.month)[1]
+				for d in sorted([d < 0 and length + d + 1 or d for d in days]):
+					if 1 <= d <= length:
+						yield period.replace(day=d) + at
+				n = n + 1
+		return (anchor, step, generate)
+	return None
+
+def expand(event, start, end):
+	"""Returns the start times (seconds since the epoch) of event that fall in [start, end).
+
+	Recurring events are only expanded inside the window.  EXDATEs are
+	left out; RDATEs are added."""
+	dtstart, utc = parseDate(*event['DTSTART'])
+	starts = []
+	excluded = set()
+	for value, params in event.get('EXDATE', []):
+		for part in value.split(','):
+			excluded.add(toEpoch(*parseDate(part, params)))
+
+	rule = None
+	if event.has_key('RRULE') and not event.has_key('RECURRENCE-ID'):
+		rule = _parseRule(event['RRULE'][0])
+	if rule is None:
+		t = toEpoch(dtstart, utc)
+		if start <= t < end:
+			starts.append(t)
+	else:
+		count = None
+		if rule.has_key('COUNT'):
+			count = int(rule['COUNT'])
+		until = None
+		if rule.has_key('UNTIL'):
+			untilDT, untilUTC = parseDate(rule['UNTIL'])
+			until = _fromEpoch(toEpoch(untilDT, untilUTC), utc)
+		# A day of margin either side covers DST and UTC offsets
+		windowStart = _fromEpoch(start, utc) - datetime.timedelta(days=1)
+		windowEnd = _fromEpoch(end, utc) + datetime.timedelta(days=1)
+		last = windowEnd
+		if until is not None and until < last:
+			last = until
+
+		candidates = _candidates(rule, dtstart, last)
+		if candidates is None:
+			t = toEpoch(dtstart, utc)
+			if start <= t < end:
+				starts.append(t)
+		else:
+			anchor, step, generate = candidates
+			first = 0
+			if count is None and windowStart > anchor:
+				# Skip whole periods before the window without generating them
+				if rule['FREQ'] in ('DAILY', 'WEEKLY'):
+					first = max(0, (windowStart - anchor).days // step - 1)
+				else:
+					months = (windowStart.year - anchor.year) * 12 + windowStart.month - anchor.month
+					first = max(0, months // step - 1)
+			seen = 0
+			for dt in generate(first):
+				if dt < dtstart:
+					continue
+				if until is not None and dt > until:
+					break
+				seen = seen + 1
+				if count is not None and seen > count:
+					break
+				if dt >= windowEnd:
+					break
+				if dt < windowStart:
+					continue
+				t = toEpoch(dt, utc)
+				if start <= t < end:
+					starts.append(t)
+
+	for value, params in event.get('RDATE', []):
+		if params.get('VALUE') == 'PERIOD':
+			continue
+		for part in value.split(','):
+			t = toEpoch(*parseDate(part, params))
+			if start <= t < end:
+				starts.append(t)
+	return sorted([t for t in set(starts) if t not in excluded])
+
+def loadEvents(f, start, end):
+	"""Reads the open iCalendar file f and returns {uid: (title, starts)} for events starting in [start, end).
+
+	Cancelled events are left out.  Modified instances of a recurring
+	event (with a RECURRENCE-ID) replace the instance they override."""
+	events = {}
+	overridden = {}
+	# Most one-off events are far from the window, which shows in the text of their date
+	first = time.strftime('%Y%m%d', time.localtime(start - DAY))
+	last = time.strftime('%Y%m%d', time.localtime(end + DAY))
+	for event in readEvents(f):
+		if not event.has_key('DTSTART'):
+			continue
+		if not event.has_key('RRULE') and not event.has_key('RDATE') and not event.has_key('RECURRENCE-ID'):
+			day = event['DTSTART'][0].strip()[:8]
+			if day < first or day > last:
+				continue
+		uid = event.get('UID', ('', {}))[0]
+		title = _unescape(event.get('SUMMARY', ('', {}))[0]).strip()
+		cancelled = event.get('STATUS', ('', {}))[0].upper() == 'CANCELLED'
+		try:
+			if event.has_key('RECURRENCE-ID'):
+				overridden.setdefault(uid, set()).add(toEpoch(*parseDate(*event['RECURRENCE-ID'])))
+				uid = "%s/%s" % (uid, event['RECURRENCE-ID'][0])
+			if cancelled:
+				continue
+			starts = expand(event, start, end)
+		except ValueError:
+			continue
+		if starts:
+			events[uid] = (title, starts)
+	for uid, instances in overridden.items():
+		if events.has_key(uid):
+			title, starts = events[uid]
+			starts = [t for t in starts if t not in instances]
+			if starts:
+				events[uid] = (title, starts)
+			else:
+				del events[uid]
+	return events
+
+class ICSCalendar:
+	"""Calendar source reading a local iCalendar file."""
+
+	def __init__(self, path, days=8):
+		self.path = path
+		self.days = days
+		self.name = os.path.splitext(os.path.basename(path))[0]
+
+	def sync(self, schedule):
+		"""Loads events from a week ago to days days ahead into schedule, if the file or date changed.
+
+		Returns False if the file does not exist."""
+		try:
+			st = os.stat(self.path)
+		except OSError:
+			return False
+		today = time.mktime(datetime.date.today().timetuple())
+		# The week before today is read so the command in effect is known
+		start = today - 7 * DAY
+		end = today + self.days * DAY
+		version = [os.path.abspath(self.path), st.st_mtime, st.st_size, start, end]
+		if schedule.state.get('ics') == version:
+			return True
+
+		f = open(self.path, 'rb')
+		try:
+			events = loadEvents(f, start, end)
+		finally:
+			f.close()
+		schedule.clear()
+		for uid, (title, starts) in events.items():
+			schedule.update(uid, title, starts)
+		schedule.state['ics'] = version
+		schedule.state['windowEnd'] = end
+		schedule.save()
+		print "Loaded %d events from %s" % (len(events), self.path)
+		return True
@@ -0,0 +1,260 @@
+#!/usr/bin/env python
+
+#Copyright (c) 2011, Paul Jennings <pjennings-tstat@pjennings.net>
+#All rights reserved.
+
+#Redistribution and use in source and binary forms, with or without
+#modification, are permitted provided that the following conditions are met:
+#
+#    * Redistributions of source code must retain the above copyright notice,
+#      this list of conditions and the following disclaimer.
+#    * Redistributions in binary form must reproduce the above copyright
+#      notice, this list of conditions and the following disclaimer in the
+#      documentation and/or other materials provided with the distribution.
+#    * The names of its contributors may not be used to endorse or promote
+#      products derived from this software without specific prior written
+#      permission.
+
+#THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+#AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+#IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+#ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+#LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+#CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+#SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+#INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+#CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+#ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF
+#THE POSSIBILITY OF SUCH DAMAGE.
+
+# Metrics.py
+# Counters and latency histograms for thermostat traffic.
+
+# Usage:
+# m = Metrics()
+# t = TStat('10.0.0.5', metrics=m)   # Or metrics=True for a private Metrics
+# ...
+# m.snapshot()                 # {'tstat_requests_total': {labels: count}, ...}
+# m.snapshot(without=('address',))   # Summed over every device
+# print prometheus(m)          # Prometheus text exposition format
+# s = MetricsServer(m, 9108)   # Serves prometheus(m) at http://127.0.0.1:9108/
+#
+# Labels are tuples of (name, value) pairs, e.g.
+#   (('address', '10.0.0.5'), ('method', 'GET'), ('location', '/tstat'))
+# Histogram values in a snapshot are dicts with 'buckets' (a list of
+# (upper bound, cumulative count)), 'sum' and 'count'.
+#
+# Several TStat instances (e.g. every device in a TStatFleet) may share one
+# Metrics.  TStat only records anything when it was given a Metrics, so the
+# cost when metrics are disabled is one attribute test per request.  Cache
+# counters are not recorded per lookup; they are read from each TStat's
+# cache when a snapshot is taken.
+
+import bisect
+import threading
+import weakref
+
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+# name: (type, help)
+METRICS = {
+	'tstat_requests_total': ('counter', 'HTTP requests by response status ("error" if there was no answer).'),
+	'tstat_request_seconds': ('histogram', 'Time taken by each HTTP request.'),
+	'tstat_retries_total': ('counter', 'Requests retried under the retry policy.'),
+	'tstat_response_bytes_total': ('counter', 'Bytes of response bodies read.'),
+	'tstat_breaker_rejections_total': ('counter', 'Calls skipped because the circuit breaker was open.'),
+	'tstat_cache_hits_total': ('counter', 'Cache lookups answered with fresh data.'),
+	'tstat_cache_stale_total': ('counter', 'Cache lookups answered with stale data.'),
+	'tstat_cache_misses_total': ('counter', 'Cache lookups that found nothing usable.'),
+	'tstat_cache_expired_total': ('counter', 'Cache misses caused by an entry past its TTL.'),
+	'tstat_cache_evictions_total': ('counter', 'Cache entries dropped to make room.'),
+	'tstat_cache_entries': ('gauge', 'Responses currently cached.')
+}
+
+class Histogram:
+	def __init__(self, buckets=BUCKETS):
+		self.buckets = buckets
+		self.counts = [0] * (len(buckets) + 1)
+		self.sum = 0.0
+		self.count = 0
+
+	def observe(self, value):
+		self.counts[bisect.bisect_left(self.buckets, value)] += 1
+		self.sum = self.sum + value
+		self.count = self.count + 1
+
+	def snapshot(self):
+		"""Returns the histogram as a dict with cumulative bucket counts."""
+		buckets = []
+		total = 0
+		for bound, n in zip(self.buckets, self.counts):
+			total = total + n
+			buckets.append((bound, total))
+		return {'buckets': buckets, 'sum': self.sum, 'count': self.count}
+
+def _add(a, b):
+	"""Used internally to sum two snapshot values (numbers or histogram dicts)."""
+	if a is None:
+		return b
+	if not isinstance(a, dict):
+		return a + b
+	return {
+		'buckets': [(bound, x + y) for (bound, x), (other, y) in zip(a['buckets'], b['buckets'])],
+		'sum': a['sum'] + b['sum'],
+		'count': a['count'] + b['count']
+	}
+
+class Metrics:
+	def __init__(self, buckets=BUCKETS):
+		self.buckets = buckets
+		self._lock = threading.Lock()
+		self._counters = {}
+		self._histograms = {}
+		self._collectors = []
+
+	def inc(self, name, labels, amount=1):
+		"""Adds amount to the counter name{labels}."""
+		key = (name, labels)
+		self._lock.acquire()
+		try:
+			self._counters[key] = self._counters.get(key, 0) + amount
+		finally:
+			self._lock.release()
+
+	def observe(self, name, labels, value):
+		"""Records value in the histogram name{labels}."""
+		key = (name, labels)
+		self._lock.acquire()
+		try:
+			histogram = self._histograms.get(key)
+			if histogram is None:
+				histogram = self._histograms[key] = Histogram(self.buckets)
+			histogram.observe(value)
+		finally:
+			self._lock.release()
+
+	def addCollector(self, source):
+		"""Registers source, whose collectMetrics() returns (name, labels, value) samples.
+
+		Only a weak reference is kept, so sources that go away drop out."""
+		self._lock.acquire()
+		try:
+			self._collectors.append(weakref.ref(source))
+		finally:
+			self._lock.release()
+
+	def _collect(self):
+		"""Used internally to read samples from live collectors."""
+		self._lock.acquire()
+		try:
+			self._collectors = [ref for ref in self._collectors if ref() is not None]
+			sources = [ref() for ref in self._collectors]
+		finally:
+			self._lock.release()
+		samples = []
+		for source in sources:
+			if source is not None:
+				samples.extend(source.collectMetrics())
+		return samples
+
+	def snapshot(self, without=()):
+		"""Returns a dict of metric name -> {labels: value}.
+
+		Labels named in without are dropped and the values they separated
+		are summed, e.g. without=('address',) totals a fleet."""
+		self._lock.acquire()
+		try:
+			samples = [(name, labels, value) for (name, labels), value in self._counters.items()]
+			samples.extend([(name, labels, h.snapshot()) for (name, labels), h in self._histograms.items()])
+		finally:
+			self._lock.release()
+		samples.extend(self._collect())
+
+		result = {}
+		for name, labels, value in samples:
+			if without:
+				labels = tuple([label for label in labels if label[0] not in without])
+			values = result.setdefault(name, {})
+			values[labels] = _add(values.get(labels), value)
+		return result
+
+	def reset(self):
+		"""Clears recorded counters and histograms."""
+		self._lock.acquire()
+		try:
+			self._counters = {}
+			self._histograms = {}
+		finally:
+			self._lock.release()
+
+def _escape(value):
+	return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _labels(labels, extra=()):
+	"""Used internally to format labels as {a="1",b="2"}."""
+	labels = list(labels) + list(extra)
+	if not labels:
+		return ""
+	return "{%s}" % ",".join(['%s="%s"' % (name, _escape(value)) for name, value in labels])
+
+def _number(value):
+	if value == float('inf'):
+		return "+Inf"
+	return repr(value)
+
+def prometheus(metrics, without=()):
+	"""Returns a snapshot of metrics in the Prometheus text exposition format."""
+	snapshot = metrics.snapshot(without)
+	lines = []
+	names = snapshot.keys()
+	names.sort()
+	for name in names:
+		kind, help = METRICS.get(name, ('untyped', name))
+		lines.append("# HELP %s %s" % (name, help))
+		lines.append("# TYPE %s %s" % (name, kind))
+		values = snapshot[name].items()
+		values.sort()
+		for labels, value in values:
+			if kind != 'histogram':
+				lines.append("%s%s %s" % (name, _labels(labels), _number(value)))
+				continue
+			for bound, count in value['buckets']:
+				lines.append("%s_bucket%s %d" % (name, _labels(labels, [('le', _number(bound))]), count))
+			lines.append("%s_bucket%s %d" % (name, _labels(labels, [('le', '+Inf')]), value['count']))
+			lines.append("%s_sum%s %s" % (name, _labels(labels), _number(value['sum'])))
+			lines.append("%s_count%s %d" % (name, _labels(labels), value['count']))
+	return "\n".join(lines) + "\n"
+
+class MetricsServer:
+	"""Serves prometheus(metrics) over HTTP from a background thread."""
+
+	def __init__(self, metrics, port=9108, address='127.0.0.1', without=()):
+		import BaseHTTPServer
+		import SocketServer
+
+		class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+			def do_GET(handler):
+				body = prometheus(metrics, without)
+				handler.send_response(200)
+				handler.send_header("Content-Type", "text/plain; version=0.0.4")
+				handler.send_header("Content-Length", str(len(body)))
+				handler.end_headers()
+				handler.wfile.write(body)
+
+			def log_message(handler, *args):
+				pass
+
+		class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+			daemon_threads = True
+			allow_reuse_address = True
+
+		self.server = Server((address, port), Handler)
+		self.port = self.server.server_address[1]
+		self._thread = threading.Thread(target=self.server.serve_forever, name="MetricsServer")
+		self._thread.setDaemon(True)
+		self._thread.start()
+
+	def close(self):
+		self.server.shutdown()
+		self.server.server_close()
+		self._thread.join()
@@ -0,0 +1,331 @@
+#!/usr/bin/env python
+
+#Copyright (c) 2011, Paul Jennings <pjennings-tstat@pjennings.net>
+#All rights reserved.
+
+#Redistribution and use in source and binary forms, with or without
+#modification, are permitted provided that the following conditions are met:
+#
+#    * Redistributions of source code must retain the above copyright notice,
+#      this list of conditions and the following disclaimer.
+#    * Redistributions in binary form must reproduce the above copyright
+#      notice, this list of conditions and the following disclaimer in the
+#      documentation and/or other materials provided with the distribution.
+#    * The names of its contributors may not be used to endorse or promote
+#      products derived from this software without specific prior written
+#      permission.
+
+#THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+#AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+#IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+#ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+#LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+#CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+#SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+#INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+#CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+#ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF
+#THE POSSIBILITY OF SUCH DAMAGE.
+
+# Recorder.py
+# Compact time-series logging of thermostat readings.
+
+# Usage:
+# r = Recorder('/var/lib/tstat', [TStat('10.0.0.5'), TStat('10.0.0.6')])
+# r.run(interval=60)           # Sample every device once a minute, forever
+#
+# A TStatFleet may be passed instead of a list, to sample devices in parallel.
+#
+# s = SeriesReader('/var/lib/tstat', '10.0.0.5')
+# data = s.range(start, end)   # {'time': array('d', ...), 'temp': ...}
+#
+# Each device gets its own directory holding one file per column (time,
+# temp, t_heat, t_cool, tstate, fstate by default).  Every sample appends one
+# fixed-width binary value to each column file, so files only ever grow and
+# nothing needs to be parsed to read them back.  SeriesReader memory-maps the
+# columns and binary searches the (non-decreasing) time column, so a range
+# query costs O(log n) plus a copy of the matching slice.
+#
+# Missing readings are stored as NaN for float columns and -1 for integer
+# columns.  A meta.json file in each directory records the column types and
+# byte order.
+
+import array
+import bisect
+import mmap
+import os
+import struct
+import sys
+import time
+
+# For Python < 2.6, this json module:
+# http://pypi.python.org/pypi/python-json
+# will work.
+try:
+	from json import read as loads
+	from json import write as dumps
+except ImportError:
+	from json import loads
+	from json import dumps
+
+# (API key, array typecode) for each recorded column after the timestamp
+FIELDS = [
+	('temp', 'f'),
+	('t_heat', 'f'),
+	('t_cool', 'f'),
+	('tstate', 'b'),
+	('fstate', 'b')
+]
+
+TIME_COLUMN = ('time', 'd')
+
+NAN = float('nan')
+
+def _directory(root, address):
+	"""Returns the directory used for address under root."""
+	return os.path.join(root, address.replace(':', '_').replace('/', '_'))
+
+def _missing(typecode):
+	if typecode in 'fd':
+		return NAN
+	return -1
+
+def _wholeSamples(path, columns):
+	"""Used internally to count the samples written completely to every column file."""
+	lengths = []
+	for name, typecode in columns:
+		size = os.path.getsize(os.path.join(path, name))
+		lengths.append(size // array.array(typecode).itemsize)
+	return min(lengths)
+
+class SeriesWriter:
+	"""Appends samples for one device to its column files."""
+
+	def __init__(self, root, address, fields=None):
+		if fields is None:
+			fields = FIELDS
+		self.path = _directory(root, address)
+		self.columns = [TIME_COLUMN] + list(fields)
+		if not os.path.isdir(self.path):
+			os.makedirs(self.path)
+
+		metaPath = os.path.join(self.path, 'meta.json')
+		meta = {'address': address, 'columns': self.columns, 'byteorder': sys.byteorder}
+		if os.path.exists(metaPath):
+			f = open(metaPath)
+			try:
+				existing = loads(f.read())
+			finally:
+				f.close()
+			if [tuple(c) for c in existing['columns']] != self.columns or existing['byteorder'] != sys.byteorder:
+				raise ValueError("%s was recorded with different columns" % self.path)
+		else:
+			f = open(metaPath, 'w')
+			try:
+				f.write(dumps(meta))
+			finally:
+				f.close()
+
+		self._files = []
+		for name, typecode in self.columns:
+			self._files.append(open(os.path.join(self.path, name), 'ab'))
+
+		# Columns may disagree after a crash, or end part way through a 
+		# value; drop anything past the last whole sample
+		length = _wholeSamples(self.path, self.columns)
+		for f, (name, typecode) in zip(self._files, self.columns):
+			size = length * array.array(typecode).itemsize
+			if os.path.getsize(f.name) != size:
+				f.truncate(size)
+		self.length = length
+		self._last = None
+		if length:
+			self._last = SeriesReader(root, address).time[length - 1]
+
+	def append(self, values, timestamp=None):
+		"""Appends one sample; values maps column names to numbers (or None)."""
+		if timestamp is None:
+			timestamp = time.time()
+		# Keep the time column sorted even if the clock steps backwards
+		if self._last is not None and timestamp < self._last:
+			timestamp = self._last
+		self._last = timestamp
+
+		array.array('d', [timestamp]).tofile(self._files[0])
+		for f, (name, typecode) in zip(self._files[1:], self.columns[1:]):
+			value = values.get(name)
+			try:
+				column = array.array(typecode, [value])
+			except (TypeError, OverflowError):
+				column = array.array(typecode, [_missing(typecode)])
+			column.tofile(f)
+		for f in self._files:
+			f.flush()
+		self.length = self.length + 1
+
+	def close(self):
+		for f in self._files:
+			f.close()
+		self._files = []
+
+class _Column:
+	"""Read-only sequence view of one memory-mapped column file."""
+
+	def __init__(self, path, typecode, length, swap):
+		self.typecode = typecode
+		self.size = array.array(typecode).itemsize
+		self.length = length
+		self.swap = swap
+		order = "="
+		if swap:
+			order = {'little': '>', 'big': '<'}[sys.byteorder]
+		self._format = order + typecode
+		self._map = None
+		if length:
+			f = open(path, 'rb')
+			try:
+				self._map = mmap.mmap(f.fileno(), length * self.size, access=mmap.ACCESS_READ)
+			finally:
+				f.close()
+
+	def __len__(self):
+		return self.length
+
+	def __getitem__(self, i):
+		if i < 0:
+			i = i + self.length
+		if i < 0 or i >= self.length:
+			raise IndexError(i)
+		return struct.unpack_from(self._format, self._map, i * self.size)[0]
+
+	def slice(self, start, end):
+		"""Returns values [start:end] as an array."""
+		values = array.array(self.typecode)
+		if end > start:
+			values.fromstring(self._map[start * self.size:end * self.size])
+			if self.swap:
+				values.byteswap()
+		return values
+
+	def close(self):
+		if self._map is not None:
+			self._map.close()
+			self._map = None
+
+class SeriesReader:
+	"""Memory-mapped, read-only access to one device's recorded samples."""
+
+	def __init__(self, root, address):
+		self.path = _directory(root, address)
+		f = open(os.path.join(self.path, 'meta.json'))
+		try:
+			meta = loads(f.read())
+		finally:
+			f.close()
+		self.columnTypes = [(str(name), str(typecode)) for name, typecode in meta['columns']]
+		swap = meta['byteorder'] != sys.byteorder
+
+		# Only whole samples (present in every column) are visible
+		self.length = _wholeSamples(self.path, self.columnTypes)
+
+		self.columns = {}
+		for name, typecode in self.columnTypes:
+			self.columns[name] = _Column(os.path.join(self.path, name), typecode, self.length, swap)
+		self.time = self.columns['time']
+
+	def __len__(self):
+		return self.length
+
+	def indexes(self, start=None, end=None):
+		"""Returns the (first, last+1) sample indexes with start <= time < end."""
+		first = 0
+		last = self.length
+		if start is not None:
+			first = bisect.bisect_left(self.time, start)
+		if end is not None:
+			last = bisect.bisect_left(self.time, end)
+		return (first, max(first, last))
+
+	def range(self, start=None, end=None, columns=None):
+		"""Returns a dict of column name -> array for samples with start <= time < end."""
+		first, last = self.indexes(start, end)
+		if columns is None:
+			columns = [name for name, typecode in self.columnTypes]
+		result = {}
+		for name in columns:
+			result[name] = self.columns[name].slice(first, last)
+		return result
+
+	def close(self):
+		for column in self.columns.values():
+			column.close()
+
+class Recorder:
+	"""Polls thermostats and appends their readings to per-device series."""
+
+	def __init__(self, root, tstats, fields=None):
+		if fields is None:
+			fields = FIELDS
+		self.root = root
+		self.fields = list(fields)
+		self.keys = [name for name, typecode in self.fields]
+		self.fleet = None
+		if hasattr(tstats, 'imap'):
+			self.fleet = tstats
+			addresses = self.fleet.addresses
+			self.tstats = []
+		else:
+			self.tstats = list(tstats)
+			addresses = [tstat.address for tstat in self.tstats]
+		self.writers = {}
+		for address in addresses:
+			self.writers[address] = SeriesWriter(root, address, self.fields)
+
+	def sample(self, tstat, timestamp=None):
+		"""Reads and records one sample from tstat."""
+		values = tstat.getMany(self.keys, raw=True)
+		self.writers[tstat.address].append(values, timestamp)
+		return values
+
+	def sampleAll(self):
+		"""Reads and records one sample from every device."""
+		if self.fleet is None:
+			for tstat in self.tstats:
+				self.sample(tstat)
+			return
+		keys = self.keys
+		for address, values, error in self.fleet.imap(lambda t: t.getMany(keys, raw=True)):
+			if error is None:
+				self.writers[address].append(values)
+
+	def run(self, interval=60, count=None):
+		"""Samples every device each interval seconds (count times, or forever)."""
+		next = time.time()
+		n = 0
+		while count is None or n < count:
+			self.sampleAll()
+			n = n + 1
+			next = next + interval
+			delay = next - time.time()
+			if delay > 0 and (count is None or n < count):
+				time.sleep(delay)
+			elif delay <= 0:
+				# Fell behind; don't try to catch up with a burst of samples
+				next = time.time()
+
+	def close(self):
+		for writer in self.writers.values():
+			writer.close()
+
+def main():
+	from TStat import TStat
+	root = sys.argv[1]
+	interval = float(sys.argv[2])
+	r = Recorder(root, [TStat(address) for address in sys.argv[3:]])
+	try:
+		r.run(interval)
+	finally:
+		r.close()
+
+if __name__ == '__main__':
+	main()
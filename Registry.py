@@ -0,0 +1,159 @@
+#!/usr/bin/env python
+
+#Copyright (c) 2011, Paul Jennings <pjennings-tstat@pjennings.net>
+#All rights reserved.
+
+#Redistribution and use in source and binary forms, with or without
+#modification, are permitted provided that the following conditions are met:
+#
+#    * Redistributions of source code must retain the above copyright notice,
+#      this list of conditions and the following disclaimer.
+#    * Redistributions in binary form must reproduce the above copyright
+#      notice, this list of conditions and the following disclaimer in the
+#      documentation and/or other materials provided with the distribution.
+#    * The names of its contributors may not be used to endorse or promote
+#      products derived from this software without specific prior written
+#      permission.
+
+#THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+#AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+#IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+#ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+#LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+#CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+#SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+#INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+#CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+#ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF
+#THE POSSIBILITY OF SUCH DAMAGE.
+
+# Registry.py
+# Small on-disk record of known thermostats.
+
+# The registry is a JSON file (~/.tstat/registry.json by default) mapping a
+# thermostat address to what we have learned about it, e.g.:
+#   {"10.0.0.5": {"model": "CT50 V1.09", "updated": 1318888888.0}}
+# TStat uses it to skip model detection on startup.  Writes go to a
+# temporary file that is renamed into place, so concurrent readers never see
+# a partial file; concurrent writers merge with what is on disk.
+
+import os
+import tempfile
+import threading
+import time
+
+# For Python < 2.6, this json module:
+# http://pypi.python.org/pypi/python-json
+# will work.
+try:
+	from json import read as loads
+	from json import write as dumps
+except ImportError:
+	from json import loads
+	from json import dumps
+
+DEFAULT_PATH = os.path.expanduser("~/.tstat/registry.json")
+
+class Registry:
+	def __init__(self, path=None):
+		if path is None:
+			path = DEFAULT_PATH
+		self.path = path
+		self._lock = threading.Lock()
+		self._devices = None
+		self._mtime = None
+
+	def _read(self):
+		"""Used internally to (re)load the file if it changed on disk."""
+		try:
+			mtime = os.stat(self.path).st_mtime
+		except OSError:
+			if self._devices is None:
+				self._devices = {}
+			return self._devices
+		if self._devices is None or mtime != self._mtime:
+			try:
+				f = open(self.path)
+				try:
+					self._devices = loads(f.read())
+				finally:
+					f.close()
+				self._mtime = mtime
+			except (IOError, ValueError):
+				self._devices = {}
+		return self._devices
+
+	def get(self, address, maxAge=None):
+		"""Returns the dict stored for address, or None.
+
+		If maxAge is given, records updated more than maxAge seconds ago
+		are ignored."""
+		self._lock.acquire()
+		try:
+			record = self._read().get(address)
+		finally:
+			self._lock.release()
+		if record is None:
+			return None
+		if maxAge is not None and time.time() - record.get('updated', 0) > maxAge:
+			return None
+		return dict(record)
+
+	def addresses(self, maxAge=None, field=None):
+		"""Returns all known addresses.
+
+		If maxAge is given, only addresses updated within maxAge seconds are 
+		returned; if field is given, only addresses whose record has it."""
+		self._lock.acquire()
+		try:
+			devices = self._read()
+			now = time.time()
+			return [a for a, r in devices.items()
+				if (maxAge is None or now - r.get('updated', 0) <= maxAge)
+				and (field is None or r.has_key(field))]
+		finally:
+			self._lock.release()
+
+	def update(self, address, **fields):
+		"""Merges fields into the record for address and saves the registry."""
+		self.updateMany({address: fields})
+
+	def updateMany(self, records):
+		"""Merges a dict of address -> fields and saves the registry once."""
+		self._lock.acquire()
+		try:
+			self._devices = None
+			devices = self._read()
+			now = time.time()
+			for address, fields in records.items():
+				record = devices.setdefault(address, {})
+				record.update(fields)
+				record['updated'] = now
+			self._write(devices)
+		finally:
+			self._lock.release()
+
+	def remove(self, address):
+		"""Forgets address."""
+		self._lock.acquire()
+		try:
+			self._devices = None
+			devices = self._read()
+			if devices.has_key(address):
+				del devices[address]
+				self._write(devices)
+		finally:
+			self._lock.release()
+
+	def _write(self, devices):
+		"""Used internally to atomically replace the registry file."""
+		directory = os.path.dirname(self.path)
+		if directory and not os.path.isdir(directory):
+			os.makedirs(directory)
+		fd, tmp = tempfile.mkstemp(dir=directory or '.', prefix='.registry')
+		try:
+			os.write(fd, dumps(devices))
+		finally:
+			os.close(fd)
+		os.rename(tmp, self.path)
+		self._mtime = os.stat(self.path).st_mtime
@@ -0,0 +1,167 @@
+#!/usr/bin/env python
+
+#Copyright (c) 2011, Paul Jennings <pjennings-tstat@pjennings.net>
+#All rights reserved.
+
+#Redistribution and use in source and binary forms, with or without
+#modification, are permitted provided that the following conditions are met:
+#
+#    * Redistributions of source code must retain the above copyright notice,
+#      this list of conditions and the following disclaimer.
+#    * Redistributions in binary form must reproduce the above copyright
+#      notice, this list of conditions and the following disclaimer in the
+#      documentation and/or other materials provided with the distribution.
+#    * The names of its contributors may not be used to endorse or promote
+#      products derived from this software without specific prior written
+#      permission.
+
+#THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+#AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+#IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+#ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+#LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+#CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+#SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+#INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+#CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+#ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF
+#THE POSSIBILITY OF SUCH DAMAGE.
+
+# Retry.py
+# Retry, timeout and circuit breaker policy for talking to thermostats.
+
+# A RetryPolicy describes how hard TStat tries to get an answer:
+#   attempts:       Maximum number of requests per call.
+#   connectTimeout: Seconds allowed to open a connection.
+#   readTimeout:    Seconds allowed to wait for each read from the socket.
+#   deadline:       Seconds allowed for the whole call, including backoff.
+#                   Timeouts of later attempts shrink to fit.
+#   baseDelay, maxDelay: Backoff before attempt n is a random time between
+#                   0 and min(maxDelay, baseDelay*2**n) ("full jitter").
+#   A request is retried if it failed to connect or read, or if the tstat
+#   answered with a 5xx status.
+#
+# A CircuitBreaker stops requests to a thermostat that keeps failing.  After
+# failureThreshold consecutive failed calls it opens, and calls fail at once
+# for resetTimeout seconds.  Then a single trial call is let through
+# (half-open); success closes the breaker, failure opens it again.  Every
+# TStat talking to the same address shares one breaker (see getBreaker).
+
+import random
+import threading
+
+from Cache import monotonic
+
+class RetryPolicy:
+	def __init__(self, attempts=5, connectTimeout=5, readTimeout=10, deadline=30, baseDelay=0.5, maxDelay=8):
+		self.attempts = attempts
+		self.connectTimeout = connectTimeout
+		self.readTimeout = readTimeout
+		self.deadline = deadline
+		self.baseDelay = baseDelay
+		self.maxDelay = maxDelay
+
+	def begin(self):
+		"""Starts the clock for one call and returns its RetryState."""
+		return RetryState(self)
+
+	def retryable(self, status):
+		"""Returns True if a request that got status (None if no answer) should be retried."""
+		return status is None or status >= 500
+
+class RetryState:
+	"""Tracks attempts and the deadline for one call under a RetryPolicy."""
+
+	def __init__(self, policy):
+		self.policy = policy
+		self.attempt = 0
+		self.started = monotonic()
+
+	def remaining(self):
+		"""Returns seconds left before the deadline."""
+		return self.policy.deadline - (monotonic() - self.started)
+
+	def timeouts(self):
+		"""Returns (connectTimeout, readTimeout) clipped to the deadline."""
+		remaining = max(self.remaining(), 0.001)
+		return (min(self.policy.connectTimeout, remaining), min(self.policy.readTimeout, remaining))
+
+	def next(self):
+		"""Records a failed attempt and returns how long to back off, or None to give up."""
+		self.attempt = self.attempt + 1
+		if self.attempt >= self.policy.attempts:
+			return None
+		p = self.policy
+		delay = random.uniform(0, min(p.maxDelay, p.baseDelay * 2 ** (self.attempt - 1)))
+		# Leave time for at least a connect after sleeping
+		if delay + min(p.connectTimeout, 1) >= self.remaining():
+			return None
+		return delay
+
+class CircuitBreaker:
+	CLOSED = 'closed'
+	OPEN = 'open'
+	HALF_OPEN = 'half-open'
+
+	def __init__(self, failureThreshold=5, resetTimeout=30):
+		self.failureThreshold = failureThreshold
+		self.resetTimeout = resetTimeout
+		self.state = self.CLOSED
+		self.failures = 0
+		self._openedAt = 0
+		self._trial = False
+		self._lock = threading.Lock()
+
+	def allow(self):
+		"""Returns True if a call may be made now."""
+		self._lock.acquire()
+		try:
+			if self.state == self.CLOSED:
+				return True
+			if self.state == self.OPEN:
+				if monotonic() - self._openedAt < self.resetTimeout:
+					return False
+				self.state = self.HALF_OPEN
+				self._trial = False
+			# Half-open: let exactly one trial call through
+			if self._trial:
+				return False
+			self._trial = True
+			return True
+		finally:
+			self._lock.release()
+
+	def success(self):
+		"""Records a successful call."""
+		self._lock.acquire()
+		try:
+			self.state = self.CLOSED
+			self.failures = 0
+			self._trial = False
+		finally:
+			self._lock.release()
+
+	def failure(self):
+		"""Records a failed call, opening the breaker if there were too many."""
+		self._lock.acquire()
+		try:
+			self.failures = self.failures + 1
+			if self.state == self.HALF_OPEN or self.failures >= self.failureThreshold:
+				self.state = self.OPEN
+				self._openedAt = monotonic()
+				self._trial = False
+		finally:
+			self._lock.release()
+
+_breakers = {}
+_breakersLock = threading.Lock()
+
+def getBreaker(address):
+	"""Returns the CircuitBreaker shared by every TStat talking to address."""
+	_breakersLock.acquire()
+	try:
+		if not _breakers.has_key(address):
+			_breakers[address] = CircuitBreaker()
+		return _breakers[address]
+	finally:
+		_breakersLock.release()
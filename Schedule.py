@@ -0,0 +1,194 @@
+#!/usr/bin/env python
+
+#Copyright (c) 2011, Paul Jennings <pjennings-tstat@pjennings.net>
+#All rights reserved.
+
+#Redistribution and use in source and binary forms, with or without
+#modification, are permitted provided that the following conditions are met:
+#
+#    * Redistributions of source code must retain the above copyright notice,
+#      this list of conditions and the following disclaimer.
+#    * Redistributions in binary form must reproduce the above copyright
+#      notice, this list of conditions and the following disclaimer in the
+#      documentation and/or other materials provided with the distribution.
+#    * The names of its contributors may not be used to endorse or promote
+#      products derived from this software without specific prior written
+#      permission.
+
+#THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+#AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+#IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+#ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+#LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+#CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+#SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+#INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+#CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+#ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF
+#THE POSSIBILITY OF SUCH DAMAGE.
+
+# Schedule.py
+# Local copy of a calendar, kept as a sorted timeline of event start times.
+
+# Usage:
+# s = Schedule(schedulePath('Thermostat'))   # Loads ~/.tstat/schedule-Thermostat.json
+# s.update(uid, 'Heat 70', [start, ...])     # Starts are seconds since the epoch
+# s.remove(uid)
+# s.save()
+# s.closest()                  # (start, title) of the latest event that has started
+# s.between(start, end)        # [(start, title), ...] in time order
+#
+# Calendar sync code (see TStatGcal.py) stores whatever it needs to fetch
+# only changes next time (sync tokens, update times, ...) in s.state, which
+# is saved along with the events.  The file is written to a temporary file
+# that is renamed into place, and is only readable by its owner because the
+# state may include a login token.
+#
+# Event starts are parsed once, when they are stored.  The sorted timeline
+# is rebuilt only after a change, so finding the closest past event is a
+# binary search.
+
+import bisect
+import calendar
+import os
+import re
+import tempfile
+import time
+
+# For Python < 2.6, this json module:
+# http://pypi.python.org/pypi/python-json
+# will work.
+try:
+	from json import read as loads
+	from json import write as dumps
+except ImportError:
+	from json import loads
+	from json import dumps
+
+DEFAULT_DIR = os.path.expanduser("~/.tstat")
+
+def schedulePath(name, directory=None):
+	"""Returns the default schedule file for the calendar called name."""
+	if directory is None:
+		directory = DEFAULT_DIR
+	return os.path.join(directory, "schedule-%s.json" % re.sub(r'[^A-Za-z0-9_.-]', '_', name))
+
+_TIME = re.compile(r'^(\d{4})-(\d\d)-(\d\d)(?:T(\d\d):(\d\d)(?::(\d\d)(?:\.\d+)?)?(Z|[+-]\d\d:?\d\d)?)?$')
+
+def parseTime(text):
+	"""Returns an RFC 3339 date or time (e.g. 2011-10-17T06:30:00.000-07:00) as seconds since the epoch.
+
+	Times without an offset and plain dates are taken as local time."""
+	m = _TIME.match(text.strip())
+	if m is None:
+		raise ValueError("Unrecognized time '%s'" % text)
+	year, month, day, hour, minute, second, zone = m.groups()
+	fields = (int(year), int(month), int(day), int(hour or 0), int(minute or 0), int(second or 0))
+	if zone is None:
+		return time.mktime(fields + (0, 0, -1))
+	t = calendar.timegm(fields + (0, 0, 0))
+	if zone != 'Z':
+		offset = int(zone[1:3]) * 3600 + int(zone[-2:]) * 60
+		if zone[0] == '+':
+			t = t - offset
+		else:
+			t = t + offset
+	return t
+
+def formatTime(t):
+	"""Returns seconds since the epoch as an RFC 3339 UTC time."""
+	return time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(t))
+
+class Schedule:
+	def __init__(self, path=None):
+		self.path = path
+		self.events = {}
+		self.state = {}
+		self._starts = None
+		self._titles = None
+		if path is not None and os.path.exists(path):
+			f = open(path)
+			try:
+				try:
+					saved = loads(f.read())
+					self.events = saved.get('events', {})
+					self.state = saved.get('state', {})
+				except ValueError:
+					pass
+			finally:
+				f.close()
+
+	def update(self, uid, title, starts):
+		"""Adds or replaces the event uid."""
+		self.events[uid] = {'title': title, 'starts': sorted(starts)}
+		self._starts = None
+
+	def remove(self, uid):
+		"""Forgets the event uid, if known."""
+		if self.events.has_key(uid):
+			del self.events[uid]
+			self._starts = None
+
+	def clear(self):
+		"""Forgets every event and the sync state."""
+		self.events = {}
+		self.state.clear()
+		self._starts = None
+
+	def prune(self, before):
+		"""Forgets events that all started before before, except the one in effect at before."""
+		keep = self.closest(before)
+		for uid, event in self.events.items():
+			starts = event['starts']
+			if starts and starts[-1] >= before:
+				continue
+			if keep is not None and event['title'] == keep[1] and keep[0] in starts:
+				continue
+			del self.events[uid]
+			self._starts = None
+
+	def _timeline(self):
+		"""Used internally to (re)build the sorted timeline after a change."""
+		if self._starts is None:
+			timeline = []
+			for event in self.events.values():
+				for start in event['starts']:
+					timeline.append((start, event['title']))
+			timeline.sort()
+			self._starts = [start for start, title in timeline]
+			self._titles = [title for start, title in timeline]
+		return (self._starts, self._titles)
+
+	def closest(self, now=None, accept=None):
+		"""Returns (start, title) of the latest event starting at or before now, or None.
+
+		If accept is given, events for which accept(title) is false are
+		skipped."""
+		if now is None:
+			now = time.time()
+		starts, titles = self._timeline()
+		i = bisect.bisect_right(starts, now) - 1
+		while i >= 0:
+			if accept is None or accept(titles[i]):
+				return (starts[i], titles[i])
+			i = i - 1
+		return None
+
+	def between(self, start, end):
+		"""Returns [(start, title), ...] for events starting in [start, end), in time order."""
+		starts, titles = self._timeline()
+		first = bisect.bisect_left(starts, start)
+		last = bisect.bisect_left(starts, end)
+		return zip(starts[first:last], titles[first:last])
+
+	def save(self):
+		"""Atomically writes the schedule to its file."""
+		directory = os.path.dirname(self.path)
+		if directory and not os.path.isdir(directory):
+			os.makedirs(directory)
+		fd, tmp = tempfile.mkstemp(dir=directory or '.', prefix='.schedule')
+		try:
+			os.write(fd, dumps({'events': self.events, 'state': self.state}))
+		finally:
+			os.close(fd)
+		os.rename(tmp, self.path)
@@ -0,0 +1,291 @@
+#!/usr/bin/env python
+
+#Copyright (c) 2011, Paul Jennings <pjennings-tstat@pjennings.net>
+#All rights reserved.
+
+#Redistribution and use in source and binary forms, with or without
+#modification, are permitted provided that the following conditions are met:
+#
+#    * Redistributions of source code must retain the above copyright notice,
+#      this list of conditions and the following disclaimer.
+#    * Redistributions in binary form must reproduce the above copyright
+#      notice, this list of conditions and the following disclaimer in the
+#      documentation and/or other materials provided with the distribution.
+#    * The names of its contributors may not be used to endorse or promote
+#      products derived from this software without specific prior written
+#      permission.
+
+#THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+#AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+#IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+#ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+#LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+#CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+#SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+#INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+#CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+#ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF
+#THE POSSIBILITY OF SUCH DAMAGE.
+
+# Scheduler.py
+# Adaptive polling of many thermostats.
+
+# Usage:
+# def report(address, values, changed):
+#     ...                      # Called after every poll, from a worker thread
+# s = PollScheduler([TStat(a) for a in addresses], callback=report, rate=20)
+# s.run()                      # Polls until s.stop() is called
+#
+# Each device has its own poll interval between minInterval and maxInterval.
+# When tstate or fstate changes, or the temperature moves by tempDelta or
+# more, the interval drops back to minInterval so transitions are followed
+# closely.  While readings stay the same the interval grows by growth each
+# poll, and while a device is failing it doubles, so idle and offline units
+# cost little airtime.  Across all devices, at most rate polls are started
+# per second (a token bucket allowing bursts of up to rate polls).
+#
+# Devices wait in a heap ordered by the time their next poll is due, so each
+# scheduling decision costs O(log n) and thousands of devices can share one
+# scheduler.  Polls run on a small pool of worker threads and use
+# TStat.getMany, so they share the TStat cache with any other readers.
+
+import heapq
+import logging
+import Queue
+import threading
+
+from Cache import monotonic
+
+DEFAULT_KEYS = ['temp', 'tstate', 'fstate']
+
+class _Device:
+	def __init__(self, tstat, interval):
+		self.tstat = tstat
+		self.address = tstat.address
+		self.interval = interval
+		self.values = None
+		self.failures = 0
+		self.active = True
+
+class _TokenBucket:
+	"""Allows rate events per second on average, in bursts of up to burst."""
+
+	def __init__(self, rate, burst):
+		self.rate = rate
+		self.burst = burst
+		self.tokens = burst
+		self.updated = monotonic()
+
+	def take(self):
+		"""Takes a token if one is available; returns seconds to wait otherwise."""
+		now = monotonic()
+		self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+		self.updated = now
+		if self.tokens >= 1:
+			self.tokens = self.tokens - 1
+			return 0
+		return (1 - self.tokens) / self.rate
+
+class PollScheduler:
+	def __init__(self, tstats=(), keys=None, minInterval=15, maxInterval=600, growth=1.5, tempDelta=0.5, rate=10, workers=4, callback=None, logger=None):
+		if keys is None:
+			keys = DEFAULT_KEYS
+		self.keys = keys
+		self.minInterval = minInterval
+		self.maxInterval = maxInterval
+		self.growth = growth
+		self.tempDelta = tempDelta
+		self.workers = workers
+		self.callback = callback
+		if logger is None:
+			logger = logging.getLogger('PollScheduler')
+		self.logger = logger
+
+		self._bucket = _TokenBucket(rate, max(rate, 1))
+		self._heap = []
+		self._seq = 0
+		self._devices = {}
+		self._cond = threading.Condition()
+		self._queue = Queue.Queue()
+		self._threads = []
+		self._stopped = False
+		for tstat in tstats:
+			self.add(tstat)
+
+	def _push(self, device, due):
+		"""Used internally to schedule device; caller holds the condition."""
+		self._seq = self._seq + 1
+		heapq.heappush(self._heap, (due, self._seq, device))
+		self._cond.notify()
+
+	def add(self, tstat, delay=0):
+		"""Starts polling tstat after delay seconds."""
+		self._cond.acquire()
+		try:
+			device = _Device(tstat, self.minInterval)
+			old = self._devices.get(tstat.address)
+			if old is not None:
+				old.active = False
+			self._devices[tstat.address] = device
+			self._push(device, monotonic() + delay)
+		finally:
+			self._cond.release()
+
+	def remove(self, address):
+		"""Stops polling the device at address."""
+		self._cond.acquire()
+		try:
+			device = self._devices.pop(address, None)
+			if device is not None:
+				device.active = False
+		finally:
+			self._cond.release()
+
+	def intervals(self):
+		"""Returns a dict of address -> current poll interval."""
+		self._cond.acquire()
+		try:
+			return dict([(a, d.interval) for a, d in self._devices.items()])
+		finally:
+			self._cond.release()
+
+	def _changed(self, old, new):
+		"""Used internally to decide whether readings changed enough to poll faster."""
+		if old is None:
+			return False
+		for key, value in new.items():
+			previous = old.get(key)
+			if key == 'temp':
+				try:
+					if abs(value - previous) >= self.tempDelta:
+						return True
+				except TypeError:
+					if value != previous:
+						return True
+			elif value != previous:
+				return True
+		return False
+
+	def _adapt(self, device, values, error):
+		"""Used internally to pick the next interval for device after a poll.
+
+		Returns True if the readings changed."""
+		failed = error is not None or values is None or not [v for v in values.values() if v is not None]
+		if failed:
+			device.failures = device.failures + 1
+			device.interval = min(self.maxInterval, max(device.interval, self.minInterval) * 2)
+			return False
+		device.failures = 0
+		changed = self._changed(device.values, values)
+		device.values = values
+		if changed:
+			device.interval = self.minInterval
+		else:
+			device.interval = min(self.maxInterval, device.interval * self.growth)
+		return changed
+
+	def _work(self):
+		"""Worker thread: polls devices handed over by the scheduling loop."""
+		while True:
+			device = self._queue.get()
+			if device is None:
+				return
+			self._cond.acquire()
+			try:
+				stopped = self._stopped
+				if stopped and device.active:
+					# run() has ended; leave this poll to the next run()
+					self._push(device, monotonic())
+			finally:
+				self._cond.release()
+			if stopped:
+				continue
+			values = None
+			error = None
+			try:
+				values = device.tstat.getMany(self.keys, raw=True)
+			except Exception, e:
+				self.logger.warning("Poll of %s failed: %s" % (device.address, e))
+				error = e
+			changed = self._adapt(device, values, error)
+			if self.callback is not None and error is None:
+				try:
+					self.callback(device.address, values, changed)
+				except Exception, e:
+					self.logger.error("Callback for %s failed: %s" % (device.address, e))
+			self._cond.acquire()
+			try:
+				# Even after run() ends, so a later run() keeps polling it
+				if device.active:
+					self._push(device, monotonic() + device.interval)
+			finally:
+				self._cond.release()
+
+	def run(self, duration=None):
+		"""Runs the scheduling loop until stop() is called (or for duration seconds)."""
+		self._stopped = False
+		for i in range(self.workers):
+			t = threading.Thread(target=self._work, name="PollScheduler-%d" % i)
+			t.setDaemon(True)
+			t.start()
+			self._threads.append(t)
+		end = None
+		if duration is not None:
+			end = monotonic() + duration
+
+		self._cond.acquire()
+		try:
+			while not self._stopped:
+				now = monotonic()
+				if end is not None and now >= end:
+					break
+				wait = 1.0
+				if end is not None:
+					wait = min(wait, end - now)
+				if not self._heap:
+					self._cond.wait(wait)
+					continue
+				due, seq, device = self._heap[0]
+				if not device.active:
+					heapq.heappop(self._heap)
+					continue
+				if due > now:
+					self._cond.wait(min(wait, due - now))
+					continue
+				delay = self._bucket.take()
+				if delay > 0:
+					self._cond.wait(min(wait, delay))
+					continue
+				heapq.heappop(self._heap)
+				self._queue.put(device)
+		finally:
+			self._stopped = True
+			self._cond.release()
+			for t in self._threads:
+				self._queue.put(None)
+			for t in self._threads:
+				t.join()
+			self._threads = []
+
+	def stop(self):
+		"""Makes run() return once in-progress polls finish."""
+		self._cond.acquire()
+		try:
+			self._stopped = True
+			self._cond.notify()
+		finally:
+			self._cond.release()
+
+def main():
+	import sys
+	from TStat import TStat
+	def report(address, values, changed):
+		print address, values, changed and "changed" or ""
+	s = PollScheduler([TStat(address) for address in sys.argv[1:]], callback=report)
+	try:
+		s.run()
+	except KeyboardInterrupt:
+		s.stop()
+
+if __name__ == '__main__':
+	main()
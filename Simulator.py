@@ -0,0 +1,418 @@
+#!/usr/bin/env python
+
+#Copyright (c) 2011, Paul Jennings <pjennings-tstat@pjennings.net>
+#All rights reserved.
+
+#Redistribution and use in source and binary forms, with or without
+#modification, are permitted provided that the following conditions are met:
+#
+#    * Redistributions of source code must retain the above copyright notice,
+#      this list of conditions and the following disclaimer.
+#    * Redistributions in binary form must reproduce the above copyright
+#      notice, this list of conditions and the following disclaimer in the
+#      documentation and/or other materials provided with the distribution.
+#    * The names of its contributors may not be used to endorse or promote
+#      products derived from this software without specific prior written
+#      permission.
+
+#THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+#AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+#IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+#ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+#LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+#CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+#SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+#INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+#CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+#ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF
+#THE POSSIBILITY OF SUCH DAMAGE.
+
+# Simulator.py
+# Local HTTP server that behaves like a CT50 V1.09 thermostat.
+
+# Usage:
+# s = Simulator(latency=0.05, errorRate=0.01)
+# t = TStat(s.address)         # s.address is e.g. '127.0.0.1:40123'
+# ...
+# s.stats()                    # Requests served, errors injected, etc.
+# s.close()
+#
+# python Simulator.py 8080     # Run one simulated thermostat on port 8080
+#
+# The simulator serves the URLs used by API_CT50v109: /tstat (and
+# /tstat/<key> for single values), /tstat/info, /tstat/ttemp,
+# /tstat/datalog, /tstat/model, /tstat/errstatus, /tstat/power,
+# /tstat/program/heat, /tstat/program/cool and /cloud/mode.  POSTs change
+# its state and answer with the same text as a real thermostat.  The
+# temperature drifts towards the active set point while the thermostat is
+# running, so tstate changes now and then.
+#
+# Options:
+#   latency, jitter:  Each response is delayed by latency plus a random
+#                     time up to jitter seconds.
+#   concurrency:      Requests handled at once (the real device handles
+#                     one at a time); others queue.  None for no limit.
+#   maxConnections:   Open connections allowed; further connections are
+#                     closed immediately.  None for no limit.
+#   errorRate:        Fraction of requests answered with HTTP 500.
+#   errorMsgRate:     Fraction of GETs answered with {"error_msg": ...}.
+#   dropRate:         Fraction of requests whose connection is closed
+#                     without an answer.
+#   model:            Reported by /tstat/model.
+
+import BaseHTTPServer
+import SocketServer
+import random
+import sys
+import threading
+import time
+import urlparse
+
+# For Python < 2.6, this json module:
+# http://pypi.python.org/pypi/python-json
+# will work.
+try:
+	from json import read as loads
+	from json import write as dumps
+except ImportError:
+	from json import loads
+	from json import dumps
+
+SUCCESS = "Tstat Command Processed"
+
+# Keys that may be read or written as /tstat/<key>
+SINGLE_KEYS = ['temp', 'tmode', 'fmode', 'override', 'hold', 'tstate', 'fstate', 't_heat', 't_cool', 'power', 'errstatus']
+
+class SimulatedTStat:
+	"""State of one simulated thermostat."""
+
+	def __init__(self, model='CT50 V1.09', temp=70.0, t_heat=68.0, t_cool=78.0, tmode=1):
+		self.model = model
+		self.state = {
+			'temp': temp,
+			'tmode': tmode,
+			'fmode': 0,
+			'override': 0,
+			'hold': 0,
+			't_heat': t_heat,
+			't_cool': t_cool,
+			'tstate': 0,
+			'fstate': 0,
+			'power': 0,
+			'errstatus': 0
+		}
+		self.cloudMode = 1
+		# Day number (from Monday) -> [minute, temp] for four periods
+		self.program = {
+			'heat': dict([(str(day), [360, 70, 480, 62, 1080, 70, 1320, 62]) for day in range(7)]),
+			'cool': dict([(str(day), [360, 80, 480, 85, 1080, 80, 1320, 82]) for day in range(7)])
+		}
+		self.runtime = {'heat': 0, 'cool': 0}
+		self._lock = threading.Lock()
+		self._updated = time.time()
+
+	def _step(self):
+		"""Used internally to move the temperature and running state on to now."""
+		now = time.time()
+		elapsed = now - self._updated
+		self._updated = now
+		s = self.state
+		if s['tstate'] == 1:
+			s['temp'] = s['temp'] + elapsed * 0.01
+			self.runtime['heat'] = self.runtime['heat'] + elapsed
+		elif s['tstate'] == 2:
+			s['temp'] = s['temp'] - elapsed * 0.01
+			self.runtime['cool'] = self.runtime['cool'] + elapsed
+		else:
+			s['temp'] = s['temp'] + random.uniform(-0.005, 0.005) * elapsed
+		s['temp'] = round(s['temp'], 2)
+		if s['tmode'] == 1:
+			if s['temp'] < s['t_heat'] - 0.5:
+				s['tstate'] = 1
+			elif s['temp'] >= s['t_heat'] + 0.5:
+				s['tstate'] = 0
+		elif s['tmode'] == 2:
+			if s['temp'] > s['t_cool'] + 0.5:
+				s['tstate'] = 2
+			elif s['temp'] <= s['t_cool'] - 0.5:
+				s['tstate'] = 0
+		else:
+			s['tstate'] = 0
+		s['fstate'] = int(s['tstate'] != 0 or s['fmode'] == 2)
+
+	def _time(self):
+		t = time.localtime()
+		return {'day': t.tm_wday, 'hour': t.tm_hour, 'minute': t.tm_min}
+
+	def _runtime(self, seconds):
+		minutes = int(seconds // 60)
+		return {'hour': minutes // 60, 'minute': minutes % 60}
+
+	def get(self, location):
+		"""Returns the data served for location, or None if it does not exist."""
+		self._lock.acquire()
+		try:
+			self._step()
+			s = self.state
+			if location == '/tstat':
+				data = dict([(k, s[k]) for k in ('temp', 'tmode', 'fmode', 'override', 'hold', 'tstate', 'fstate')])
+				if s['tmode'] == 2:
+					data['t_cool'] = s['t_cool']
+				else:
+					data['t_heat'] = s['t_heat']
+				data['time'] = self._time()
+				return data
+			if location == '/tstat/info':
+				data = dict([(k, s[k]) for k in ('temp', 'tmode', 'fmode', 'override', 'hold', 't_heat', 't_cool', 'tstate', 'fstate')])
+				data['time'] = self._time()
+				return data
+			if location == '/tstat/ttemp':
+				return {'t_heat': s['t_heat'], 't_cool': s['t_cool']}
+			if location == '/tstat/model':
+				return {'model': self.model}
+			if location == '/tstat/datalog':
+				return {
+					'today': {'heat_runtime': self._runtime(self.runtime['heat']), 'cool_runtime': self._runtime(self.runtime['cool'])},
+					'yesterday': {'heat_runtime': {'hour': 1, 'minute': 30}, 'cool_runtime': {'hour': 0, 'minute': 0}}
+				}
+			if location == '/cloud/mode':
+				return {'command': self.cloudMode}
+			if location in ('/tstat/program/heat', '/tstat/program/cool'):
+				return dict([(day, list(periods)) for day, periods in self.program[location.split('/')[-1]].items()])
+			if location.startswith('/tstat/'):
+				key = location[len('/tstat/'):]
+				if key in SINGLE_KEYS:
+					return {key: s[key]}
+			return None
+		finally:
+			self._lock.release()
+
+	def post(self, location, body):
+		"""Applies a POST and returns (status, text of the answer)."""
+		self._lock.acquire()
+		try:
+			self._step()
+			if location == '/cloud/mode':
+				params = urlparse.parse_qs(body)
+				try:
+					self.cloudMode = int(params['command'][0])
+				except (KeyError, ValueError):
+					return (200, dumps({'error_msg': 'Invalid command'}))
+				if self.cloudMode:
+					return (200, "Cloud updates activated")
+				return (200, "Cloud updates have been suspended till reboot")
+
+			if location in ('/tstat/program/heat', '/tstat/program/cool'):
+				try:
+					values = loads(body)
+					program = self.program[location.split('/')[-1]]
+					for day, periods in values.items():
+						if day not in program or len(periods) != 8 or [p for p in periods if not isinstance(p, (int, long, float))]:
+							raise ValueError
+				except (ValueError, AttributeError, TypeError):
+					return (200, dumps({'error_msg': 'Invalid program'}))
+				for day, periods in values.items():
+					program[day] = [int(p) for p in periods]
+				return (200, SUCCESS)
+
+			if location in ('/tstat', '/tstat/ttemp'):
+				allowed = SINGLE_KEYS
+			elif location.startswith('/tstat/') and location[len('/tstat/'):] in SINGLE_KEYS:
+				allowed = [location[len('/tstat/'):]]
+			else:
+				return (404, "Not Found")
+			try:
+				values = loads(body)
+				if not isinstance(values, dict):
+					raise ValueError
+			except ValueError:
+				return (200, dumps({'error_msg': 'Invalid JSON'}))
+			for key, value in values.items():
+				if key not in allowed or key in ('temp', 'tstate', 'fstate', 'errstatus'):
+					return (200, dumps({'error_msg': 'Invalid key %s' % key}))
+				self.state[key] = value
+			return (200, SUCCESS)
+		finally:
+			self._lock.release()
+
+class _Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+	protocol_version = 'HTTP/1.1'
+	# Send each response in one write, or delayed ACKs add ~40ms per request
+	wbufsize = -1
+	disable_nagle_algorithm = True
+
+	def log_message(self, *args):
+		pass
+
+	def _answer(self, status, body, contentType="application/json"):
+		self.send_response(status)
+		self.send_header("Content-Type", contentType)
+		self.send_header("Content-Length", str(len(body)))
+		self.end_headers()
+		self.wfile.write(body)
+
+	def _handle(self, method):
+		sim = self.server.simulator
+		location = self.path.split('?')[0]
+		body = None
+		if method == 'POST':
+			body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+
+		sim._begin()
+		try:
+			delay = sim.latency + random.uniform(0, sim.jitter)
+			if delay > 0:
+				time.sleep(delay)
+			fault = sim._fault(method)
+			if fault == 'drop':
+				self.close_connection = 1
+				return
+			if fault == 'error':
+				self._answer(500, "Internal Server Error", "text/plain")
+				return
+			if fault == 'error_msg':
+				self._answer(200, dumps({'error_msg': 'Simulated error'}))
+				return
+			if method == 'GET':
+				data = sim.device.get(location)
+				if data is None:
+					self._answer(404, "Not Found", "text/plain")
+				else:
+					self._answer(200, dumps(data))
+			else:
+				status, text = sim.device.post(location, body)
+				self._answer(status, text, "text/plain")
+		finally:
+			sim._end()
+
+	def do_GET(self):
+		self._handle('GET')
+
+	def do_POST(self):
+		self._handle('POST')
+
+class _Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+	daemon_threads = True
+	allow_reuse_address = True
+
+	def process_request(self, request, client_address):
+		if not self.simulator._connect():
+			# Like a device that is out of sockets: accept and hang up
+			request.close()
+			return
+		SocketServer.ThreadingMixIn.process_request(self, request, client_address)
+
+	def close_request(self, request):
+		BaseHTTPServer.HTTPServer.close_request(self, request)
+		self.simulator._disconnect()
+
+class Simulator:
+	def __init__(self, port=0, host='127.0.0.1', device=None, latency=0, jitter=0, concurrency=None, maxConnections=None, errorRate=0, errorMsgRate=0, dropRate=0, seed=None):
+		if device is None:
+			device = SimulatedTStat()
+		self.device = device
+		self.latency = latency
+		self.jitter = jitter
+		self.maxConnections = maxConnections
+		self.errorRate = errorRate
+		self.errorMsgRate = errorMsgRate
+		self.dropRate = dropRate
+		self._random = random.Random(seed)
+		self._lock = threading.Lock()
+		self._slots = None
+		if concurrency is not None:
+			self._slots = threading.Semaphore(concurrency)
+		self.connections = 0
+		self.counts = {'connections': 0, 'rejected': 0, 'requests': 0, 'errors': 0, 'error_msgs': 0, 'drops': 0}
+
+		self.server = _Server((host, port), _Handler)
+		self.server.simulator = self
+		self.port = self.server.server_address[1]
+		self.address = "%s:%d" % (host, self.port)
+		self._thread = threading.Thread(target=self.server.serve_forever, name="Simulator %s" % self.address)
+		self._thread.setDaemon(True)
+		self._thread.start()
+
+	def _connect(self):
+		"""Used internally to admit a new connection, if under maxConnections."""
+		self._lock.acquire()
+		try:
+			if self.maxConnections is not None and self.connections >= self.maxConnections:
+				self.counts['rejected'] += 1
+				return False
+			self.connections = self.connections + 1
+			self.counts['connections'] += 1
+			return True
+		finally:
+			self._lock.release()
+
+	def _disconnect(self):
+		self._lock.acquire()
+		try:
+			self.connections = self.connections - 1
+		finally:
+			self._lock.release()
+
+	def _begin(self):
+		"""Used internally to wait for a free request slot."""
+		if self._slots is not None:
+			self._slots.acquire()
+
+	def _end(self):
+		if self._slots is not None:
+			self._slots.release()
+
+	def _fault(self, method):
+		"""Used internally to decide whether to inject a fault into this request."""
+		self._lock.acquire()
+		try:
+			self.counts['requests'] += 1
+			r = self._random.random()
+			if r < self.dropRate:
+				self.counts['drops'] += 1
+				return 'drop'
+			r = r - self.dropRate
+			if r < self.errorRate:
+				self.counts['errors'] += 1
+				return 'error'
+			r = r - self.errorRate
+			if method == 'GET' and r < self.errorMsgRate:
+				self.counts['error_msgs'] += 1
+				return 'error_msg'
+			return None
+		finally:
+			self._lock.release()
+
+	def stats(self):
+		"""Returns a dict of connection, request and injected fault counts."""
+		self._lock.acquire()
+		try:
+			stats = dict(self.counts)
+			stats['open'] = self.connections
+			return stats
+		finally:
+			self._lock.release()
+
+	def close(self):
+		self.server.shutdown()
+		self.server.server_close()
+		self._thread.join()
+
+def simulateMany(count, **options):
+	"""Starts count simulators (each on its own port) and returns them."""
+	return [Simulator(**options) for i in range(count)]
+
+def main():
+	port = 8080
+	if len(sys.argv) > 1:
+		port = int(sys.argv[1])
+	s = Simulator(port, '0.0.0.0')
+	print "Simulated thermostat listening on port %d" % s.port
+	try:
+		while True:
+			time.sleep(3600)
+	except KeyboardInterrupt:
+		s.close()
+
+if __name__ == '__main__':
+	main()
@@ -46,14 +46,73 @@
 # value will already exist and tstate will be returned from that.  
 #
 # You can change the time for cache expiration by calling 
-# t.setCacheExpiry(timeInSeconds).  
+# t.setCacheExpiry(timeInSeconds).  Some URLs have their own expiry (see 
+# API.cacheTTLs; e.g. /tstat/model is cached for a day).  At most cacheSize 
+# URLs are cached.  With cacheStale > 0, data up to cacheStale seconds past 
+# expiry is returned immediately while it is refreshed in the background.  
+# t.cache.stats() reports hits and misses.  (See Cache.py.)
+#
+# Pass sharedCache=True (or the path of an SQLite file) to share cached 
+# responses with other processes on the same machine; while one process 
+# retrieves a URL, others wait for its result instead of asking the 
+# thermostat again.
+#
+# If api is not given, the thermostat model is looked up on first use and 
+# remembered in ~/.tstat/registry.json (see Registry.py), so later runs 
+# start without asking the thermostat.  Pass registry=False to disable 
+# this, or a path to use a different file.  Requests to one thermostat are 
+# spaced out adaptively: the gap grows while the device is failing and 
+# shrinks back to minSpacing while it answers normally.
+#
+# Timeouts, retries and backoff are controlled by a RetryPolicy (pass 
+# retry=RetryPolicy(...)); a thermostat that keeps failing is skipped for 
+# a while by a per-address CircuitBreaker.  (See Retry.py.)
+#
+# To read several values at once, use t.getMany(['temp', 'tstate', 't_heat'])
+# or t.snapshot().  These work out the fewest URLs that cover every requested 
+# key (e.g. /tstat alone supplies temp, tmode, fmode, tstate, fstate, hold, 
+# override and time), retrieve each URL once and return a dict of values.  
+# Likewise t.setMany({'t_heat': 68, 'hold': True}) sends one POST per URL.
+#
+# With pipeline=True, the URLs getMany needs are requested together over one 
+# connection (HTTP/1.1 pipelining), so a full refresh takes about one round 
+# trip.  After a pipelined read ends early, URLs are read one at a time for 
+# a while.  A thermostat that keeps doing this, or answers with garbage, is 
+# remembered in the registry and read one URL at a time from then on.
+#
+# Successful writes update every cached response that contains the written 
+# value, so t.getHeatPoint() right after t.setHeatPoint(68) returns 68.  
+# With skipNoopWrites=True, a write is not sent at all if freshly cached 
+# data shows the thermostat already has that value.
+#
+# Pass metrics=Metrics() (shared by as many TStat instances as you like) or 
+# metrics=True to record request latency, status codes, retries, bytes read 
+# and cache counters; see Metrics.py for snapshots and a Prometheus exporter.
+#
+# Connections to the thermostat are kept alive (HTTP/1.1) and reused between 
+# requests.  Each TStat instance owns a ConnectionPool of at most poolSize 
+# connections (in use or idle; further requests wait their turn).  Idle 
+# connections are health checked before reuse and closed after poolIdle 
+# seconds.  Call t.close() to drop all pooled connections.
+#
+# Connections come from a pluggable transport (transport=..., a ConnectionPool 
+# by default).  Transport.py has transports that record live traffic to a 
+# trace file and replay it later without the thermostat.
+#
+# Finding thermostats:
+# discover()                   # Address of a thermostat on the local network
+# for address in discoverAll(timeout=10):
+#     ...                      # Every thermostat, as each one answers
+# Discovered addresses are remembered in the registry (see below), so 
+# discover() usually returns without sending anything; knownThermostats() 
+# lists them.
 
-import datetime
 import httplib
 import urllib
 import logging
-import random
+import select
 import socket
+import threading
 import time
 
 # For Python < 2.6, this json module:
@@ -67,21 +126,213 @@ except ImportError:
 	from json import dumps
 
 from API import *
+from Cache import CacheEntry, ResponseCache, SharedCache, monotonic
+from Metrics import Metrics
+from Registry import Registry
+from Retry import RetryPolicy, getBreaker
+
+class ConnectionPool:
+	"""Pool of persistent (keep-alive) HTTP connections to one thermostat.
+
+	At most maxSize connections are open at once, counting both those in 
+	use and those kept idle; acquire() blocks until one is released or 
+	discarded."""
 
-class CacheEntry:
-	def __init__(self, location, data):
-		self.location = location
-		self.data = data
-		self.time = datetime.datetime.now()
+	def __init__(self, address, maxSize=2, maxIdle=30):
+		self.address = address
+		self.maxSize = maxSize
+		self.maxIdle = maxIdle
+		self._idle = []
+		self._active = 0
+		self._lock = threading.Condition(threading.Lock())
+
+	def _isHealthy(self, conn):
+		"""Returns False if the peer closed an idle connection."""
+		if conn.sock is None:
+			# Not connected yet (or closed by httplib); will reconnect on use
+			return True
+		try:
+			readable = select.select([conn.sock], [], [], 0)[0]
+		except (socket.error, select.error, ValueError):
+			return False
+		# An idle keep-alive socket should never be readable.  If it is, the 
+		# thermostat either closed it or sent garbage.
+		return not readable
+
+	def acquire(self):
+		"""Returns a connection, reusing an idle one if a healthy one exists."""
+		self._lock.acquire()
+		try:
+			while True:
+				now = time.time()
+				while self._idle:
+					conn, released = self._idle.pop()
+					if now - released > self.maxIdle or not self._isHealthy(conn):
+						conn.close()
+						continue
+					self._active = self._active + 1
+					return conn
+				if self._active < self.maxSize:
+					self._active = self._active + 1
+					break
+				self._lock.wait()
+		finally:
+			self._lock.release()
+		return httplib.HTTPConnection(self.address)
 
-	def age(self):
-		return datetime.datetime.now()-self.time
+	def release(self, conn):
+		"""Returns a connection to the pool once its response has been read."""
+		self._lock.acquire()
+		try:
+			self._active = self._active - 1
+			self._idle.append((conn, time.time()))
+			self._lock.notify()
+		finally:
+			self._lock.release()
+
+	def discard(self, conn):
+		"""Closes a connection that failed and must not be reused."""
+		self._lock.acquire()
+		try:
+			self._active = self._active - 1
+			self._lock.notify()
+		finally:
+			self._lock.release()
+		try:
+			conn.close()
+		except Exception:
+			pass
 
-class TStat:
-	def __init__(self, address, cacheExpiry=5, api=None, logger=None, logLevel=None):
+	def close(self):
+		"""Closes all idle connections."""
+		self._lock.acquire()
+		try:
+			idle, self._idle = self._idle, []
+		finally:
+			self._lock.release()
+		for conn, released in idle:
+			conn.close()
+
+class RequestSpacer:
+	"""Adaptive minimum gap between requests to one thermostat.
+
+	Each failure multiplies the gap by backoff (up to maxSpacing); each 
+	success shrinks it by decay (down to minSpacing)."""
+
+	def __init__(self, minSpacing=0, maxSpacing=5, backoff=2, decay=0.5):
+		self.minSpacing = minSpacing
+		self.maxSpacing = maxSpacing
+		self.backoff = backoff
+		self.decay = decay
+		self.spacing = minSpacing
+		self._next = 0
+		self._lock = threading.Lock()
+
+	def reserve(self):
+		"""Claims the next request slot and returns how long to wait for it."""
+		self._lock.acquire()
+		try:
+			now = monotonic()
+			slot = max(now, self._next)
+			self._next = slot + self.spacing
+			return slot - now
+		finally:
+			self._lock.release()
+
+	def wait(self, limit=None):
+		"""Sleeps until the next request slot, but no longer than limit seconds."""
+		delay = self.reserve()
+		if limit is not None:
+			delay = min(delay, limit)
+		if delay > 0:
+			time.sleep(delay)
+
+	def record(self, ok):
+		"""Adjusts the spacing after a request succeeded (ok) or failed.
+
+		Only server errors and requests without an answer count as 
+		failures; e.g. a 404 from a fallback getter does not."""
+		self._lock.acquire()
+		try:
+			if ok:
+				self.spacing = max(self.minSpacing, self.spacing * self.decay)
+				if self.spacing < 0.01:
+					self.spacing = self.minSpacing
+			else:
+				self.spacing = min(self.maxSpacing, max(self.spacing * self.backoff, 0.25))
+		finally:
+			self._lock.release()
+
+class _Flight:
+	"""An in-progress retrieval of one location that other threads can wait on."""
+	def __init__(self):
+		self.done = threading.Event()
+		self.result = None
+
+_spacers = {}
+_spacersLock = threading.Lock()
+
+def getSpacer(address):
+	"""Returns the RequestSpacer shared by every TStat talking to address."""
+	_spacersLock.acquire()
+	try:
+		if not _spacers.has_key(address):
+			_spacers[address] = RequestSpacer()
+		return _spacers[address]
+	finally:
+		_spacersLock.release()
+
+class TStat(object):
+	# How long a model remembered in the registry is trusted (seconds)
+	registryMaxAge = 30*24*60*60
+	# How long to wait after failing to read the model before trying again (seconds)
+	detectRetry = 30
+	# Pipelined reads that end early before pipelining is given up for good
+	pipelineFailures = 3
+	# How long to read serially after a pipelined read ends early (seconds)
+	pipelineRetry = 60
+
+	postHeaders = {"Content-type": "application/x-www-form-urlencoded", "Accept": "text/plain"}
+
+	def __init__(self, address, cacheExpiry=5, api=None, logger=None, logLevel=None, poolSize=2, poolIdle=30, cacheSize=64, cacheStale=0, sharedCache=None, registry=True, retry=None, skipNoopWrites=False, metrics=None, transport=None, pipeline=False):
 		self.address = address
-		self.setCacheExpiry(cacheExpiry)
-		self.cache = {}
+		self.pipeline = pipeline
+		self._pipelineFailed = 0
+		self._pipelineRetryAt = None
+		self.skipNoopWrites = skipNoopWrites
+		if retry is None:
+			retry = RetryPolicy()
+		self.retry = retry
+		self.breaker = getBreaker(address)
+		if sharedCache:
+			path = None
+			if sharedCache is not True:
+				path = sharedCache
+			self.cache = SharedCache(address, path, cacheExpiry, cacheSize, cacheStale)
+		else:
+			self.cache = ResponseCache(cacheExpiry, cacheSize, cacheStale)
+		self._refreshing = set()
+		self._refreshLock = threading.Lock()
+		self._inflight = {}
+		self._inflightLock = threading.Lock()
+		self._apiLock = threading.RLock()
+		self._probe = None
+		if transport is None:
+			transport = ConnectionPool(address, poolSize, poolIdle)
+		self.pool = transport
+		self.spacer = getSpacer(address)
+		if metrics is True:
+			metrics = Metrics()
+		self.metrics = metrics or None
+		if self.metrics is not None:
+			self.metrics.addCollector(self)
+		if registry is True:
+			registry = Registry()
+		elif registry and not isinstance(registry, Registry):
+			registry = Registry(registry)
+		self.registry = registry or None
+		self._api = None
+		self._detectFailed = None
 		if logger is None:
 			if logLevel is None:
 				logLevel = logging.WARNING
@@ -89,168 +340,533 @@ class TStat:
 			self.logger = logging.getLogger('TStat')
 		else:
 			self.logger = logger
+		if api is not None:
+			self._useAPI(api)
+
+	def _useAPI(self, api):
+		"""Used internally to switch to api and apply its cache TTLs."""
+		self._api = api
+		if api is not None:
+			for location, ttl in api.cacheTTLs.items():
+				self.cache.ttls.setdefault(location, ttl)
+
+	def _knownAPI(self):
+		"""Used internally to look up the API for this tstat in the registry."""
+		if self.registry is None:
+			return None
+		record = self.registry.get(self.address, self.registryMaxAge)
+		if record is None or not record.has_key('model'):
+			return None
+		return getAPI(record['model'])
+
+	def _detected(self, model):
+		"""Used internally to pick (and remember) the API for model.
+
+		Returns None if the tstat could not be reached, so that detection 
+		is tried again, but not for detectRetry seconds."""
+		if model is None:
+			self.logger.error("Unable to retrieve model of %s" % self.address)
+			self._detectFailed = monotonic()
+			return None
+		self._detectFailed = None
+		api = getAPI(model)
 		if api is None:
-			self.api = API()
-			self.api = getAPI(self.getModel())
-			time.sleep(2)
-		else:
-			self.api = api
+			self.logger.error("Unsupported model '%s' at %s" % (model, self.address))
+			return API()
+		if self.registry is not None:
+			try:
+				self.registry.update(self.address, model=model)
+			except (IOError, OSError), e:
+				self.logger.warning("Unable to save registry: %s" % e)
+		return api
+
+	def _detect(self):
+		"""Used internally to determine the tstat's API on first use."""
+		api = self._knownAPI()
+		if api is None:
+			# The base API knows just enough to ask for the model
+			self._probe = API()
+			self._api = self._probe
+			try:
+				api = self._detected(self.getModel())
+			finally:
+				self._probe = None
+			if api is None:
+				self._api = None
+				return API()
+		self._useAPI(api)
+		return api
+
+	def _detectPending(self):
+		"""Used internally to decide whether a failed detection is too recent to try again."""
+		failed = self._detectFailed
+		return failed is not None and monotonic() - failed < self.detectRetry
+
+	def _getAPI(self):
+		api = self._api
+		if api is None or api is self._probe:
+			# Other threads wait here while one thread detects the API
+			self._apiLock.acquire()
+			try:
+				if self._api is None:
+					if self._detectPending():
+						# The base API answers everything else with None
+						return API()
+					return self._detect()
+				return self._api
+			finally:
+				self._apiLock.release()
+		return api
+
+	api = property(_getAPI, _useAPI)
 
 	def setCacheExpiry(self, newExpiry):
-		self.cacheExpiry = datetime.timedelta(seconds=newExpiry)
+		self.cache.ttl = newExpiry
 
 	def _getConn(self):
 		"""Used internally to get a connection to the tstat."""
-		return httplib.HTTPConnection(self.address)
+		return self.pool.acquire()
+
+	def _request(self, method, location, body=None, headers=None, timeouts=None, call=None):
+		"""Used internally to perform one request on a pooled connection.
+
+		Returns a (status, data) tuple.  A request that fails on a reused 
+		connection is retried once on a fresh one, since the thermostat may 
+		have dropped the keep-alive socket without us noticing.  timeouts 
+		is a (connect, read) tuple in seconds.  With call (a RetryState), 
+		waiting for the spacer and the timeouts all come out of its 
+		deadline."""
+		headers = dict(headers or {})
+		headers["Connection"] = "keep-alive"
+		if timeouts is None:
+			timeouts = (self.retry.connectTimeout, self.retry.readTimeout)
+		for attempt in range(2):
+			if call is not None:
+				self.spacer.wait(max(call.remaining(), 0))
+				timeouts = call.timeouts()
+			else:
+				self.spacer.wait()
+			started = monotonic()
+			conn = self._getConn()
+			reused = conn.sock is not None
+			try:
+				if conn.sock is None:
+					conn.timeout = timeouts[0]
+					conn.connect()
+				conn.sock.settimeout(timeouts[1])
+				conn.request(method, location, body, headers)
+				response = conn.getresponse()
+				data = response.read()
+			except (socket.error, httplib.HTTPException):
+				self.pool.discard(conn)
+				if self.metrics is not None:
+					self._measure(method, location, started, None)
+				if reused and attempt == 0:
+					continue
+				self.spacer.record(False)
+				raise
+			self.pool.release(conn)
+			if self.metrics is not None:
+				self._measure(method, location, started, (response.status, data))
+			self.spacer.record(response.status < 500)
+			return (response.status, data)
+
+	def _measure(self, method, location, started, response):
+		"""Used internally to record one request (started at monotonic() time started) in self.metrics."""
+		m = self.metrics
+		labels = (('address', self.address), ('method', method), ('location', location))
+		m.observe('tstat_request_seconds', labels, monotonic() - started)
+		status = 'error'
+		if response is not None:
+			status = str(response[0])
+			m.inc('tstat_response_bytes_total', labels, len(response[1]))
+		m.inc('tstat_requests_total', labels + (('status', status),))
+
+	def collectMetrics(self):
+		"""Returns this tstat's cache counters as (name, labels, value) samples (see Metrics.py)."""
+		stats = self.cache.stats()
+		labels = (('address', self.address),)
+		samples = [('tstat_cache_%s_total' % name, labels, stats[name]) for name in ('hits', 'stale', 'misses', 'expired', 'evictions')]
+		samples.append(('tstat_cache_entries', labels, stats['entries']))
+		return samples
+
+	def close(self):
+		"""Closes any pooled connections to the tstat."""
+		self.pool.close()
+
+	def _fetch(self, method, location, body=None, headers=None):
+		"""Used internally to perform a request under the retry policy.
+
+		Returns the last (status, data) tuple, or None if the tstat never 
+		answered (or is known to be offline)."""
+		l = self.logger
+		if not self.breaker.allow():
+			l.warning("%s is not responding; skipping %s %s" % (self.address, method, location))
+			if self.metrics is not None:
+				self.metrics.inc('tstat_breaker_rejections_total', (('address', self.address),))
+			return None
+		call = self.retry.begin()
+		while True:
+			try:
+				response = self._request(method, location, body, headers, call=call)
+			except (socket.error, httplib.HTTPException), e:
+				l.debug("%s %s failed: %s" % (method, location, e))
+				response = None
+			status = None
+			if response is not None:
+				status = response[0]
+			if not self.retry.retryable(status):
+				break
+			delay = call.next()
+			if delay is None:
+				break
+			l.debug("Retrying %s %s in %.1fs" % (method, location, delay))
+			if self.metrics is not None:
+				self.metrics.inc('tstat_retries_total', (('address', self.address), ('method', method), ('location', location)))
+			time.sleep(delay)
+		if self.retry.retryable(status):
+			self.breaker.failure()
+		else:
+			self.breaker.success()
+		return response
 
-	def _post(self, key, value):
-		"""Used internally to modify tstat settings (e.g. cloud mode)."""
+	def _entry(self, key, setting=False):
+		"""Used internally to look up the API entry for key.
 
+		Returns None (after logging why) if key cannot be retrieved, or set 
+		if setting is True."""
 		l = self.logger
 
 		# Check for valid request
 		if not self.api.has_key(key):
-			l.error("%s does not exist in API" % key)
-			return False
+			if setting:
+				l.error("%s does not exist in API" % key)
+			else:
+				#TODO: Error processing
+				l.debug("%s does not exist in API" % key)
+			return None
 
 		# Retrieve the mapping from api key to thermostat URL
 		entry = self.api[key]
 		l.debug("Got API entry: %s" % entry)
 
-		try:
-			if len(entry.setters) < 1:
-				raise TypeError
-		except TypeError:
-			l.error("%s cannot be set (maybe readonly?)" % key)
+		if setting:
+			try:
+				if len(entry.setters) < 1:
+					raise TypeError
+			except TypeError:
+				l.error("%s cannot be set (maybe readonly?)" % key)
+				return None
+		return entry
+
+	def _toRaw(self, key, entry, value):
+		"""Used internally to map a human-readable value back to the tstat's value."""
+		if entry.valueMap is not None:
+			inverse = entry.inverse
+			try:
+				if inverse.has_key(value):
+					return inverse[value]
+				if entry.valueMap.has_key(value):
+					return value
+			except TypeError:
+				pass
+			self.logger.warning("Value '%s' may not be a valid value for '%s'" % (value, key))
+		return value
+
+	def _encode(self, entry, setter, value):
+		"""Used internally to build the POST body for a setter."""
+		if entry.usesJson:
+			return dumps({setter[1]: value})
+		return urllib.urlencode({setter[1]: value})
+
+	def _checkSet(self, location, params, response):
+		"""Used internally to check the tstat's answer to a POST.
+
+		Returns True if the tstat reported success, False if it answered 
+		with anything else, or None if there was no usable answer (so the 
+		next setter should be tried)."""
+		l = self.logger
+		if response is None:
+			l.error("No response while trying to set '%s' with '%s'" % (location, params))
+			return None
+		status, data = response
+		if status != 200:
+			l.error("Error %s while trying to set '%s' with '%s'" % (status, location, params))
+			return None
+
+		success = False
+		for s in self.api.successStrings:
+			if data.startswith(s):
+				success = True
+				break
+
+		if not success:
+			l.error("Error trying to set '%s' with '%s': %s" % (location, params, data))
+		l.debug("Response: %s" % data)
+		return success
+
+	def _post(self, key, value):
+		"""Used internally to modify tstat settings (e.g. cloud mode)."""
+
+		l = self.logger
+
+		entry = self._entry(key, setting=True)
+		if entry is None:
 			return False
 
 		# Check for valid values
-		if entry.valueMap is not None:
-			inverse = dict((v,k) for k, v in entry.valueMap.iteritems())
-			if not inverse.has_key(value) and not entry.valueMap.has_key(value):
-				l.warning("Value '%s' may not be a valid value for '%s'" % (value, key))
-			elif inverse.has_key(value):
-				value = inverse[value]
+		value = self._toRaw(key, entry, value)
+
+		if self._isNoop(key, entry, value):
+			return True
 
 		for setter in entry.setters:
 			location = setter[0]
-			jsonKey = setter[1]
-			if entry.usesJson:
-				params = dumps({jsonKey: value})
-			else:
-				params = urllib.urlencode({jsonKey: value})
+			params = self._encode(entry, setter, value)
 			l.debug("Will send params: %s" % params)
 
-			headers = {"Content-type": "application/x-www-form-urlencoded", "Accept": "text/plain"}
-			response = None
-			count = 0
-			while response is None and count < 5:
-				try:
-					conn = self._getConn()
-					conn.request("POST", location, params, headers)
-					response = conn.getresponse()
-				except socket.error:
-					response = None
-				if response is None:
-					time.sleep(count*random.randint(0, 3))
-				count = count + 1
-			if response.status != 200:
-				l.error("Error %s while trying to set '%s' with '%s'" % (response.status, location, params))
-				continue
-			data = response.read()
-			response.close()
+			response = self._fetch("POST", location, params, self.postHeaders)
+			result = self._checkSet(location, params, response)
+			self._written(entry, value, result)
+			if result is not None:
+				# Historically any answer counts, even without a success string
+				return True
 
-			success = False
-			for s in self.api.successStrings:
-				if data.startswith(s):
-					success = True
-					break
+	def _isNoop(self, key, entry, value):
+		"""Used internally to decide whether writing (raw) value can be skipped.
 
-			if not success:
-				l.error("Error trying to set '%s' with '%s': %s" % (location, params, data))
-			l.debug("Response: %s" % data)
+		Only applies with skipNoopWrites, and only if fresh cached data 
+		already shows value."""
+		if not self.skipNoopWrites or not entry.getters:
+			return False
+		locations = [getter[0] for getter in entry.getters]
+		location, cacheEntry, fresh = self.cache.lookup(locations, entry.ttl)
+		if not fresh:
+			return False
+		current = self._extract(entry, self._getter(entry, location), cacheEntry.data, raw=True)
+		if current == value:
+			self.logger.debug("Skipping write of %s=%s (already set)" % (key, value))
 			return True
+		return False
 
-	def _get(self, key, raw=False):
-		"""Used internally to retrieve data from the tstat and process it with JSON if necessary."""
+	def _written(self, entry, value, result):
+		"""Used internally to keep the cache coherent after writing (raw) value.
+
+		On success, every cached response that exposes the key is updated 
+		in place; otherwise they are dropped, since the tstat's state is 
+		unknown."""
+		for getter in entry.getters:
+			if result:
+				self.cache.patch(getter[0], getter[1], value)
+			else:
+				self.cache.invalidate(getter[0])
+
+	def _setGroups(self, pending):
+		"""Used internally to merge pending writes into one POST per setter location.
+
+		pending maps key -> (entry, raw value, setters not yet tried).  The 
+		next setter of every key is used up.  JSON values for the same 
+		location share one body; other values get a POST each.  Returns a 
+		list of (location, body, keys) tuples."""
+		groups = {}
+		order = []
+		for key in sorted(pending):
+			entry, value, setters = pending[key]
+			if not setters:
+				continue
+			setter = setters.pop(0)
+			if entry.usesJson:
+				group = (setter[0], None)
+			else:
+				group = (setter[0], key)
+			if not groups.has_key(group):
+				groups[group] = []
+				order.append(group)
+			groups[group].append((key, entry, setter, value))
+
+		requests = []
+		for group in order:
+			members = groups[group]
+			if group[1] is None:
+				body = dumps(dict([(setter[1], value) for key, entry, setter, value in members]))
+			else:
+				key, entry, setter, value = members[0]
+				body = self._encode(entry, setter, value)
+			requests.append((group[0], body, [m[0] for m in members]))
+		return requests
+
+	def _pendingSets(self, values, results):
+		"""Used internally to validate values for setMany.
+
+		Returns the pending dict used by _setGroups; keys that cannot be set 
+		are recorded as False in results."""
+		pending = {}
+		for key, value in values.items():
+			entry = self._entry(key, setting=True)
+			if entry is None:
+				results[key] = False
+				continue
+			value = self._toRaw(key, entry, value)
+			if self._isNoop(key, entry, value):
+				results[key] = True
+				continue
+			pending[key] = (entry, value, list(entry.setters))
+		return pending
+
+	def setMany(self, values):
+		"""Sets several values at once, sending one POST per setter location.
 
+		values is a dict such as {'t_heat': 68, 'tmode': 'On', 'hold': True}.  
+		Returns a dict mapping each key to True if the tstat reported 
+		success."""
 		l = self.logger
-		l.debug("Requested: %s" % key)
+		results = {}
+		pending = self._pendingSets(values, results)
+		while pending:
+			requests = self._setGroups(pending)
+			if not requests:
+				break
+			for location, body, keys in requests:
+				l.debug("Will send params: %s" % body)
+				response = self._fetch("POST", location, body, self.postHeaders)
+				result = self._checkSet(location, body, response)
+				for key in keys:
+					self._written(pending[key][0], pending[key][1], result)
+				if result is None:
+					# Try the keys' next setters (if any) in the next round
+					continue
+				for key in keys:
+					results[key] = result
+					del pending[key]
+		for key in pending:
+			results[key] = False
+		return results
+
+	def _cached(self, entry):
+		"""Used internally to find the newest usable cached data for entry.
+
+		Returns a (getter, data) tuple, or (None, None) if nothing usable is 
+		cached.  Stale data is returned only within the cache's staleTTL, 
+		and triggers a background refresh."""
+		l = self.logger
+		locations = [getter[0] for getter in entry.getters]
+		location, cacheEntry, fresh = self.cache.lookup(locations, entry.ttl)
+		if location is None:
+			l.debug("No valid cache entry")
+			return (None, None)
+		l.debug("Found cache entry: %s" % cacheEntry)
+		if not fresh:
+			l.debug("Entry is stale, refreshing")
+			self._revalidate(location)
+		return (self._getter(entry, location), cacheEntry.data)
+
+	def _revalidate(self, location):
+		"""Used internally to refresh location in a background thread."""
+		self._refreshLock.acquire()
+		try:
+			if location in self._refreshing:
+				return
+			self._refreshing.add(location)
+		finally:
+			self._refreshLock.release()
 
-		# Check for valid request
-		if not self.api.has_key(key):
-			#TODO: Error processing
-			l.debug("%s does not exist in API" % key)
-			return
+		def refresh():
+			try:
+				self._load(location)
+			finally:
+				self._refreshLock.acquire()
+				self._refreshing.discard(location)
+				self._refreshLock.release()
+		t = threading.Thread(target=refresh, name="TStat-refresh %s%s" % (self.address, location))
+		t.setDaemon(True)
+		t.start()
+
+	def _load(self, location):
+		"""Used internally to retrieve location from the tstat and cache it.
+
+		Returns the decoded JSON or None.  Concurrent callers for the same 
+		location share a single request: the first one retrieves it and the 
+		others wait for its result."""
+		self._inflightLock.acquire()
+		try:
+			flight = self._inflight.get(location)
+			leader = flight is None
+			if leader:
+				flight = _Flight()
+				self._inflight[location] = flight
+		finally:
+			self._inflightLock.release()
+
+		if not leader:
+			self.logger.debug("Waiting for in-flight request for %s" % location)
+			flight.done.wait()
+			return flight.result
 
-		# Retrieve the mapping from api key to thermostat URL
-		entry = self.api[key]
-		l.debug("Got API entry: %s" % entry)
+		try:
+			flight.result = self._loadShared(location)
+		finally:
+			self._inflightLock.acquire()
+			try:
+				del self._inflight[location]
+			finally:
+				self._inflightLock.release()
+			flight.done.set()
+		return flight.result
+
+	def _loadShared(self, location):
+		"""Used internally to retrieve and cache location.
+
+		If another process sharing the cache is already retrieving location, 
+		waits for its result instead."""
+		if not self.cache.claim(location):
+			self.logger.debug("Waiting for another process to retrieve %s" % location)
+			cacheEntry = self.cache.wait(location)
+			if cacheEntry is not None:
+				return cacheEntry.data
+			self.cache.claim(location)
+		try:
+			response = self._parse(location, self._fetch("GET", location))
+			if response is not None:
+				self.cache.put(location, response)
+		finally:
+			self.cache.release(location)
+		return response
 
-		# First check cache
-		newest = None
-		for getter in entry.getters:
-			location = getter[0]
-			jsonKey = getter[1]
-			if self.cache.has_key(location):
-				cacheEntry = self.cache[location]
-				l.debug("Found cache entry: %s" % cacheEntry)
-				if cacheEntry.age() < self.cacheExpiry:
-					l.debug("Entry is valid")
-					try:
-						if cacheEntry.age() < self.cache[newest[0]].age():
-							l.debug("Entry is now newest entry")
-							newest = getter
-					except TypeError:
-						l.debug("Entry is first valid entry")
-						newest = getter
-				else:
-					l.debug("Entry is invalid (expired)")
+	def _parse(self, location, response):
+		"""Used internally to decode the tstat's answer to a GET.
 
-		response = None
-		if newest is not None:
-			# At least one valid entry was found in the cache
-			l.debug("Using cached entry")
-			response = self.cache[newest[0]].data
-		else:
-			for getter in entry.getters:
-				# Either data was not cached or cache was expired
-				response = None
-				count = 0
-				while response is None and count < 5:
-					try:
-						conn = self._getConn()
-						conn.request("GET", getter[0])
-						response = conn.getresponse()
-					except socket.error:
-						response = None
-					if response is None:
-						time.sleep(count*random.randint(0, 10))
-					count = count + 1
-				if response.status != 200:
-					l.warning("Request for '%s' failed (error %s)" % (getter[0], response.status))
-					response = None
-					continue
-				data = response.read()
-				response.close()
-				l.debug("Got response: %s" % data)
-				try:
-					response = loads(data)
-					if 'error_msg' not in response:
-						break
-				except:
-					l.warning("Some problem with response: %s" % data)
-					response = None
-					continue
+		Returns the decoded JSON, or None if location did not supply usable 
+		data (so the next getter should be tried)."""
+		l = self.logger
+		if response is None:
+			l.warning("Request for '%s' failed (no response)" % location)
+			return None
+		status, data = response
+		if status != 200:
+			l.warning("Request for '%s' failed (error %s)" % (location, status))
+			return None
+		l.debug("Got response: %s" % data)
+		try:
+			response = loads(data)
+		except:
+			l.warning("Some problem with response: %s" % data)
+			return None
+		try:
+			if 'error_msg' in response:
+				l.warning("Request for '%s' returned error: %s" % (location, response['error_msg']))
+				return None
+		except TypeError:
+			l.warning("Some problem with response: %s" % data)
+			return None
+		return response
 
-			if response is None:
-				l.error("Unable to retrieve '%s' from any of %s" % (key, entry.getters))
-				return
-			self.cache[getter[0]] = CacheEntry(getter[0], response)
+	def _extract(self, entry, getter, response, raw=False):
+		"""Used internally to pull the value for getter out of a response and map it."""
+		l = self.logger
 
 		# Allow mappings to subdictionaries in json data
 		# e.g. 'today/heat_runtime' from '/tstat/datalog'
-		for key in getter[1].split("/"):
+		for key in entry.paths[getter]:
 			try:
 				response = response[key]
 			except:
@@ -269,6 +885,225 @@ class TStat:
 			l.debug("Didn't find '%s' in %s" % (response, entry.valueMap))
 		return response
 
+	def _get(self, key, raw=False):
+		"""Used internally to retrieve data from the tstat and process it with JSON if necessary."""
+
+		l = self.logger
+		l.debug("Requested: %s" % key)
+
+		entry = self._entry(key)
+		if entry is None:
+			return
+
+		# First check cache
+		getter, response = self._cached(entry)
+		if getter is not None:
+			# At least one valid entry was found in the cache
+			l.debug("Using cached entry")
+		else:
+			for getter in entry.getters:
+				# Either data was not cached or cache was expired
+				response = self._load(getter[0])
+				if response is not None:
+					break
+
+			if response is None:
+				l.error("Unable to retrieve '%s' from any of %s" % (key, entry.getters))
+				return
+
+		return self._extract(entry, getter, response, raw)
+
+	def _canPipeline(self):
+		"""Used internally to decide whether to pipeline requests to this tstat."""
+		if not self.pipeline:
+			return False
+		if self.registry is not None:
+			record = self.registry.get(self.address)
+			if record is not None and record.get('pipelining') is False:
+				self.pipeline = False
+				return False
+		if self._pipelineRetryAt is not None and monotonic() < self._pipelineRetryAt:
+			return False
+		return True
+
+	def _noPipelining(self):
+		"""Used internally to fall back to serial requests for good."""
+		self.logger.warning("%s does not handle pipelined requests; falling back to serial requests" % self.address)
+		self.pipeline = False
+		if self.registry is not None:
+			try:
+				self.registry.update(self.address, pipelining=False)
+			except (IOError, OSError), e:
+				self.logger.warning("Unable to save registry: %s" % e)
+
+	def _pipelinePartial(self):
+		"""Used internally to read serially for a while after a pipelined read ended early."""
+		self._pipelineFailed = self._pipelineFailed + 1
+		if self._pipelineFailed >= self.pipelineFailures:
+			self._noPipelining()
+			return
+		self.logger.info("Pipelined read from %s ended early; reading serially for %d seconds" % (self.address, self.pipelineRetry))
+		self._pipelineRetryAt = monotonic() + self.pipelineRetry
+
+	def _pipelined(self, locations):
+		"""Used internally to GET several locations over one connection.
+
+		All requests are written at once (HTTP/1.1 pipelining) and the 
+		responses read back in order, parsed and cached.  Returns a dict of 
+		location -> decoded JSON for the locations that were answered; the 
+		caller retrieves the rest one by one.  A tstat that answers some 
+		but not all pipelined requests is read serially for pipelineRetry 
+		seconds, and marked as not supporting pipelining after 
+		pipelineFailures such reads in a row or a malformed answer."""
+		l = self.logger
+		conn = self._getConn()
+		if not isinstance(conn, httplib.HTTPConnection):
+			# e.g. a replay transport; only real sockets can be pipelined
+			self.pool.release(conn)
+			return {}
+		if not self.breaker.allow():
+			self.pool.release(conn)
+			return {}
+
+		answers = []
+		closing = False
+		malformed = False
+		self.spacer.wait()
+		started = monotonic()
+		try:
+			if conn.sock is None:
+				conn.timeout = self.retry.connectTimeout
+				conn.connect()
+			conn.sock.settimeout(self.retry.readTimeout)
+			conn.sock.sendall("".join(["GET %s HTTP/1.1\r\nHost: %s\r\nAccept-Encoding: identity\r\nConnection: keep-alive\r\n\r\n" % (location, self.address) for location in locations]))
+			for location in locations:
+				response = httplib.HTTPResponse(conn.sock, method="GET")
+				response.begin()
+				if response.version == 9:
+					# Not a status line (httplib takes it for HTTP/0.9), so 
+					# the answers got mixed up
+					malformed = True
+					break
+				answers.append((location, (response.status, response.read())))
+				if response.will_close:
+					closing = True
+					break
+		except (socket.error, httplib.HTTPException), e:
+			l.debug("Pipelined request for %s failed: %s" % (locations, e))
+
+		if len(answers) == len(locations) and not closing:
+			self.pool.release(conn)
+			self._pipelineFailed = 0
+			self._pipelineRetryAt = None
+		else:
+			self.pool.discard(conn)
+			if malformed and answers:
+				self._noPipelining()
+			elif answers:
+				self._pipelinePartial()
+		self.spacer.record(len(answers) == len(locations))
+		if answers:
+			self.breaker.success()
+		else:
+			self.breaker.failure()
+
+		results = {}
+		for location, response in answers:
+			if self.metrics is not None:
+				self._measure("GET", location, started, response)
+			data = self._parse(location, response)
+			if data is not None:
+				self.cache.put(location, data)
+				results[location] = data
+		return results
+
+	def _cachedLocation(self, location):
+		"""Used internally to return unexpired cached data for location, or None."""
+		cacheEntry = self.cache.get(location)
+		if cacheEntry is not None:
+			return cacheEntry.data
+		return None
+
+	def _plan(self, entries, keys, exclude=()):
+		"""Used internally to choose the fewest getter locations covering keys.
+
+		Greedy set cover: locations that are already cached cost nothing and 
+		are picked first, then whichever location covers the most remaining 
+		keys, preferring locations listed earlier in the getters.  Locations 
+		in exclude are never picked.  Returns a list of (location, keys) 
+		tuples; keys that no location can supply are left out."""
+		uncovered = set(keys)
+		plan = []
+		while uncovered:
+			candidates = {}
+			for key in uncovered:
+				for location, rank in entries[key].ranks.iteritems():
+					if location in exclude:
+						continue
+					covered, rankSum = candidates.get(location, ([], 0))
+					candidates[location] = (covered + [key], rankSum + rank)
+			if not candidates:
+				break
+			def score(location):
+				covered, rankSum = candidates[location]
+				return (self.cache.peek(location) is not None, len(covered), -rankSum)
+			location = max(candidates, key=score)
+			covered = candidates[location][0]
+			plan.append((location, covered))
+			uncovered.difference_update(covered)
+		return plan
+
+	def _getter(self, entry, location):
+		"""Used internally to find the getter in entry that reads from location."""
+		return entry.byLocation.get(location)
+
+	def getMany(self, keys, raw=False):
+		"""Returns a dict of values for keys, retrieving each tstat URL at most once."""
+		l = self.logger
+
+		entries = {}
+		for key in keys:
+			entry = self._entry(key)
+			if entry is not None:
+				entries[key] = entry
+
+		results = {}
+		failed = set()
+		pending = set(entries)
+		while pending:
+			plan = self._plan(entries, pending, failed)
+			if not plan:
+				break
+			responses = {}
+			for location, planKeys in plan:
+				responses[location] = self._cachedLocation(location)
+			missing = [location for location, planKeys in plan if responses[location] is None]
+			if len(missing) > 1 and self._canPipeline():
+				responses.update(self._pipelined(missing))
+			for location, planKeys in plan:
+				response = responses[location]
+				if response is None:
+					response = self._load(location)
+					if response is None:
+						# Replan the keys this location would have supplied
+						failed.add(location)
+						continue
+				for key in planKeys:
+					entry = entries[key]
+					results[key] = self._extract(entry, self._getter(entry, location), response, raw)
+					pending.discard(key)
+
+		for key in keys:
+			if not results.has_key(key):
+				if entries.has_key(key):
+					l.error("Unable to retrieve '%s' from any of %s" % (key, entries[key].getters))
+				results[key] = None
+		return results
+
+	def snapshot(self, raw=False):
+		"""Returns a dict of every readable value, retrieving each tstat URL at most once."""
+		return self.getMany(self.api.readableKeys, raw)
+
 	def getCurrentTemp(self, raw=False):
 		"""Returns current temperature measurement."""
 		return self._get('temp', raw)
@@ -327,7 +1162,8 @@ class TStat:
 
 	def getSetPoints(self, raw=False):
 		"""Returns both heating and cooling set points."""
-		return (self.getHeatPoint(), self.getCoolPoint())
+		values = self.getMany(['t_heat', 't_cool'])
+		return (values['t_heat'], values['t_cool'])
 
 	def getModel(self, raw=False):
 		"""Returns the model of the thermostat."""
@@ -343,7 +1179,7 @@ class TStat:
 
 	def getTime(self, raw=False):
 		"""Returns current time."""
-		return {'day': self._get('day'),  'hour': self._get('hour'),  'minute': self._get('minute')}
+		return self.getMany(['day', 'hour', 'minute'])
 
 	def getHeatUsageToday(self, raw=False):
 		"""Returns heat usage for today."""
@@ -377,41 +1213,263 @@ class TStat:
 		"""Sets cloud mode to state."""
 		return self._post("cloud_mode", value)
 
-def discover():
-	import struct
-	import select
-	import re
+	def getProgram(self, mode):
+		"""Returns the 7-day program for mode ('heat' or 'cool') as a dict of day number (0 is Monday) -> [minute, temp, ...]."""
+		keys = ['program_%s_%s' % (mode, day) for day in PROGRAM_DAYS]
+		values = self.getMany(keys, raw=True)
+		return dict([(i, values[key]) for i, key in enumerate(keys)])
 
-	sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
-	sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, 2)
-	sock.sendto("TYPE: WM-DISCOVER\r\nVERSION: 1.0\r\n\r\nservices: com.marvell.wm.system*\r\n\r\n", ("239.255.255.250", 1900))
+	def setProgram(self, mode, program):
+		"""Sets the days in program (day number -> [minute, temp, ...]) of the 7-day program for mode.
+
+		Every day for one mode is sent in a single request.  Returns a dict
+		of day number -> True/False."""
+		values = dict([('program_%s_%s' % (mode, PROGRAM_DAYS[day]), periods) for day, periods in program.items()])
+		results = self.setMany(values)
+		return dict([(day, results['program_%s_%s' % (mode, PROGRAM_DAYS[day])]) for day in program])
+
+# Day names used in program_<mode>_<day> API keys, Monday first
+PROGRAM_DAYS = ['mon', 'tue', 'wed', 'thu', 'fri', 'sat', 'sun']
 
-	mreq = struct.pack("=4sl", socket.inet_aton("239.255.255.250"), socket.INADDR_ANY)
-	sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, mreq)
+DISCOVER_GROUP = ("239.255.255.250", 1900)
+DISCOVER_MESSAGE = "TYPE: WM-DISCOVER\r\nVERSION: 1.0\r\n\r\nservices: com.marvell.wm.system*\r\n\r\n"
 
-	sock.setblocking(0)
+# How long thermostats found by discovery are remembered (seconds)
+DISCOVERY_MAX_AGE = 7*24*60*60
 
-	ready = select.select([sock], [], [], 30)
-	data = None
-	if ready[0]:
-		data = sock.recv(4096).replace("\r\n", "\n")
+def discoverAll(timeout=30, maxDevices=None, retransmit=(0, 1, 3, 7, 15), registry=True):
+	"""Yields the address of each thermostat that answers a multicast discovery.
+
+	Addresses are yielded as replies arrive, each only once.  The 
+	discovery message is resent at each of the times (in seconds) in 
+	retransmit.  Stops after timeout seconds, or once maxDevices 
+	thermostats have answered.  Every thermostat found is saved in the 
+	registry (pass registry=False to disable)."""
+	import struct
+	import re
 
-	m = re.search("http://([0-9]+\.[0-9]+\.[0-9]+\.[0-9]+)/(.*?)$", data, re.MULTILINE)
+	if registry is True:
+		registry = Registry()
+	elif registry and not isinstance(registry, Registry):
+		registry = Registry(registry)
 
+	sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
 	try:
-		return m.group(1)
-	except:
-		raise ValueError, "Didn't find any thermostats on the local network"
+		sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, 2)
+		mreq = struct.pack("=4sl", socket.inet_aton(DISCOVER_GROUP[0]), socket.INADDR_ANY)
+		try:
+			sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, mreq)
+		except socket.error:
+			# Replies are normally unicast to us anyway
+			pass
+		sock.setblocking(0)
+
+		pattern = re.compile("http://([0-9]+\.[0-9]+\.[0-9]+\.[0-9]+)/(.*?)$", re.MULTILINE)
+		schedule = sorted(retransmit)
+		started = monotonic()
+		found = set()
+		while True:
+			elapsed = monotonic() - started
+			if elapsed >= timeout:
+				return
+			while schedule and schedule[0] <= elapsed:
+				schedule.pop(0)
+				sock.sendto(DISCOVER_MESSAGE, DISCOVER_GROUP)
+			wait = timeout - elapsed
+			if schedule:
+				wait = min(wait, schedule[0] - elapsed)
+			if not select.select([sock], [], [], max(wait, 0))[0]:
+				continue
+			try:
+				data = sock.recv(4096).replace("\r\n", "\n")
+			except socket.error:
+				continue
+			m = pattern.search(data)
+			if m is None or m.group(1) in found:
+				continue
+			address = m.group(1)
+			found.add(address)
+			if registry:
+				try:
+					registry.update(address, discovered=m.group(2))
+				except (IOError, OSError):
+					pass
+			yield address
+			if maxDevices is not None and len(found) >= maxDevices:
+				return
+	finally:
+		sock.close()
+
+def knownThermostats(registry=True, maxAge=DISCOVERY_MAX_AGE):
+	"""Returns addresses of thermostats found by recent discoveries (from the registry).
+
+	Returns an empty list if registry is False or None."""
+	if not registry:
+		return []
+	if registry is True:
+		registry = Registry()
+	elif not isinstance(registry, Registry):
+		registry = Registry(registry)
+	return registry.addresses(maxAge, 'discovered')
+
+def discover(timeout=30, registry=True, refresh=False):
+	"""Returns the address of a thermostat on the local network.
+
+	A thermostat remembered from a recent discovery is returned without 
+	sending anything, unless refresh is True or registry is False."""
+	if registry and not refresh:
+		known = knownThermostats(registry)
+		if known:
+			return sorted(known)[0]
+	for address in discoverAll(timeout, 1, registry=registry):
+		return address
+	raise ValueError, "Didn't find any thermostats on the local network"
+
+def _row(address, values, error):
+	"""Used internally to build one output record for main()."""
+	row = {'address': address, 'time': time.time()}
+	if error is not None:
+		row['error'] = str(error)
+	else:
+		row.update(values)
+	return row
+
+def _csvRows(out, writer, columns, rows):
+	"""Used internally to write rows for main() as CSV, starting with a header if writer is None.
+
+	Returns the writer."""
+	import csv
+	if writer is None:
+		writer = csv.DictWriter(out, columns + ['error'], extrasaction='ignore')
+		writer.writerow(dict([(c, c) for c in columns + ['error']]))
+	for row in rows:
+		for key, value in row.items():
+			if isinstance(value, (dict, list)):
+				row[key] = dumps(value)
+		writer.writerow(row)
+	return writer
 
 def main():
+	"""Command line interface; run with --help for usage."""
+	import inspect
+	import optparse
 	import sys
-	addr = discover()
-
-	t = TStat(addr, api=API_CT50v109())
-	for cmd in sys.argv[1:]:
-		result = eval("t.%s(raw=True)" % cmd)
-		#print "%s: %s" % (cmd, result)
-		print result
+	from TStatFleet import TStatFleet
+
+	parser = optparse.OptionParser(usage="%prog [options] [key|method ...]",
+		description="Reads keys (e.g. temp tstate t_heat) or getter methods (e.g. getCurrentTemp) "
+			"from many thermostats at once.  With no keys, every readable value is read.  "
+			"Each device's keys are fetched in one pass, devices are read in parallel, and "
+			"one record per device is written as soon as it is ready.")
+	parser.add_option("-a", "--address", action="append", dest="addresses", default=[],
+		help="thermostat address (may be repeated); default is every thermostat in the registry, "
+			"or discovery if the registry is empty")
+	parser.add_option("-d", "--discover", action="store_true", default=False,
+		help="find thermostats with multicast discovery instead of using the registry")
+	parser.add_option("-t", "--timeout", type="float", default=10,
+		help="discovery timeout in seconds (default %default)")
+	parser.add_option("-f", "--format", choices=["json", "csv"], default="json",
+		help="output format: json (one object per line) or csv (default %default)")
+	parser.add_option("-m", "--mapped", action="store_true", default=False,
+		help="translate values through the API value maps (e.g. 'On' rather than 1)")
+	parser.add_option("-w", "--watch", type="float", metavar="SECONDS",
+		help="read again every SECONDS seconds until interrupted")
+	parser.add_option("-j", "--jobs", type="int", default=16,
+		help="devices read in parallel (default %default)")
+	options, args = parser.parse_args()
+	logging.basicConfig(level=logging.ERROR, format="%(name)s: %(message)s")
+
+	addresses = options.addresses
+	if not addresses:
+		if not options.discover:
+			addresses = knownThermostats()
+		if not addresses:
+			addresses = list(discoverAll(options.timeout))
+	if not addresses:
+		parser.error("no thermostats found; use --address or --discover")
+
+	raw = not options.mapped
+	keys = [arg for arg in args if not hasattr(TStat, arg)]
+	methods = [arg for arg in args if hasattr(TStat, arg)]
+	# Getter method -> whether it takes raw
+	takesRaw = {}
+	for method in methods:
+		func = getattr(TStat, method)
+		if not (method.startswith('get') or method.startswith('is')) or not callable(func):
+			parser.error("%s is not a getter method" % method)
+		takesRaw[method] = 'raw' in inspect.getargspec(func)[0]
+
+	def read(tstat):
+		if keys or not methods:
+			if keys:
+				values = tstat.getMany(keys, raw)
+			else:
+				values = tstat.snapshot(raw)
+		else:
+			values = {}
+		answered = [v for v in values.values() if v is not None]
+		for method in methods:
+			try:
+				if takesRaw[method]:
+					values[method] = getattr(tstat, method)(raw=raw)
+				else:
+					values[method] = getattr(tstat, method)()
+			except Exception, e:
+				# Keep the rest of the record
+				values[method] = {'error': str(e)}
+				continue
+			if values[method] is not None:
+				answered.append(values[method])
+		if values and not answered:
+			raise IOError("No answer from %s" % tstat.address)
+		return values
+
+	out = sys.stdout
+	writer = None
+	if options.format == "csv":
+		columns = ['address', 'time'] + keys + methods
+		if not args:
+			columns = None
+	fleet = TStatFleet(addresses, workers=options.jobs)
+	failed = False
+	try:
+		while True:
+			started = time.time()
+			# CSV rows of failed devices, held until the columns are known
+			held = []
+			for address, values, error in fleet.imap(read):
+				failed = failed or error is not None
+				row = _row(address, values, error)
+				if options.format == "json":
+					out.write(dumps(row) + "\n")
+				else:
+					if columns is None:
+						if error is not None:
+							held.append(row)
+							continue
+						columns = ['address', 'time'] + sorted([k for k in row if k not in ('address', 'time', 'error')])
+					writer = _csvRows(out, writer, columns, held + [row])
+					held = []
+				out.flush()
+			if held:
+				if columns is None:
+					# Nothing answered; use every key any supported model can read
+					keys = set()
+					for api in set(modelIndex.values()):
+						keys.update(api.readableKeys)
+					columns = ['address', 'time'] + sorted(keys)
+				writer = _csvRows(out, writer, columns, held)
+				out.flush()
+			if options.watch is None:
+				break
+			delay = options.watch - (time.time() - started)
+			if delay > 0:
+				time.sleep(delay)
+	except KeyboardInterrupt:
+		pass
+	fleet.close()
+	if failed and options.watch is None:
+		sys.exit(1)
 
 if __name__ == '__main__':
 	main()
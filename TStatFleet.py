@@ -0,0 +1,223 @@
+#!/usr/bin/env python
+
+#Copyright (c) 2011, Paul Jennings <pjennings-tstat@pjennings.net>
+#All rights reserved.
+
+#Redistribution and use in source and binary forms, with or without
+#modification, are permitted provided that the following conditions are met:
+#
+#    * Redistributions of source code must retain the above copyright notice,
+#      this list of conditions and the following disclaimer.
+#    * Redistributions in binary form must reproduce the above copyright
+#      notice, this list of conditions and the following disclaimer in the
+#      documentation and/or other materials provided with the distribution.
+#    * The names of its contributors may not be used to endorse or promote
+#      products derived from this software without specific prior written
+#      permission.
+
+#THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+#AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+#IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+#ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+#LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+#CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+#SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+#INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+#CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+#ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF
+#THE POSSIBILITY OF SUCH DAMAGE.
+
+# TStatFleet.py
+# Concurrent access to many Radio Thermostat devices at once.
+
+# Usage:
+# fleet = TStatFleet(['10.0.0.5', '10.0.0.6', ...], workers=32)
+# for address, temp, error in fleet.imap('getCurrentTemp'):
+#     ...                      # Results arrive in completion order
+# results, errors = fleet.gather('setHeatPoint', 68)
+# fleet.close()
+#
+# Each address gets its own TStat instance (created on first use, inside a
+# worker thread) so caching and connection pooling work per device as usual.
+# A fixed pool of worker threads runs the calls.  At most perDevice calls are
+# in flight against any one thermostat; further calls for that device wait
+# in a per-device queue without tying up a worker, so total wall-clock time
+# depends on the worker count rather than the number of devices.
+#
+# With metrics=True, every device records into one shared Metrics
+# (fleet.metrics); fleet.metrics.snapshot(without=('address',)) totals it.
+
+import logging
+import Queue
+import sys
+import threading
+
+from collections import deque
+
+from Metrics import Metrics
+from TStat import TStat
+
+class _Task:
+	def __init__(self, address, func, args, kwargs, results):
+		self.address = address
+		self.func = func
+		self.args = args
+		self.kwargs = kwargs
+		self.results = results
+
+class TStatFleet:
+	def __init__(self, addresses, workers=16, perDevice=1, logger=None, **tstatArgs):
+		self.addresses = list(addresses)
+		self.workers = workers
+		self.perDevice = perDevice
+		self.tstatArgs = tstatArgs
+		if logger is None:
+			logger = logging.getLogger('TStatFleet')
+		self.logger = logger
+		self.tstatArgs.setdefault('logger', logger)
+		# One Metrics for the whole fleet, so it can be totalled across devices
+		if self.tstatArgs.get('metrics') is True:
+			self.tstatArgs['metrics'] = Metrics()
+		self.metrics = self.tstatArgs.get('metrics')
+
+		self._tstats = {}
+		self._lock = threading.Lock()
+		self._ready = Queue.Queue()
+		self._waiting = {}
+		self._inflight = {}
+		self._threads = []
+
+	def _start(self):
+		"""Used internally to start worker threads on first use."""
+		while len(self._threads) < self.workers:
+			t = threading.Thread(target=self._work, name="TStatFleet-%d" % len(self._threads))
+			t.setDaemon(True)
+			t.start()
+			self._threads.append(t)
+
+	def getTStat(self, address):
+		"""Returns the TStat instance for address, creating it if necessary."""
+		self._lock.acquire()
+		try:
+			tstat = self._tstats.get(address)
+		finally:
+			self._lock.release()
+		if tstat is not None:
+			return tstat
+
+		# Construction may talk to the thermostat, so do it outside the lock
+		tstat = TStat(address, **self.tstatArgs)
+		self._lock.acquire()
+		try:
+			return self._tstats.setdefault(address, tstat)
+		finally:
+			self._lock.release()
+
+	def _submit(self, task):
+		"""Used internally to queue a task, honoring the per-device limit."""
+		self._lock.acquire()
+		try:
+			if self._inflight.get(task.address, 0) < self.perDevice:
+				self._inflight[task.address] = self._inflight.get(task.address, 0) + 1
+				self._ready.put(task)
+			else:
+				self._waiting.setdefault(task.address, deque()).append(task)
+		finally:
+			self._lock.release()
+
+	def _done(self, address):
+		"""Used internally to release a device slot and start its next task."""
+		self._lock.acquire()
+		try:
+			waiting = self._waiting.get(address)
+			if waiting:
+				self._ready.put(waiting.popleft())
+				return
+			if waiting is not None:
+				del self._waiting[address]
+			self._inflight[address] = self._inflight[address] - 1
+			if self._inflight[address] == 0:
+				del self._inflight[address]
+		finally:
+			self._lock.release()
+
+	def _work(self):
+		"""Worker thread main loop."""
+		while True:
+			task = self._ready.get()
+			if task is None:
+				return
+			result = None
+			error = None
+			try:
+				tstat = self.getTStat(task.address)
+				if callable(task.func):
+					result = task.func(tstat, *task.args, **task.kwargs)
+				else:
+					result = getattr(tstat, task.func)(*task.args, **task.kwargs)
+			except Exception, e:
+				self.logger.warning("Call %s on %s failed: %s" % (task.func, task.address, e))
+				error = e
+			self._done(task.address)
+			task.results.put((task.address, result, error))
+
+	def imap(self, method, *args, **kwargs):
+		"""Runs method on every device and yields (address, result, error) as each completes.
+
+		method is either the name of a TStat method (e.g. 'getCurrentTemp')
+		or a callable that takes a TStat as its first argument.  Pass
+		addresses=[...] to run against a subset of the fleet.  error is the
+		exception raised by the call, or None."""
+		addresses = kwargs.pop('addresses', None)
+		if addresses is None:
+			addresses = self.addresses
+		self._start()
+		results = Queue.Queue()
+		for address in addresses:
+			self._submit(_Task(address, method, args, kwargs, results))
+		for i in range(len(addresses)):
+			# A timeout keeps the wait interruptible with Ctrl-C
+			while True:
+				try:
+					yield results.get(True, 3600)
+					break
+				except Queue.Empty:
+					pass
+
+	def gather(self, method, *args, **kwargs):
+		"""Runs method on every device and returns (results, errors) dicts keyed by address."""
+		results = {}
+		errors = {}
+		for address, result, error in self.imap(method, *args, **kwargs):
+			if error is None:
+				results[address] = result
+			else:
+				errors[address] = error
+		return (results, errors)
+
+	def close(self):
+		"""Stops worker threads and closes connections to every device."""
+		for t in self._threads:
+			self._ready.put(None)
+		for t in self._threads:
+			t.join()
+		self._threads = []
+		self._lock.acquire()
+		try:
+			tstats = self._tstats.values()
+		finally:
+			self._lock.release()
+		for tstat in tstats:
+			tstat.close()
+
+def main():
+	fleet = TStatFleet(sys.argv[2:])
+	for address, result, error in fleet.imap(sys.argv[1], raw=True):
+		if error is None:
+			print "%s: %s" % (address, result)
+		else:
+			print "%s: ERROR %s" % (address, error)
+	fleet.close()
+
+if __name__ == '__main__':
+	main()
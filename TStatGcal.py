@@ -33,7 +33,7 @@ VERSION = 1.0
 # Script to pull commands from Google Calendar and update thermostat.
 #
 # Requirements:
-# * gdata (http://code.google.com/p/gdata-python-client/)
+# * gdata (http://code.google.com/p/gdata-python-client/), for Google Calendar
 # * ElementTree (http://effbot.org/zone/element-index.htm)
 # * Python-TStat (same place you got this script)
 #
@@ -94,6 +94,47 @@ VERSION = 1.0
 #	 6:30-22:00 and an overlapping "Heat 60" event that lasts from 
 #	 8:00-16:00, you will effectively miss the "Heat 70" command at 
 #	 16:00.	 Only the start time of the event is used.	
+#
+#	 Events titled with one of PERIODS (Wake, Leave, Home, Sleep) are 
+#	 translated through ~/.tstat_commands (lines like "Wake:Heat 70") 
+#	 and compiled into the thermostat's own 7-day heat/cool program, 
+#	 clamped to HEAT_MIN/HEAT_MAX and COOL_MIN/COOL_MAX.  Only days that 
+#	 differ from the program already on the thermostat are uploaded.  
+#	 The thermostat then follows the weekly schedule by itself, so the 
+#	 script only has to run when the calendar changes or for one-off 
+#	 events.
+#
+#	 Instead of cron, the script can run as a daemon:
+#	   TStatGcal.py --daemon [--refresh=900] <thermostat_address> <calendar_name>
+#	 It stays logged in and connected to the thermostat, sends each 
+#	 command at the start time of its event, and checks the calendar 
+#	 for changes every 900 seconds (--refresh) in the background.
+#
+#	 Many thermostats can be driven from one run with a zone map file, 
+#	 with lines like:
+#	   Upstairs:10.0.0.5,10.0.0.6
+#	   #basement:10.0.0.7
+#	 and:
+#	   TStatGcal.py --zones=<zone_file> [--jobs=8] [<calendar_name>]
+#	 A zone named after a calendar follows that calendar's untagged 
+#	 events; a zone named #tag follows events titled like 
+#	 "#tag Heat 70" in <calendar_name> (default Thermostat).  Each 
+#	 calendar is downloaded once with a single login, and all of the 
+#	 thermostats are updated in parallel (at most --jobs at a time), 
+#	 with one line of results per thermostat.
+#
+#	 Instead of Google Calendar, events can come from a local iCalendar 
+#	 file (see ICalendar.py):
+#	   TStatGcal.py --ics=<file.ics> <thermostat_address>
+#	 Any other calendar source can be passed to main() or 
+#	 CalendarDaemon as source: an object with a name and a 
+#	 sync(schedule) method that brings a Schedule up to date and returns 
+#	 False if the calendar does not exist.
+#
+#	 Events are kept in a local schedule file (~/.tstat/schedule-<calendar_name>.json, 
+#	 see Schedule.py) along with the Google login token.  After the first 
+#	 run, only events changed since the previous run are downloaded, so 
+#	 a run where nothing changed costs one small calendar query.
 
 # Minimum and maximum values for heat and cool
 # The script will never set values outside of this range
@@ -115,188 +156,624 @@ try:
   from xml.etree import ElementTree # for Python 2.5 users
 except ImportError:
   from elementtree import ElementTree
-import gdata.calendar.service
-import gdata.service
-import atom.service
-import gdata.calendar
+try:
+	import gdata.calendar.service
+	import gdata.service
+	import atom.service
+	import gdata.calendar
+	import atom
+except ImportError:
+	# Only needed for GoogleCalendar
+	gdata = None
 
-import atom
 import datetime
 import getopt
+import heapq
 import os
 import sys
 import string
+import threading
 import time
 
+import Schedule
 import TStat
 
-def getCalendarService(username, password):
-	# Log in to Google
+from ICalendar import ICSCalendar
+
+from Schedule import formatTime, parseTime
+
+def getCalendarService(username, password, token=None):
+	"""Returns a calendar service, reusing a saved login token if given."""
 	calendar_service = gdata.calendar.service.CalendarService()
 	calendar_service.email = username
 	calendar_service.password = password
 	calendar_service.source = "TStatGCal-%s" % VERSION
-	calendar_service.ProgrammaticLogin()
+	if token is not None:
+		calendar_service.SetClientLoginToken(token)
+	else:
+		# Log in to Google
+		calendar_service.ProgrammaticLogin()
 	return calendar_service
 
-def main(tstatAddr, commandMap=None, username=None, password=None, calName="Thermostat"):
-	# Connect to thermostat
-	tstat = TStat.TStat(tstatAddr)
+def findCalendar(calendar_service, calName):
+	"""Returns the event feed URL of the calendar called calName, or None."""
+	feed = calendar_service.GetOwnCalendarsFeed()
+	for a_calendar in feed.entry:
+		if a_calendar.title.text == calName:
+			return a_calendar.content.src
+	return None
 
+def _fetchEvents(calendar_service, schedule, feedURL, start, end, updatedMin=None):
+	"""Used internally to copy events starting in [start, end) into schedule.
+
+	Only the starts of each event inside [start, end) are replaced, so 
+	ranges can be fetched separately.  With updatedMin, only events 
+	changed since then (including deletions) are fetched.  Returns the 
+	number of events received."""
+	query = gdata.calendar.service.CalendarEventQuery()
+	query.feed = feedURL
+	query.start_min = formatTime(start)
+	query.start_max = formatTime(end)
+	query.max_results = "500"
+	if updatedMin is not None:
+		query.updated_min = updatedMin
+		query['showdeleted'] = 'true'
+
+	count = 0
+	feed = calendar_service.CalendarQuery(query)
+	while feed is not None:
+		for an_event in feed.entry:
+			count = count + 1
+			uid = an_event.id.text
+			if an_event.event_status is not None and an_event.event_status.value.endswith('canceled'):
+				schedule.remove(uid)
+				continue
+			starts = [parseTime(a_when.start_time) for a_when in an_event.when]
+			old = schedule.events.get(uid)
+			if old is not None:
+				starts = [t for t in old['starts'] if t < start or t >= end] + starts
+			schedule.update(uid, an_event.title.text.strip(), starts)
+		next = feed.GetNextLink()
+		feed = None
+		if next is not None:
+			feed = calendar_service.GetCalendarEventFeed(next.href)
+	return count
+
+def syncCalendar(calendar_service, schedule, calName, days=8):
+	"""Brings schedule up to date with the calendar called calName.
+
+	The first sync downloads every event from the start of today to days 
+	days ahead.  Later syncs only ask for events updated since the last 
+	sync (usually an empty answer), plus any whole days that have come 
+	into the window since.  Returns False if there is no calendar called 
+	calName."""
+	state = schedule.state
+	if state.get('calendar') != calName or not state.get('feed'):
+		feedURL = findCalendar(calendar_service, calName)
+		if feedURL is None:
+			return False
+		token = state.get('token')
+		schedule.clear()
+		state['calendar'] = calName
+		state['feed'] = feedURL
+		if token is not None:
+			state['token'] = token
+
+	now = time.time()
+	today = time.mktime(datetime.date.today().timetuple())
+	end = today + days * 24 * 60 * 60
+	if not state.has_key('updated'):
+		n = _fetchEvents(calendar_service, schedule, state['feed'], today, end)
+		print "Downloaded %d events" % n
+	else:
+		n = _fetchEvents(calendar_service, schedule, state['feed'], today, state['windowEnd'], state['updated'])
+		print "%d events changed since %s" % (n, state['updated'])
+		if end > state['windowEnd']:
+			n = _fetchEvents(calendar_service, schedule, state['feed'], state['windowEnd'], end)
+			print "Downloaded %d events for new days" % n
+	# Overlap the next delta a little, in case our clock is ahead of Google's
+	state['updated'] = formatTime(now - 5 * 60)
+	state['windowEnd'] = max(end, state.get('windowEnd', end))
+	schedule.prune(today - days * 24 * 60 * 60)
+	return True
+
+def splitTag(text):
+	"""Splits an event title like "#upstairs Heat 70" into ('upstairs', 'Heat 70'); untagged titles give (None, text)."""
+	if text.startswith('#'):
+		tag, sep, rest = text[1:].partition(' ')
+		return (tag, rest.strip())
+	return (None, text)
+
+def parseCommand(text, commandMap):
+	"""Translates an event title into a (command, value) tuple, or None if it is not a valid command."""
 	# Command map is used to translate things like "Wake" into "Heat 70"
-	if commandMap is None:
-		commandMap = {}
+	if commandMap.has_key(text):
+		text = commandMap[text]
+	try:
+		(command, value) = text.splitlines()[0].split()
+	except (ValueError, IndexError):
+		# Wrong number of words, or an empty title
+		return None
+	if command not in COMMANDS:
+		return None
+	try:
+		float(value)
+	except ValueError:
+		if value not in ['Off', 'On', 'Auto']:
+			return None
+	return (command, value)
 
-	calendar_service = getCalendarService(username, password)
+def isCommand(text, commandMap):
+	"""Returns True if the event title text is a command to send when it starts.
 
-	# Create date range for event search
-	today = datetime.datetime.today()
-	gmt = time.gmtime()
-	gmtDiff = datetime.datetime(gmt[0], gmt[1], gmt[2], gmt[3], gmt[4]) - today
-	tomorrow = datetime.datetime.today()+datetime.timedelta(days=8)
+	Programmed periods (PERIODS) are left to the thermostat's 7-day 
+	program instead."""
+	return text not in PERIODS and parseCommand(text, commandMap) is not None
 
-	query = gdata.calendar.service.CalendarEventQuery()
-	query.start_min = "%04i-%02i-%02i" % (today.year, today.month, today.day)
-	query.start_max = "%04i-%02i-%02i" % (tomorrow.year, tomorrow.month, tomorrow.day)
-	
-	print "start_min:", query.start_min
-	print "start_max:", query.start_max
+def _clamp(command, value):
+	"""Used internally to keep a program temperature within HEAT_MIN/HEAT_MAX or COOL_MIN/COOL_MAX."""
+	if command == 'Heat':
+		return max(HEAT_MIN, min(HEAT_MAX, value))
+	return max(COOL_MIN, min(COOL_MAX, value))
 
-	# Look for a calendar called calName
-	feed = calendar_service.GetOwnCalendarsFeed()
-	for i, a_calendar in enumerate(feed.entry):
-		if a_calendar.title.text == calName:
-			query.feed = a_calendar.content.src
+def compileProgram(schedule, commandMap, start=None, tag=None):
+	"""Builds the thermostat's 7-day program from PERIODS events in the week after start.
 
-	if query.feed is None:
-		print "No calendar with name '%s' found" % calName
-		return
+	Only events tagged tag (see splitTag) are used; by default, untagged 
+	ones.  The command for each period (e.g. "Heat 70") comes from commandMap.  
+	Returns {'heat': {day: [minute, temp, ...]}, 'cool': {...}} with days 
+	numbered from Monday and four [minute, temp] pairs per day.  Periods 
+	missing from a day repeat the one before (or the first one, at the 
+	start of the day); days without any periods are left out."""
+	if start is None:
+		start = time.mktime(datetime.date.today().timetuple())
+	found = {}
+	for t, text in schedule.between(start, start + 7 * 24 * 60 * 60):
+		eventTag, text = splitTag(text)
+		if eventTag != tag or text not in PERIODS:
+			continue
+		parsed = parseCommand(text, commandMap)
+		if parsed is None or parsed[0] not in ('Heat', 'Cool'):
+			continue
+		command, value = parsed
+		try:
+			value = int(float(value))
+		except ValueError:
+			continue
+		dt = datetime.datetime.fromtimestamp(t)
+		days = found.setdefault(command.lower(), {})
+		days.setdefault(dt.weekday(), {})[text] = [dt.hour * 60 + dt.minute, _clamp(command, value)]
 
-	# Search for the event that has passed but is closest to the current time
-	# There is probably a better way to do this...
-	closest = None
-	closestDT = None
-	closestWhen = None
-	closestEvent = None
-	closestCommand = None
-	closestValue = None
-	periods = {}
-	feed = calendar_service.CalendarQuery(query)
-	for i, an_event in enumerate(feed.entry):
-		#print '\t%s. %s' % (i, an_event.title.text,)
-
-		# Try to map named time period into actual command
-		text = an_event.title.text.strip()
-
-		if not text in PERIODS:
-			if commandMap.has_key(text):
-				text = commandMap[text]
-	
-			print "Translated %s into %s" % (an_event.title.text.strip(), text)
-	
-			# Skip events that are not valid commands
-			try:
-				(command, value) = text.splitlines()[0].split()
-			except:
-				command = text
-			if command not in COMMANDS:
-				print "Warning: '%s' is not a valid command" % text
-				continue
-			try:
-				float(value)
-			except:
-				if value not in ['Off', 'On', 'Auto']:
-					print "Warning: '%s' is not a valid command" % an_event.title.text
-					continue
-		for a_when in an_event.when:
-			d = a_when.start_time.split("T")[0]
-			t = a_when.start_time.split("T")[1].split(".")[0]
-			(year, month, day) = [int(p) for p in d.split("-")]
-			(hour, min, sec) = [int(p) for p in t.split(":")]
-			dt = datetime.datetime(year, month, day, hour, min, sec)-gmtDiff
-			#print "DT:", dt
-			d = dt-datetime.datetime.today()
-			#print "d.days:", d.days
-
-			if text in PERIODS:
-			    if not periods.has_key(dt.day):
-			        periods[dt.day] = {}
-				periods[dt.day][text] = dt
+	program = {}
+	for mode, days in found.items():
+		program[mode] = {}
+		for day, periods in days.items():
+			pairs = []
+			for p in PERIODS:
+				if periods.has_key(p):
+					pairs.append(periods[p])
+				elif pairs:
+					pairs.append(pairs[-1])
+			pairs = [pairs[0]] * (len(PERIODS) - len(pairs)) + pairs
+			program[mode][day] = sum(pairs, [])
+	return program
+
+def uploadProgram(tstat, program):
+	"""Writes the days of program (see compileProgram) that differ from the thermostat's program.
+
+	Returns {mode: {day: True/False}} for the days that were sent."""
+	results = {}
+	for mode, days in program.items():
+		current = tstat.getProgram(mode)
+		changed = {}
+		for day, periods in days.items():
+			if current.get(day) != periods:
+				changed[day] = periods
+		if changed:
+			results[mode] = tstat.setProgram(mode, changed)
+	return results
+
+def _sync(calendar_service, schedule, calName, username, password):
+	"""Used internally to bring schedule up to date, logging in again if the session has expired.
+
+	With no calendar_service, logs in with the token saved in schedule 
+	(if any).  Returns (calendar_service, found)."""
+	token = schedule.state.get('token')
+	fresh = calendar_service is None and token is None
+	try:
+		if calendar_service is None:
+			calendar_service = getCalendarService(username, password, token)
+		found = syncCalendar(calendar_service, schedule, calName)
+	except gdata.service.RequestError:
+		if fresh:
+			raise
+		# Saved login has expired
+		calendar_service = getCalendarService(username, password)
+		found = syncCalendar(calendar_service, schedule, calName)
+	if found:
+		schedule.state['token'] = calendar_service.GetClientLoginToken()
+		schedule.save()
+	return (calendar_service, found)
+
+class GoogleCalendar:
+	"""Calendar source for a Google calendar (needs gdata)."""
+
+	def __init__(self, username, password, calName="Thermostat"):
+		if gdata is None:
+			raise ImportError("GoogleCalendar needs gdata (http://code.google.com/p/gdata-python-client/)")
+		self.username = username
+		self.password = password
+		self.name = calName
+		self.calendar_service = None
+
+	def sync(self, schedule):
+		"""Brings schedule up to date with the calendar.  Returns False if there is no such calendar."""
+		self.calendar_service, found = _sync(self.calendar_service, schedule, self.name, self.username, self.password)
+		return found
+
+	def calendar(self, calName):
+		"""Returns a source for another calendar of the same account, sharing this one's login."""
+		source = GoogleCalendar(self.username, self.password, calName)
+		source.calendar_service = self.calendar_service
+		return source
+
+def _program(tstat, schedule, commandMap):
+	"""Used internally to upload the programmed periods in schedule to tstat."""
+	program = compileProgram(schedule, commandMap)
+	print "Program:", program
+	for mode, days in uploadProgram(tstat, program).items():
+		for day, result in sorted(days.items()):
+			if result:
+				print "Updated %s program for %s" % (mode, TStat.PROGRAM_DAYS[day])
 			else:
-				# Skip events that are in the future
-				if d.days >= 0:
-					continue
-	
-				if closest is None:
-					closest = d
-					closestDT = dt
-					closestWhen = a_when
-					closestEvent = an_event
-					closestCommand = command
-					closestValue = value
-				else:
-					if d.days < closest.days:
-						continue
-					if d.seconds > closest.seconds:
-						closest = d
-						closestDT = dt
-						closestWhen = a_when
-						closestEvent = an_event
-						closestCommand = command
-						closestValue = value
-
-	print "Found periods:", periods
-	
-	# Handle programmed periods
-	periodCommands = {}
-	for day in range(0,7):
-	    if not periodCommands.has_key(day):
-            periodCommands[day] = []
-        for p in PERIODS:
-    
-            if periods.has_key(p):
-                periodCommands.append(int(periods[p].hour*60+periods[p].minute))
-                periodCommands.append(int(commandMap[p].split()[-1]))
-            else:
-                periodCommands.append(periodCommands[-2])
-                periodCommands.append(periodCommands[-2])			
-
-	print "Commands:", periodCommands
-
-	if closestEvent is None:
-		print "No events found"
-		return
+				print "Failed to update %s program for %s" % (mode, TStat.PROGRAM_DAYS[day])
 
-	text = closestEvent.title.text
-	print "Closest event: %s at %s" % (text, closestDT)
-	#(command, value) = text.splitlines()[0].split()
-	command, value = (closestCommand, closestValue)
+def resolveCommand(text, commandMap):
+	"""Returns (TStat method name, value) that carries out the command in the event title text, or None.
+
+	Commands outside the HEAT/COOL limits are not carried out."""
+	command, value = parseCommand(text, commandMap)
 	if command == 'Heat':
 		value = int(value)
 		if value >= HEAT_MIN and value <= HEAT_MAX:
-			print "Setting heat to %s" % int(value)
-			#tstat.setHeatPoint(value)
+			# Heat set points are only sent as part of the 7-day program
+			print "Heat commands are disabled; not setting heat to %s" % value
 		else:
 			print "Value out of acceptable heat range:", value
 	elif command == 'Cool':
 		value = int(value)
 		if value >= COOL_MIN and value <= COOL_MAX:
 			print "Setting cool to %s" % value
-			tstat.setCoolPoint(int(value))
+			return ('setCoolPoint', int(value))
 		else:
 			print "Value out of acceptable cool range:", value
 	elif command == 'Fan':
 		print "Setting fan to %s" % value
-		tstat.setFanMode(value)
+		return ('setFanMode', value)
 	elif command == 'Mode':
 		print "Setting mode to %s" % value
-		tstat.setTstatMode(value)
+		return ('setTstatMode', value)
+	return None
+
+def applyCommand(tstat, text, commandMap):
+	"""Sends the command in the event title text to tstat, within the HEAT/COOL limits.
+
+	Returns the result of the TStat setter, or None if nothing was sent."""
+	action = resolveCommand(text, commandMap)
+	if action is None:
+		return None
+	method, value = action
+	return getattr(tstat, method)(value)
+
+class CalendarDaemon:
+	"""Keeps a thermostat in step with a calendar, sending each command at its start time."""
+
+	def __init__(self, tstatAddr, commandMap=None, username=None, password=None, calName="Thermostat", schedulePath=None, refresh=900, source=None):
+		if commandMap is None:
+			commandMap = {}
+		if source is None:
+			source = GoogleCalendar(username, password, calName)
+		if schedulePath is None:
+			schedulePath = Schedule.schedulePath(source.name)
+		self.tstat = TStat.TStat(tstatAddr)
+		self.commandMap = commandMap
+		self.source = source
+		self.schedule = Schedule.Schedule(schedulePath)
+		self.refreshInterval = refresh
+		self._cond = threading.Condition()
+		self._timers = []
+		self._seq = 0
+		self._last = None
+		self._stopped = False
+		self._wake = threading.Event()
+		self._refresher = None
+
+	def _accept(self, text):
+		return isCommand(text, self.commandMap)
+
+	def refresh(self):
+		"""Syncs the calendar, updates the thermostat's program and reschedules commands.
+
+		Returns False if the calendar was not found."""
+		if not self.source.sync(self.schedule):
+			print "No calendar with name '%s' found" % self.source.name
+			return False
+		_program(self.tstat, self.schedule, self.commandMap)
+
+		self._cond.acquire()
+		try:
+			# Everything after the last command sent, up to the end of the synced window
+			after = self._last
+			if after is None:
+				after = time.time()
+			end = self.schedule.state.get('windowEnd', after + 8 * 24 * 60 * 60)
+			self._timers = []
+			for start, text in self.schedule.between(after, end):
+				if start > after and self._accept(text):
+					self._seq = self._seq + 1
+					heapq.heappush(self._timers, (start, self._seq, text))
+			self._cond.notify()
+		finally:
+			self._cond.release()
+		return True
+
+	def _refreshLoop(self):
+		"""Used internally to refresh the calendar every refreshInterval seconds."""
+		while True:
+			self._wake.wait(self.refreshInterval)
+			if self._stopped:
+				return
+			try:
+				self.refresh()
+			except Exception, e:
+				# Keep the commands we already have until the next try
+				print "Calendar refresh failed: %s" % e
+
+	def run(self, duration=None):
+		"""Sends commands as they come due until stop() is called (or for duration seconds)."""
+		self._stopped = False
+		self._wake.clear()
+		now = time.time()
+		self._last = now
+		if not self.refresh():
+			return
+		closest = self.schedule.closest(now, self._accept)
+		if closest is not None:
+			print "Closest event: %s at %s" % (closest[1], datetime.datetime.fromtimestamp(closest[0]))
+			applyCommand(self.tstat, closest[1], self.commandMap)
+		self._refresher = threading.Thread(target=self._refreshLoop, name="TStatGcal-refresh")
+		self._refresher.setDaemon(True)
+		self._refresher.start()
+		end = None
+		if duration is not None:
+			end = now + duration
+
+		self._cond.acquire()
+		try:
+			while not self._stopped:
+				now = time.time()
+				if end is not None and now >= end:
+					break
+				wait = 60.0
+				if end is not None:
+					wait = min(wait, end - now)
+				if self._timers and self._timers[0][0] <= now:
+					start, seq, text = heapq.heappop(self._timers)
+					self._last = start
+					self._cond.release()
+					try:
+						print "Event: %s at %s" % (text, datetime.datetime.fromtimestamp(start))
+						try:
+							applyCommand(self.tstat, text, self.commandMap)
+						except Exception, e:
+							print "Command '%s' failed: %s" % (text, e)
+					finally:
+						self._cond.acquire()
+					continue
+				if self._timers:
+					wait = min(wait, self._timers[0][0] - now)
+				self._cond.wait(wait)
+		finally:
+			self._stopped = True
+			self._cond.release()
+			self._wake.set()
+
+	def stop(self):
+		"""Makes run() return."""
+		self._cond.acquire()
+		try:
+			self._stopped = True
+			self._cond.notify()
+		finally:
+			self._cond.release()
+		self._wake.set()
+
+	def close(self):
+		self.stop()
+		self.tstat.close()
+
+def main(tstatAddr, commandMap=None, username=None, password=None, calName="Thermostat", schedulePath=None, source=None):
+	# Connect to thermostat
+	tstat = TStat.TStat(tstatAddr)
+
+	if commandMap is None:
+		commandMap = {}
+
+	# Bring the local copy of the calendar up to date
+	if source is None:
+		source = GoogleCalendar(username, password, calName)
+	if schedulePath is None:
+		schedulePath = Schedule.schedulePath(source.name)
+	schedule = Schedule.Schedule(schedulePath)
+	if not source.sync(schedule):
+		print "No calendar with name '%s' found" % source.name
+		return
+
+	# Let the thermostat run the programmed periods itself
+	_program(tstat, schedule, commandMap)
+
+	# Find the command that has passed but is closest to the current time
+	closest = schedule.closest(time.time(), lambda text: isCommand(text, commandMap))
+	if closest is None:
+		print "No events found"
+		return
+
+	closestDT = datetime.datetime.fromtimestamp(closest[0])
+	text = closest[1]
+	print "Closest event: %s at %s" % (text, closestDT)
+	applyCommand(tstat, text, commandMap)
+
+def readZones(path):
+	"""Reads a zone map file with lines like "Upstairs:10.0.0.5,10.0.0.6" into {zone: [address, ...]}."""
+	zones = {}
+	f = open(path)
+	try:
+		for line in f.readlines():
+			if not line.strip():
+				continue
+			zone, addresses = line.split(":", 1)
+			zones[zone.strip()] = [a.strip() for a in addresses.split(",") if a.strip()]
+	finally:
+		f.close()
+	return zones
+
+def zoneCommand(schedule, commandMap, tag=None, now=None):
+	"""Returns (start, text) of the command in effect for events tagged tag (untagged by default), or None.
+
+	text has the tag removed."""
+	def accept(text):
+		eventTag, text = splitTag(text)
+		return eventTag == tag and isCommand(text, commandMap)
+	closest = schedule.closest(now, accept)
+	if closest is None:
+		return None
+	return (closest[0], splitTag(closest[1])[1])
+
+def mainZones(zones, commandMap=None, username=None, password=None, calName="Thermostat", source=None, workers=8):
+	"""Drives every zone in zones from one pass over the calendars.
+
+	zones maps a calendar name, or "#tag" for events tagged tag in the 
+	calName calendar (or source), to a list of thermostat addresses.  
+	Each calendar is synced once, sharing one login.  The writes for 
+	every thermostat run in parallel on at most workers threads.  Returns 
+	{address: (result, error)}."""
+	from TStatFleet import TStatFleet
+
+	if commandMap is None:
+		commandMap = {}
+	if source is None:
+		source = GoogleCalendar(username, password, calName)
+
+	# Sync each calendar any zone needs once, starting with the main one
+	names = []
+	for zone in zones:
+		if zone.startswith('#'):
+			name = source.name
+		else:
+			name = zone
+		if name not in names:
+			names.append(name)
+	if source.name in names:
+		names.remove(source.name)
+		names.insert(0, source.name)
+	schedules = {}
+	last = source
+	for name in names:
+		if name == source.name:
+			calendarSource = source
+		elif hasattr(last, 'calendar'):
+			calendarSource = last.calendar(name)
+		else:
+			print "No calendar with name '%s' found" % name
+			continue
+		schedule = Schedule.Schedule(Schedule.schedulePath(name))
+		if not calendarSource.sync(schedule):
+			print "No calendar with name '%s' found" % name
+			continue
+		schedules[name] = schedule
+		last = calendarSource
+
+	# Work out what each zone's thermostats should be doing
+	now = time.time()
+	tasks = {}
+	for zone, addresses in sorted(zones.items()):
+		tag, name = splitTag(zone)
+		if tag is not None:
+			name = source.name
+		if not schedules.has_key(name):
+			continue
+		schedule = schedules[name]
+		program = compileProgram(schedule, commandMap, tag=tag)
+		action = None
+		command = zoneCommand(schedule, commandMap, tag, now)
+		if command is None:
+			print "Zone %s: no events found" % zone
+		else:
+			print "Zone %s: %s at %s" % (zone, command[1], datetime.datetime.fromtimestamp(command[0]))
+			action = resolveCommand(command[1], commandMap)
+		for address in addresses:
+			if tasks.has_key(address):
+				print "%s is in zones %s and %s; using %s" % (address, tasks[address][0], zone, tasks[address][0])
+				continue
+			tasks[address] = (zone, program, action)
+
+	def work(tstat):
+		zone, program, action = tasks[tstat.address]
+		uploaded = uploadProgram(tstat, program)
+		result = None
+		if action is not None:
+			method, value = action
+			result = getattr(tstat, method)(value)
+		return (uploaded, result)
+
+	results = {}
+	fleet = TStatFleet(sorted(tasks), workers=workers)
+	try:
+		for address, result, error in fleet.imap(work):
+			zone = tasks[address][0]
+			if error is not None:
+				print "%s (%s): failed: %s" % (address, zone, error)
+				results[address] = (None, error)
+				continue
+			uploaded, result = result
+			days = []
+			for mode, modeDays in sorted(uploaded.items()):
+				for day, ok in sorted(modeDays.items()):
+					if not ok:
+						days.append("%s %s failed" % (mode, TStat.PROGRAM_DAYS[day]))
+					else:
+						days.append("%s %s" % (mode, TStat.PROGRAM_DAYS[day]))
+			if days:
+				print "%s (%s): program updated: %s" % (address, zone, ", ".join(days))
+			if tasks[address][2] is None:
+				print "%s (%s): no command sent" % (address, zone)
+			elif result:
+				print "%s (%s): %s %s ok" % ((address, zone) + tasks[address][2])
+			else:
+				print "%s (%s): %s %s failed" % ((address, zone) + tasks[address][2])
+			results[address] = (result, None)
+	finally:
+		fleet.close()
+	return results
 
 if __name__ == '__main__':
-	f = open(os.path.expanduser("~/.google"))
-	username = f.readline().splitlines()[0]
-	password = f.readline().splitlines()[0]
-	f.close()
+	opts, args = getopt.getopt(sys.argv[1:], "dr:i:z:j:", ["daemon", "refresh=", "ics=", "zones=", "jobs="])
+	daemon = False
+	refresh = 900
+	ics = None
+	zones = None
+	jobs = 8
+	for opt, arg in opts:
+		if opt in ("-d", "--daemon"):
+			daemon = True
+		elif opt in ("-r", "--refresh"):
+			refresh = float(arg)
+		elif opt in ("-i", "--ics"):
+			ics = arg
+		elif opt in ("-z", "--zones"):
+			zones = readZones(arg)
+		elif opt in ("-j", "--jobs"):
+			jobs = int(arg)
 	commandMap = {}
 	if os.path.isfile(os.path.expanduser("~/.tstat_commands")):
 		f = open(os.path.expanduser("~/.tstat_commands"))
@@ -304,4 +781,30 @@ if __name__ == '__main__':
 			key, value = line.split(":")
 			commandMap[key] = value
 		f.close()
-	main(sys.argv[1], username=username, password=password, calName=sys.argv[2], commandMap=commandMap)
+	if ics is not None:
+		source = ICSCalendar(ics)
+	else:
+		f = open(os.path.expanduser("~/.google"))
+		username = f.readline().splitlines()[0]
+		password = f.readline().splitlines()[0]
+		f.close()
+		calName = "Thermostat"
+		if zones is None:
+			calName = args[1]
+		elif args:
+			calName = args[0]
+		source = GoogleCalendar(username, password, calName)
+	if zones is not None:
+		results = mainZones(zones, commandMap, source=source, workers=jobs)
+		for result, error in results.values():
+			if error is not None:
+				sys.exit(1)
+	elif daemon:
+		d = CalendarDaemon(args[0], commandMap, refresh=refresh, source=source)
+		try:
+			d.run()
+		except KeyboardInterrupt:
+			pass
+		d.close()
+	else:
+		main(args[0], commandMap=commandMap, source=source)
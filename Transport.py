@@ -0,0 +1,293 @@
+#!/usr/bin/env python
+
+#Copyright (c) 2011, Paul Jennings <pjennings-tstat@pjennings.net>
+#All rights reserved.
+
+#Redistribution and use in source and binary forms, with or without
+#modification, are permitted provided that the following conditions are met:
+#
+#    * Redistributions of source code must retain the above copyright notice,
+#      this list of conditions and the following disclaimer.
+#    * Redistributions in binary form must reproduce the above copyright
+#      notice, this list of conditions and the following disclaimer in the
+#      documentation and/or other materials provided with the distribution.
+#    * The names of its contributors may not be used to endorse or promote
+#      products derived from this software without specific prior written
+#      permission.
+
+#THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+#AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+#IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+#ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+#LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+#CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+#SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+#INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+#CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+#ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF
+#THE POSSIBILITY OF SUCH DAMAGE.
+
+# Transport.py
+# Recording and replaying thermostat traffic.
+
+# Usage:
+# trace = TraceWriter('house.trace.gz')
+# t = TStat('10.0.0.5', transport=RecordingTransport(ConnectionPool('10.0.0.5'), trace))
+# ...                          # Use t as normal; every exchange is saved
+# trace.close()
+#
+# t = TStat('10.0.0.5', transport=ReplayTransport('house.trace.gz', '10.0.0.5', speed=10))
+# ...                          # Same answers, 10 times faster, no thermostat
+#
+# A transport is whatever TStat gets connections from (see TStat._getConn):
+# an object with ConnectionPool's acquire(), release(conn), discard(conn)
+# and close() methods, whose connections behave like httplib.HTTPConnection.
+# The default transport is a ConnectionPool.
+#
+# RecordingTransport wraps another transport and saves each request, the
+# answer (or failure) and how long it took to a TraceWriter.  One trace may
+# be shared by many TStat instances.  A trace is a gzip-compressed file with
+# a JSON header line followed by one JSON array per exchange:
+#   [started, seconds, address, method, location, body, status, data]
+# where started is seconds since the trace was opened and status is null
+# for requests that got no answer.  Each new connection is also saved, as
+# method "CONNECT" with a null location and status 200 (or null if the
+# connection could not be made).
+#
+# ReplayTransport answers each (method, location) with the recorded
+# exchanges for that address in the order they were recorded, starting over
+# when they run out.  Each answer is delayed by its recorded time divided by
+# speed (speed=None for no delay).  Recorded failures raise socket.error.
+# Requests that were never recorded get a 404; connections always succeed
+# if none were recorded.
+
+import gzip
+import httplib
+import socket
+import threading
+import time
+
+from collections import deque
+
+# For Python < 2.6, this json module:
+# http://pypi.python.org/pypi/python-json
+# will work.
+try:
+	from json import read as loads
+	from json import write as dumps
+except ImportError:
+	from json import loads
+	from json import dumps
+
+from Cache import monotonic
+
+TRACE_VERSION = 1
+
+def _text(data):
+	"""Used internally to store byte strings losslessly in JSON."""
+	if data is None:
+		return None
+	return data.decode('latin-1')
+
+def _bytes(text):
+	if text is None:
+		return None
+	return text.encode('latin-1')
+
+class TraceWriter:
+	"""Appends recorded exchanges to a trace file."""
+
+	def __init__(self, path):
+		self.path = path
+		self._lock = threading.Lock()
+		self._started = monotonic()
+		self._file = gzip.open(path, 'wb')
+		self._file.write(dumps({'version': TRACE_VERSION, 'created': time.time()}) + "\n")
+
+	def write(self, started, seconds, address, method, location, body, status, data):
+		"""Saves one exchange; started is a monotonic() time."""
+		line = dumps([round(started - self._started, 6), round(seconds, 6), address, method, location, _text(body), status, _text(data)])
+		self._lock.acquire()
+		try:
+			self._file.write(line + "\n")
+		finally:
+			self._lock.release()
+
+	def close(self):
+		self._lock.acquire()
+		try:
+			if self._file is not None:
+				self._file.close()
+				self._file = None
+		finally:
+			self._lock.release()
+
+def readTrace(path):
+	"""Yields each recorded exchange in path as a tuple (see TraceWriter.write)."""
+	f = gzip.open(path, 'rb')
+	try:
+		header = loads(f.readline())
+		if header.get('version') != TRACE_VERSION:
+			raise ValueError("%s is not a version %d trace" % (path, TRACE_VERSION))
+		for line in f:
+			started, seconds, address, method, location, body, status, data = loads(line)
+			yield (started, seconds, address, method, location, _bytes(body), status, _bytes(data))
+	finally:
+		f.close()
+
+class _Response:
+	"""Minimal stand-in for httplib.HTTPResponse holding an already read body."""
+
+	def __init__(self, status, data):
+		self.status = status
+		self._data = data
+
+	def read(self):
+		data, self._data = self._data, ""
+		return data
+
+class _RecordingConnection:
+	"""Wraps a connection, recording each request and its answer."""
+
+	def __init__(self, conn, address, trace):
+		self.conn = conn
+		self.address = address
+		self.trace = trace
+		self._request = None
+		self._reused = False
+
+	def __getattr__(self, name):
+		return getattr(self.conn, name)
+
+	def __setattr__(self, name, value):
+		if name == 'timeout':
+			self.conn.timeout = value
+		else:
+			self.__dict__[name] = value
+
+	def connect(self):
+		started = monotonic()
+		try:
+			self.conn.connect()
+		except (socket.error, httplib.HTTPException):
+			self.trace.write(started, monotonic() - started, self.address, "CONNECT", None, None, None, None)
+			raise
+		self.trace.write(started, monotonic() - started, self.address, "CONNECT", None, None, 200, None)
+
+	def request(self, method, location, body=None, headers=None):
+		self._request = (monotonic(), method, location, body)
+		self._reused = self.conn.sock is not None
+		try:
+			self.conn.request(method, location, body, headers or {})
+		except (socket.error, httplib.HTTPException):
+			self._failed()
+			raise
+
+	def getresponse(self):
+		try:
+			response = self.conn.getresponse()
+			data = response.read()
+		except (socket.error, httplib.HTTPException):
+			self._failed()
+			raise
+		started, method, location, body = self._request
+		self.trace.write(started, monotonic() - started, self.address, method, location, body, response.status, data)
+		return _Response(response.status, data)
+
+	def _failed(self):
+		# TStat quietly retries requests that fail on a reused connection
+		if self._reused:
+			return
+		started, method, location, body = self._request
+		self.trace.write(started, monotonic() - started, self.address, method, location, body, None, None)
+
+class RecordingTransport:
+	def __init__(self, transport, trace):
+		self.transport = transport
+		self.trace = trace
+
+	def acquire(self):
+		conn = self.transport.acquire()
+		return _RecordingConnection(conn, getattr(self.transport, 'address', None), self.trace)
+
+	def release(self, conn):
+		self.transport.release(conn.conn)
+
+	def discard(self, conn):
+		self.transport.discard(conn.conn)
+
+	def close(self):
+		self.transport.close()
+
+class _NullSocket:
+	"""Stands in for the socket of a replayed connection."""
+
+	def settimeout(self, timeout):
+		pass
+
+	def close(self):
+		pass
+
+class _ReplayConnection:
+	def __init__(self, transport):
+		self.transport = transport
+		self.sock = None
+		self.timeout = None
+		self._exchange = None
+
+	def connect(self):
+		seconds, status, data = self.transport._next("CONNECT", None, (0, 200, None))
+		if self.transport.speed:
+			time.sleep(seconds / self.transport.speed)
+		if status is None:
+			raise socket.error("Recorded connection failed")
+		self.sock = _NullSocket()
+
+	def request(self, method, location, body=None, headers=None):
+		self._exchange = self.transport._next(method, location)
+
+	def getresponse(self):
+		seconds, status, data = self._exchange
+		self._exchange = None
+		if self.transport.speed:
+			time.sleep(seconds / self.transport.speed)
+		if status is None:
+			raise socket.error("Recorded request failed")
+		return _Response(status, data)
+
+	def close(self):
+		self.sock = None
+
+class ReplayTransport:
+	def __init__(self, path, address=None, speed=1.0):
+		self.speed = speed
+		self._lock = threading.Lock()
+		self._exchanges = {}
+		for started, seconds, recorded, method, location, body, status, data in readTrace(path):
+			if address is None or recorded == address:
+				self._exchanges.setdefault((method, location), deque()).append((seconds, status, data))
+
+	def _next(self, method, location, default=(0, 404, "Not recorded")):
+		"""Used internally to take the next recorded answer for (method, location)."""
+		self._lock.acquire()
+		try:
+			exchanges = self._exchanges.get((method, location))
+			if not exchanges:
+				return default
+			exchange = exchanges.popleft()
+			exchanges.append(exchange)
+			return exchange
+		finally:
+			self._lock.release()
+
+	def acquire(self):
+		return _ReplayConnection(self)
+
+	def release(self, conn):
+		pass
+
+	def discard(self, conn):
+		conn.close()
+
+	def close(self):
+		pass